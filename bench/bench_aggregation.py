@@ -0,0 +1,71 @@
+"""
+Сравнение движков сложения статистики (aggregation_engine): python и numpy (src/vector_engine.py).
+Складывает N частичных статистик по странице в 100 вопросов (как extract_info при N тегах / страницах) и выводит
+среднее время в мс в JSON: cold - статистики новые (массивы NumPy строятся при сложении),
+warm - те же статистики повторно (как при попадании в кэш). Нужен установленный numpy.
+
+Запуск из корня проекта:
+    python -m bench.bench_aggregation --partials 1,10,50,100,1000 --repeat 5
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+from src import vector_engine
+from src.data_extractor import TagStats, count_questions, extract_info
+
+
+def make_page(tag_pool: int, tags_per_question: int, rnd: random.Random) -> TagStats:
+    """ Частичная статистика по странице из 100 вопросов как в ответе StackOverflow """
+    pool = [f'tag{i}' for i in range(tag_pool)]
+    return count_questions({'items': [{'tags': rnd.sample(pool, tags_per_question), 'is_answered': rnd.random() < 0.6}
+                                      for _ in range(100)]})
+
+
+def run(args) -> list[dict]:
+    rnd = random.Random(args.seed)
+    results = []
+    for count in args.partials:
+        pages = [make_page(args.tag_pool, args.tags_per_question, rnd) for _ in range(count)]
+
+        async def merge(engine: str, cold: bool) -> float:
+            partials = [page.copy() for page in pages] if cold else pages  # у копий массивы не построены
+            start = time.perf_counter()
+            await extract_info(partials, engine=engine)
+            return time.perf_counter() - start
+
+        row = {'partials': count, 'tags': sum(len(page) for page in pages)}
+        for engine in ('python', 'numpy'):
+            for cold in (True, False):
+                asyncio.run(merge(engine, cold))  # прогрев (и построение массивов для warm)
+                elapsed = [asyncio.run(merge(engine, cold)) for _ in range(args.repeat)]
+                row[f'{engine}_{"cold" if cold else "warm"}_ms'] = round(sum(elapsed) / len(elapsed) * 1000, 3)
+
+        # оба движка должны давать одинаковый результат (порядок тегов может отличаться)
+        assert asyncio.run(extract_info(pages)) == asyncio.run(extract_info(pages, engine='numpy'))
+        results.append(row)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--partials', default='1,10,50,100,1000', help='количества частичных статистик, через запятую')
+    parser.add_argument('--repeat', type=int, default=5, help='повторов каждого замера')
+    parser.add_argument('--tag-pool', type=int, default=5000, help='количество разных тегов в вопросах')
+    parser.add_argument('--tags-per-question', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    args.partials = [int(count) for count in args.partials.split(',')]
+
+    if vector_engine.np is None:
+        sys.exit('numpy is not installed')
+    from loguru import logger
+    logger.remove()  # debug логи сложения искажают замеры
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == '__main__':
+    main()
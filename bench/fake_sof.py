@@ -0,0 +1,90 @@
+"""
+Поддельный StackExchange API для нагрузочного тестирования sof_stats.
+Отдает /2.3/search и /2.3/filters/create с настраиваемой задержкой, долей ошибок и размером ответа.
+
+Запуск: python -m bench.fake_sof --port 7100 --latency 150 --error-rate 0.01
+"""
+import argparse
+import asyncio
+import random
+
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request
+from starlette.responses import Response
+
+FAKE_FILTER = '!fake-sof-stats'
+
+
+def create_fake_app(latency_ms: float = 100, jitter_ms: float = 20, error_rate: float = 0.0,
+                    tag_pool: int = 5000, tags_per_question: int = 4, extra_bytes: int = 600,
+                    seed: int = 0) -> FastAPI:
+    """
+    :param latency_ms: средняя задержка ответа в мс
+    :param jitter_ms: разброс задержки в мс (равномерно +-)
+    :param error_rate: доля ответов с ошибкой 502 (как у StackExchange при сбоях)
+    :param tag_pool: из скольких разных тегов выбираются теги вопросов
+    :param tags_per_question: тегов в каждом вопросе (включая искомый)
+    :param extra_bytes: размер полей вопроса, не нужных сервису (title, owner и т.д.), если фильтр не передан
+    :param seed: seed генератора случайных чисел
+    """
+    fake_app = FastAPI(title='fake_sof')
+    rnd = random.Random(seed)
+    pool = [f'tag{i}' for i in range(tag_pool)]
+    filler = 'x' * extra_bytes
+    quota = {'remaining': 10 ** 9}
+    fake_app.state.requests = 0
+
+    @fake_app.get('/2.3/filters/create')
+    async def create_filter():
+        return Response(orjson.dumps({'items': [{'filter': FAKE_FILTER}]}), media_type='application/json')
+
+    @fake_app.get('/2.3/search')
+    async def search(request: Request):
+        params = request.query_params
+        fake_app.state.requests += 1
+        await asyncio.sleep(max(latency_ms + rnd.uniform(-jitter_ms, jitter_ms), 0) / 1000)
+
+        if rnd.random() < error_rate:
+            body = {'error_id': 502, 'error_message': 'fake upstream error', 'error_name': 'fake_error'}
+            return Response(orjson.dumps(body), status_code=503, media_type='application/json')
+
+        tag = params.get('tagged') or params.get('intitle') or 'tag'
+        page = int(params.get('page', 1))
+        pagesize = int(params.get('pagesize', 100))
+        minimal = params.get('filter') == FAKE_FILTER
+        items = []
+        for i in range(pagesize):
+            question = {'tags': [tag] + rnd.sample(pool, tags_per_question - 1),
+                        'is_answered': rnd.random() < 0.6}
+            if not minimal:
+                question.update({'title': filler, 'owner': {'display_name': 'fake'}, 'score': 0,
+                                 'creation_date': 1_700_000_000 - page * pagesize - i,
+                                 'link': 'https://stackoverflow.com/q/0', 'question_id': page * pagesize + i})
+            items.append(question)
+
+        quota['remaining'] -= 1
+        body = {'items': items, 'has_more': page < 25, 'quota_max': 10 ** 9, 'quota_remaining': quota['remaining']}
+        return Response(orjson.dumps(body), media_type='application/json')
+
+    return fake_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7100)
+    parser.add_argument('--latency', type=float, default=100, help='средняя задержка ответа, мс')
+    parser.add_argument('--jitter', type=float, default=20, help='разброс задержки, мс')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов с ошибкой')
+    parser.add_argument('--tag-pool', type=int, default=5000, help='количество разных тегов в вопросах')
+    parser.add_argument('--extra-bytes', type=int, default=600, help='размер ненужных полей вопроса без фильтра')
+    args = parser.parse_args()
+
+    fake_app = create_fake_app(latency_ms=args.latency, jitter_ms=args.jitter, error_rate=args.error_rate,
+                               tag_pool=args.tag_pool, extra_bytes=args.extra_bytes)
+    uvicorn.run(fake_app, host=args.host, port=args.port, log_level='warning', access_log=False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+Нагрузочный тест sof_stats: поднимает поддельный StackExchange API (bench/fake_sof.py) и сам сервис с временным
+конфигом, подает на /search запросы с фиксированным RPS и заданным распределением количества тегов и выводит
+p50/p95/p99 задержки, RPS, CPU и RSS сервиса в JSON.
+
+Запуск из корня проекта:
+    python -m bench.run_bench --rps 50 --duration 20 --mix 1:50,3:30,10:20 --out bench_result.json
+Сравнение с прошлым результатом (код выхода 1 при регрессии больше 20%):
+    python -m bench.run_bench --baseline bench_result.json --max-regression 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tomllib
+
+import httpx
+
+from src import constants
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def toml_value(value) -> str:
+    """ Значение в синтаксисе TOML: строки, bool, числа, списки и словари (inline table) """
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, str):
+        return json.dumps(value, ensure_ascii=False)  # строка JSON - допустимая базовая строка TOML
+    if isinstance(value, dict):
+        items = ', '.join(f'{json.dumps(str(key), ensure_ascii=False)} = {toml_value(item)}'
+                          for key, item in value.items())
+        return f'{{ {items} }}' if items else '{}'
+    if isinstance(value, (list, tuple)):
+        return f'[{", ".join(toml_value(item) for item in value)}]'
+    return str(value)
+
+
+def dump_toml(data: dict) -> str:
+    """ Записать конфиг (секция: {ключ: значение}) в TOML """
+    lines = []
+    for section, values in data.items():
+        lines.append(f'[{section}]')
+        for key, value in values.items():
+            lines.append(f'{key} = {toml_value(value)}')
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def make_config(args, fake_url: str, workdir: str) -> str:
+    """
+    Временный конфиг сервиса на основе боевого: StackExchange заменен поддельным, логи - только ошибки.
+    Снимок кэша выключен, а хранилище - во временном каталоге: прогон не читает и не пишет данные сервиса и каждый
+    раз начинается с холодного кэша, иначе сравнение с --baseline искажено
+    :param workdir: временный каталог прогона - в нем конфиг и файл SQLite хранилища
+    :return: путь к конфигу
+    """
+    with open(os.path.join(ROOT, constants.WAR_CONFIG_PATH), 'rb') as f:
+        data = tomllib.load(f)
+
+    overrides = {
+        'self_api_port'   : args.port,
+        'self_api_host'   : '127.0.0.1',
+        'stop_delay'      : 0,
+        'workers'         : args.workers,
+        'log_level'       : 'ERROR',
+        'log_console'     : False,
+        'max_requests'    : args.max_requests,
+        'max_alive_requests': args.max_requests,
+        'rate_limit'      : 0,  # меряем сервис, а не регулятор
+        'cache_ttl'       : args.cache_ttl,
+        'hot_tags'        : 0,
+        'snapshot_path'   : '',
+        'store_path'      : os.path.join(workdir, 'store.db'),
+        'url'             : f'{fake_url}/2.3/search',
+        'filter_url'      : f'{fake_url}/2.3/filters/create',
+    }
+    for values in data.values():
+        for key in values:
+            if key in overrides:
+                values[key] = overrides[key]
+
+    path = os.path.join(workdir, 'config.toml')
+    with open(path, 'w', encoding='UTF-8') as f:
+        f.write(dump_toml(data))
+    return path
+
+
+def proc_tree_usage(pid: int) -> dict | None:
+    """
+    CPU (секунды user + system) и RSS (МБ) процесса и всех его потомков (uvicorn worker'ов). Только Linux (/proc)
+    """
+    if not os.path.isdir('/proc'):
+        return None
+
+    ticks = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    cpu, rss = 0.0, 0
+    queue = [pid]
+    while queue:
+        current = queue.pop()
+        try:
+            with open(f'/proc/{current}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            cpu += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+            with open(f'/proc/{current}/statm') as f:
+                rss += int(f.read().split()[1]) * page
+            with open(f'/proc/{current}/task/{current}/children') as f:
+                queue.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, IndexError):
+            continue
+    return {'cpu_seconds': round(cpu, 3), 'rss_mb': round(rss / 2 ** 20, 1)}
+
+
+def parse_mix(mix: str) -> tuple[list[int], list[float]]:
+    """ "1:50,3:30,10:20" -> ([1, 3, 10], [50, 30, 20]) - количество тегов в запросе и их веса """
+    counts, weights = [], []
+    for part in mix.split(','):
+        count, weight = part.split(':')
+        counts.append(int(count))
+        weights.append(float(weight))
+    return counts, weights
+
+
+def percentile(values: list[float], p: float) -> float | None:
+    """ Перцентиль p (0-100) по отсортированному списку """
+    if not values:
+        return None
+    index = min(int(round(p / 100 * (len(values) - 1))), len(values) - 1)
+    return round(values[index], 2)
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    """ Дождаться, пока сервис начнет отвечать на url """
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f'{url} is not ready in {timeout} seconds')
+
+
+async def drive(base_url: str, args) -> list[tuple[int, float, int]]:
+    """
+    Подать нагрузку с фиксированным RPS (open loop - запросы отправляются по расписанию, не дожидаясь ответов)
+    :return: [(количество тегов, задержка в мс, статус ответа)]
+    """
+    rnd = random.Random(args.seed)
+    counts, weights = parse_mix(args.mix)
+    pool = [f'tag{i}' for i in range(args.tag_pool)]
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.request_timeout, limits=limits) as client:
+        async def one(tags: list[str]) -> tuple[int, float, int]:
+            start = time.perf_counter()
+            try:
+                status = (await client.post('/search', params={'tag': tags})).status_code
+            except httpx.HTTPError:
+                status = 0  # timeout / connection error
+            return len(tags), (time.perf_counter() - start) * 1000, status
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        tasks = []
+        for i in range(int(args.rps * args.duration)):
+            delay = start + i / args.rps - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tags = rnd.sample(pool, rnd.choices(counts, weights)[0])
+            tasks.append(asyncio.create_task(one(tags)))
+        return await asyncio.gather(*tasks)
+
+
+def summarize(results: list[tuple[int, float, int]], elapsed: float) -> dict:
+    """ Сводка по результатам: задержки всех и удачных запросов, по количеству тегов """
+    ok = sorted(latency for _, latency, status in results if status == 200)
+    summary = {
+        'requests'      : len(results),
+        'ok'            : len(ok),
+        'errors'        : len(results) - len(ok),
+        'rps'           : round(len(ok) / elapsed, 2),
+        'latency_ms'    : {'p50': percentile(ok, 50), 'p95': percentile(ok, 95), 'p99': percentile(ok, 99),
+                           'max': round(ok[-1], 2) if ok else None},
+        'by_tag_count'  : {},
+    }
+    for count in sorted({count for count, _, _ in results}):
+        latencies = sorted(latency for c, latency, status in results if c == count and status == 200)
+        summary['by_tag_count'][str(count)] = {'requests': len(latencies), 'p50': percentile(latencies, 50),
+                                               'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99)}
+    return summary
+
+
+def compare(result: dict, baseline: dict, max_regression: float) -> list[str]:
+    """ Список регрессий относительно прошлого результата (пусто - все хорошо) """
+    problems = []
+    for key in ('p50', 'p95', 'p99'):
+        new, old = result['latency_ms'][key], baseline['latency_ms'][key]
+        if new is not None and old and new > old * (1 + max_regression):
+            problems.append(f'latency {key}: {old} -> {new} ms')
+    if baseline['rps'] and result['rps'] < baseline['rps'] * (1 - max_regression):
+        problems.append(f'rps: {baseline["rps"]} -> {result["rps"]}')
+    return problems
+
+
+async def run(args) -> dict:
+    """ Поднять поддельный API и сервис, подать нагрузку, собрать результат """
+    fake_url = f'http://127.0.0.1:{args.fake_port}'
+    fake = subprocess.Popen([sys.executable, '-m', 'bench.fake_sof', '--port', str(args.fake_port),
+                             '--latency', str(args.latency), '--jitter', str(args.jitter),
+                             '--error-rate', str(args.error_rate), '--tag-pool', str(args.tag_pool),
+                             '--extra-bytes', str(args.extra_bytes)], cwd=ROOT)
+    workdir = tempfile.mkdtemp(prefix='sof_stats_bench_')
+    config_path = make_config(args, fake_url, workdir)
+    service = subprocess.Popen([sys.executable, 'run_sof_stats.py'], cwd=ROOT,
+                               env={**os.environ, 'SOF_STATS_CONFIG': config_path},
+                               stdout=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{args.port}'
+    try:
+        await wait_ready(f'{fake_url}/2.3/filters/create')
+        await wait_ready(f'{base_url}/diag')
+
+        usage_before = proc_tree_usage(service.pid)
+        start = time.perf_counter()
+        results = await drive(base_url, args)
+        elapsed = time.perf_counter() - start
+        usage_after = proc_tree_usage(service.pid)
+    finally:
+        service.terminate()
+        fake.terminate()
+        service.wait(timeout=30)
+        fake.wait(timeout=30)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    result = summarize(results, elapsed)
+    if usage_before and usage_after:
+        result['service'] = {'cpu_seconds': round(usage_after['cpu_seconds'] - usage_before['cpu_seconds'], 3),
+                             'rss_mb'     : usage_after['rss_mb']}
+    result['params'] = {key: value for key, value in vars(args).items() if key not in ('baseline', 'out')}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rps', type=float, default=50, help='запросов к /search в секунду')
+    parser.add_argument('--duration', type=float, default=20, help='длительность нагрузки, с')
+    parser.add_argument('--mix', default='1:50,3:30,10:20', help='количество тегов в запросе:вес, через запятую')
+    parser.add_argument('--tag-pool', type=int, default=1000, help='из скольких тегов выбираются теги запросов')
+    parser.add_argument('--cache-ttl', type=int, default=0, help='cache_ttl сервиса, 0 - без кэша')
+    parser.add_argument('--workers', type=int, default=1, help='worker процессов сервиса')
+    parser.add_argument('--max-requests', type=int, default=1000, help='max_requests сервиса')
+    parser.add_argument('--latency', type=float, default=100, help='задержка поддельного API, мс')
+    parser.add_argument('--jitter', type=float, default=20, help='разброс задержки поддельного API, мс')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ошибок поддельного API')
+    parser.add_argument('--extra-bytes', type=int, default=600, help='ненужные байты на вопрос без фильтра')
+    parser.add_argument('--request-timeout', type=float, default=30, help='тайм-аут запроса к сервису, с')
+    parser.add_argument('--port', type=int, default=7106, help='порт сервиса')
+    parser.add_argument('--fake-port', type=int, default=7100, help='порт поддельного API')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='файл для JSON результата')
+    parser.add_argument('--baseline', help='JSON прошлого результата для сравнения')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='допустимое ухудшение, доля')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline, encoding='UTF-8') as f:
+            result['regressions'] = compare(result, json.load(f), args.max_regression)
+
+    output = json.dumps(result, indent=2, ensure_ascii=False)
+    print(output)
+    if args.out:
+        with open(args.out, 'w', encoding='UTF-8') as f:
+            f.write(output)
+    if result.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -25,6 +25,7 @@ docker rm sof_stats_0
 # http://172.17.31.170:7006/search?tag=python&smth=foo - работает
 # http://127.0.0.1:7006/search?tag=python&smth=foo - работает
 # 7006 порт - фаст апи, 80 - http запросы, 443 - https запросы
+# volume sof_stats_data - снимок кэша (data/tag_stats.snap) переживает пересоздание контейнера
 
 echo "running image..."
 
@@ -34,6 +35,7 @@ docker run -d \
 -p 443:433 \
 --dns 8.8.8.8 \
 --restart=always \
+-v sof_stats_data:/opt/sof_stats/data \
 --name sof_stats_0 \
 sof_stats:"${version}"
 
@@ -11,6 +11,7 @@ docker run -d \
 -p 443:433 \
 --dns 8.8.8.8 \
 --restart=always \
+-v sof_stats_data:/opt/sof_stats/data \
 --name sof_stats \
 $image || { echo "Docker run: not found image $image, exiting..." && exit; }
 
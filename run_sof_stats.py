@@ -40,23 +40,40 @@ http://127.0.0.1:7006/search?tag=closure&tag=python&smth=foo&tag=Русский2
 
 import asyncio
 import os
-from asyncio import BoundedSemaphore
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from typing import Any, List
+from typing import AsyncIterator, List
 
-import httpx
 import loguru
 import orjson
 import uvicorn
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import Depends, FastAPI, HTTPException, Query
 from loguru import logger
 from starlette.requests import Request
-from starlette.responses import JSONResponse
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 
-from src import constants
+from src import constants, metrics
+from src.admission import CLIENT, client_key
+from src.api_models import BatchSearch, SortBy
+from src.app_state import AppState
+from src.cache import cache_key
 from src.config import Settings, get_settings, logger_set_up
-from src.data_extractor import ExtractionError, extract_info
-from src.requester import RequestError, search_sof_questions
+from src.data_extractor import ExtractionError, TagStats, count_questions, extract_info
+from src.deadline import ClientDisconnected, Deadline, DeadlineExceeded, wait_disconnected
+from src.planner import InvalidQuery, QueryPlan, plan_query
+from src.refresher import HotTagRefresher
+from src.requester import RequestError, create_filter, search_sof_questions, warm_up
+from src.responses import stats_response
+
+# логгеры горячего пути привязываются один раз при импорте: bind() создает новый объект логгера на каждый вызов
+middleware_logger = loguru.logger.bind(object_id='Middleware')
+search_logger = loguru.logger.bind(object_id='Search endpoint')
+concat_logger = loguru.logger.bind(object_id='Concat tags')
+fetch_logger = loguru.logger.bind(object_id='Fetch tag')
+
+# пути эндпоинтов статистики -> значение метки endpoint в sof_search_duration_seconds и sof_search_requests_total
+SEARCH_ENDPOINTS = {'/search': 'search', '/search/batch': 'batch'}
 
 
 # TODO list:
@@ -69,85 +86,311 @@ from src.requester import RequestError, search_sof_questions
 #  ещё один реквест. А точнее собрать недостающее кол-во и заново сделать запрос (мб)
 # TODO?: check 'items' field for convenience handling from all places
 # TODO?: Use uvloop instead of asyncio default loop (5 times faster, but doesnt support Windows, so no testing in Win)
-# TODO?: display only statistics in last several minutes, if highload is expected (clearer logs)
 # TODO?: write specification for Swagger documentation
 # TODO?: graceful shutdown + задержка закрытия docker-контейнера
 # TODO?: add constraints to config model (use pydantic_settings)
 # TODO?: replace some logger.error funcs with logger.exception for tracebacks (mb only in TEST env_mode)
 
-# noinspection PyPep8
-class ORJSONPrettyResponse(JSONResponse):
+async def fetch_tag(state: AppState, tag: str, pages: int = 1) -> TagStats | None:
     """
-    Класс для возврата FastAPI Response JSON с человекочитаемым форматированием
+    Получить статистику по одному тегу по первым pages страницам вопросов. Страницы запрашиваются параллельно
+    (под общим ограничением семафора) и складываются по мере получения, без объединения самих вопросов.
+    Если очередная страница последняя (has_more False), то запросы следующих страниц отменяются
+    :param state: состояние приложения
+    :param tag: тег для поиска
+    :param pages: количество страниц по pagesize вопросов
+    :return: частичная статистика по тегу или None, если ответ по тегу пустой или плохой
     """
+    if pages <= 1:
+        return await fetch_page(state, tag)
 
-    def render(self, content: Any) -> bytes:
-        """
-        Вернуть ответ от orjson.dumps с человекочитаемым форматированием
-        """
-        return orjson.dumps(
-            content,
-            option=orjson.OPT_NON_STR_KEYS
-                   | orjson.OPT_SERIALIZE_NUMPY
-                   | orjson.OPT_INDENT_2,
-        )
+    tasks = {asyncio.ensure_future(fetch_page(state, tag, page)): page for page in range(1, pages + 1)}
+    pending = set(tasks)
+    last_page = pages
+    merged = TagStats()
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                page = tasks[task]
+                stats = task.result()
+                if stats:
+                    merged.update(stats)
+                if (not stats or not stats.has_more) and page < last_page:  # дальше вопросов нет
+                    last_page = page
+                    for other in pending:
+                        if tasks[other] > last_page:
+                            other.cancel()
+                    pending = {other for other in pending if tasks[other] <= last_page}
+    except BaseException:
+        for task in pending:
+            task.cancel()
+        raise
+
+    return merged if merged else None
+
+
+async def fetch_page(state: AppState, tag: str, page: int = 1) -> TagStats | None:
+    """
+    Получить статистику по одной странице вопросов тега из кэша, либо запросить вопросы у StackOverflow
+    и посчитать её. Одновременные запросы одной страницы тега объединяются кэшем в один
+    :param state: состояние приложения
+    :param tag: тег для поиска
+    :param page: номер страницы, с 1
+    :return: частичная статистика по странице или None, если ответ пустой или плохой
+    """
+    key = cache_key(tag, state.settings, page)
+    try:
+        return await state.tag_cache.get_or_fetch(key, lambda: fetch_tag_upstream(state, tag, page))
+    except RequestError as e:
+        stale = state.tag_cache.get(key, allow_stale=True)
+        if e.error_code not in (429, 503) or stale is None:
+            raise
+        # квота / бан StackOverflow или перегрузка - лучше отдать устаревшую статистику, чем ошибку
+        fetch_logger.warning('Tag {}: serving stale statistics, {}', tag, e)
+        return stale
 
 
-async def concat_tags(tags: list[str]) -> dict[str, list]:
+async def fetch_tag_upstream(state: AppState, tag: str, page: int = 1) -> TagStats | None:
     """
-    Объединить теги в один словарь с общим полем items
-    В одиночной версии: {'items':[...], 'has_more': True, 'quota_max': 300, 'quota_remaining': 294}
-    :param tags: список тегов
-    :return: словарь с полем items где лежат сколько-то (100) ответов на каждый из переданных тегов
+    Запросить страницу вопросов по одному тегу и посчитать по ним статистику. Слот семафора занимается только
+    на время исходящего HTTP запроса, поэтому ограничение max_requests действует на соединения к StackOverflow,
+    а не на входящие запросы /search
+    :param state: состояние приложения
+    :param tag: тег для поиска
+    :param page: номер страницы, с 1
+    :return: частичная статистика по странице или None, если ответ пустой или плохой
     """
-    global aclient
-    global settings
-    logger: loguru.Logger = loguru.logger.bind(object_id='Concat tags')
-    logger.info(f'Working with tags: len:{len(tags)}, data: "{tags}"...')
+    logger = fetch_logger
+    # аргументы вместо f-строк: сообщение форматируется, только если уровень TRACE включен
+    logger.trace('Tag {} (page {}) is waiting for Semaphore (around {} of {} free)...',
+                 tag, page, state.admission.free, state.max_requests)
+    # ограничивает количество одновременных соединений к StackOverflow, при перегрузке - Overloaded (503)
+    async with state.admission.slot():
+        logger.trace('Tag {} (page {}) acquired Semaphore!', tag, page)
+        res = await search_sof_questions(query_tag=tag, aclient=state.aclient, _settings=state.settings,
+                                         governor=state.governor, page=page,
+                                         offloader=state.offloader, policy=state.upstream_policy)
+
+    if not res:
+        logger.trace('Tag: {} - empty response!', tag)
+        return None  # TODO: check if its a good variant
 
-    tags_answers: dict[str, list] = {'items': list()}
-    for tag in tags:
-        res = await search_sof_questions(query_tag=tag, aclient=aclient, _settings=settings)
-        # logger.trace(f'Result: {res}')
+    try:
+        return count_questions(res, tag)  # сырой список вопросов дальше не храним
+    except ExtractionError as e:
+        logger.error(f"Smth wrong with tag {tag}: {e}")
+        return None
 
-        if not res:
-            logger.trace(f'Tag: {tag} - empty response!')
-            continue  # TODO: check if its a good variant
 
-        try:
-            tags_answers['items'].extend(res['items'])
-        except Exception as e:
-            logger.error(f"Smth wrong with tag {tag}: {e}")
-    return tags_answers
+async def fetch_tags(state: AppState, tags: list[str], pages: int = 1, deadline: Deadline = None,
+                     request: Request = None, partial: bool = False) -> tuple[dict[str, TagStats | None], dict]:
+    """
+    Получить частичные статистики по тегам, каждый уникальный тег - один раз. Запросы по тегам выполняются параллельно.
+    Когда запрос завершается (ошибка тега без partial, исчерпан бюджет, клиент отключился), запросы оставшихся тегов
+    отменяются - они освобождают слоты семафора и соединения к StackOverflow
+    :param state: состояние приложения
+    :param tags: список тегов (могут повторяться)
+    :param pages: количество страниц вопросов по каждому тегу
+    :param deadline: бюджет времени запроса. Если None, теги ждутся без ограничения
+    :param request: входящий запрос - при отключении клиента запросы тегов отменяются. Если None, не отслеживается
+    :param partial: вернуть то, что получено, если бюджет исчерпан или по тегу ошибка, вместо исключения
+    :return: (тег -> частичная статистика или None, если ответ по тегу пустой или плохой - только полученные теги,
+    тег -> статус {"status": "ok" / "empty" / "error" / "timeout", "code", "error"})
+    :raises RequestError: ошибка тега (без partial), DeadlineExceeded (без partial), ClientDisconnected
+    """
+    unique = list(dict.fromkeys(tags))
+    concat_logger.trace('Working with tags: len:{}, pages: {}, data: "{}"...', len(unique), pages, unique)
+
+    for tag in unique:
+        state.refresher.touch(tag)
+
+    tasks = {asyncio.ensure_future(fetch_tag(state, tag, pages)): tag for tag in unique}
+    pending = set(tasks)
+    watcher = asyncio.ensure_future(wait_disconnected(request)) if request is not None else None
+    stats: dict[str, TagStats | None] = dict()
+    status: dict[str, dict] = dict()
+    try:
+        while pending:
+            timeout = deadline.remaining() if deadline is not None else None
+            if timeout == 0:
+                break
+            done, _ = await asyncio.wait(pending | {watcher} if watcher else pending, timeout=timeout,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if watcher in done:
+                raise ClientDisconnected(f'Client disconnected, cancelling {len(pending)} of {len(unique)} tags')
+            for task in done:
+                pending.discard(task)
+                tag = tasks[task]
+                try:
+                    result = task.result()
+                except RequestError as e:
+                    if not partial:
+                        raise
+                    status[tag] = {'status': 'error', 'code': e.error_code, 'error': str(e)}
+                    continue
+                stats[tag] = result
+                status[tag] = {'status': 'ok' if result else 'empty'}
+    finally:
+        # при ошибке, отключении клиента или исчерпании бюджета остальные запросы уже не нужны
+        for task in pending:
+            task.cancel()
+        if watcher:
+            watcher.cancel()
+
+    if pending:
+        msg = f'Deadline of {deadline.budget} s exceeded: {len(status)} of {len(unique)} tags done'
+        if not partial:
+            raise DeadlineExceeded(msg)
+        concat_logger.warning(msg)
+        for task in pending:
+            status[tasks[task]] = {'status': 'timeout', 'code': 504}
+    return stats, status
+
+
+async def stream_tags(state: AppState, tags: list[str], pages: int = 1, sse: bool = False,
+                      deadline: Deadline = None, **view) -> AsyncIterator[bytes]:
+    """
+    Потоковый ответ /search: статистика каждого тега отдается, как только он получен, в конце - общая статистика.
+    Ошибка одного тега не отменяет остальные, а отдается строкой этого тега (статус ответа уже отправлен)
+    :param state: состояние приложения
+    :param tags: список тегов
+    :param pages: количество страниц вопросов по каждому тегу
+    :param sse: формат Server-Sent Events вместо NDJSON
+    :param deadline: бюджет времени запроса - по его исчерпании оставшиеся теги отменяются и отдаются с кодом 504
+    :param view: top, min_total, sort_by - отбор тегов в каждой статистике, см. TagStats.to_dict
+    :return: строки {"tag": ..., "stats": ...} / {"tag": ..., "error": ..., "code": ...}, последняя - {"total": ...}
+    """
+    def line(event: str, data: dict) -> bytes:
+        if sse:
+            return b'event: ' + event.encode() + b'\ndata: ' + orjson.dumps(data) + b'\n\n'
+        return orjson.dumps(data) + b'\n'
+
+    unique = list(dict.fromkeys(tags))
+    for tag in unique:
+        state.refresher.touch(tag)
+
+    tasks = {asyncio.ensure_future(fetch_tag(state, tag, pages)): tag for tag in unique}
+    pending = set(tasks)
+    stats: dict[str, TagStats] = dict()
+    try:
+        while pending:
+            timeout = deadline.remaining() if deadline is not None else None
+            if timeout == 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tag = tasks[task]
+                try:
+                    result = task.result()
+                except RequestError as e:
+                    yield line('tag', {'tag': tag, 'error': str(e), 'code': e.error_code})
+                    continue
+                if result:
+                    stats[tag] = result
+                yield line('tag', {'tag': tag, 'stats': result.to_dict(**view) if result else None})
+    finally:  # клиент отключился или бюджет исчерпан - запросы оставшихся тегов уже не нужны
+        for task in pending:
+            task.cancel()
+
+    for task in pending:
+        yield line('tag', {'tag': tasks[task], 'error': f'Deadline of {deadline.budget} s exceeded', 'code': 504})
+
+    partials = [stats[tag] for tag in tags if tag in stats]
+    with metrics.EXTRACT_LATENCY.time():
+        total = await extract_info(partials, tags, engine=state.aggregation_engine, offloader=state.offloader,
+                                       **view) if partials else None
+    yield line('total', {'total': total})
+
+
+def check_search(state: AppState, groups: list[list[str]], pages: int, logger: 'loguru.Logger') -> QueryPlan:
+    """
+    Проверки параметров поиска, общие для /search и /search/batch, и план запроса (канонические теги без повторов)
+    :param state: состояние приложения
+    :param groups: группы тегов (у /search - одна)
+    :param pages: количество страниц вопросов по каждому тегу
+    :param logger: логгер эндпоинта
+    :return: QueryPlan - дальше запрашиваются только его теги
+    :raises HTTPException: 503 если сервис останавливается, 422 если параметры неверные или сверх лимитов
+    """
+    if not state.is_running:
+        s = f'Error: service is shutting down!'
+        logger.error(s)
+        raise HTTPException(status_code=503, detail=s)  # service unavailable
+
+    if not groups or not all(groups):
+        s = f'Error: empty tag list!'
+        logger.error(s)
+        raise HTTPException(status_code=422, detail=s)  # Unprocessable entity
+
+    try:
+        plan = plan_query(groups, pages, state.tag_cache, state.settings)
+    except InvalidQuery as e:
+        logger.error(e.message)
+        raise HTTPException(status_code=e.error_code, detail=e.message)  # Unprocessable entity
+    logger.trace('{}', plan)
+    return plan
 
 
 # region FastAPI
-async def app_startup():
-    """Signal from fastapi"""
-    global loop
+async def app_startup(state: AppState):
+    """ Startup of FastAPI worker: prepare state that needs running event loop """
     log: loguru.Logger = loguru.logger.bind(object_id='Startup')
     log.info("app_startup")
-    loop = asyncio.new_event_loop()  # start new async loop for asyncio
-    loop.set_debug(True if settings.env_mode == 'TEST' else False)  # for more precise errors and tracebacks
+    # for more precise errors and tracebacks
+    asyncio.get_running_loop().set_debug(True if state.settings.env_mode == 'TEST' else False)
 
+    if not state.settings.api_filter:  # запрашивать у StackOverflow только нужные поля вопросов
+        state.settings.api_filter = await create_filter(aclient=state.aclient, _settings=state.settings)
+    await warm_up(state.aclient, state.settings)  # первые /search не ждут установки соединений
 
-async def app_shutdown():
-    """ Shutdown signal from FastAPI """
-    logger.info("app_shutdown")
-    global is_running
-    is_running = False
-    global loop
-    await asyncio.sleep(settings.stop_delay)
-    await aclient.aclose()  # close httpx.AsyncClient
-    loop.close()  # close asyncio AbstractEventLoop
+    if state.snapshot is not None:  # статистика с прошлого запуска, читается лениво
+        state.snapshot.open()
+        state.snapshot_writer.start()
+    state.refresher.start()  # фоновое обновление популярных тегов
+    state.request_log.start()  # периодическая сводка по запросам в логах
+    state.loop_lag.start()  # замер задержки event loop
 
 
-def normal_app() -> FastAPI:
+async def app_shutdown(state: AppState):
+    """ Shutdown signal from FastAPI """
+    logger.info("app_shutdown")
+    state.is_running = False
+    await state.refresher.stop()
+    await state.request_log.stop()
+    await state.loop_lag.stop()
+    if state.snapshot_writer is not None:
+        await state.snapshot_writer.stop()  # последний снимок кэша перед перезапуском
+    await asyncio.sleep(state.settings.stop_delay)
+    await state.aclient.aclose()  # close httpx.AsyncClient
+    state.offloader.shutdown()
+    if state.store is not None:
+        state.store.close()
+
+
+@asynccontextmanager
+async def lifespan(fastapi_app: FastAPI):
+    """ Lifespan of FastAPI worker: state is created here (not on import), so every worker process has its own """
+    state = AppState(fastapi_app.state.settings)
+    state.refresher = HotTagRefresher(cache=state.tag_cache,
+                                      fetch=lambda tag: fetch_tag_upstream(state, tag),
+                                      _settings=state.settings)
+    fastapi_app.state.sof = state
+
+    await app_startup(state)
+    yield
+    await app_shutdown(state)
+
+
+def get_state(request: Request) -> AppState:
+    """ FastAPI dependency - state of the current worker """
+    return request.app.state.sof
+
+
+def normal_app(settings: Settings) -> FastAPI:
     """ FastAPI settings and endpoints. Mb move to class? """
-    fastapi_app = FastAPI(version=settings.version, title=settings.service_name)
-
-    fastapi_app.add_event_handler(event_type='startup', func=app_startup)
-    fastapi_app.add_event_handler(event_type='shutdown', func=app_shutdown)
+    fastapi_app = FastAPI(version=settings.version, title=settings.service_name, lifespan=lifespan)
+    fastapi_app.state.settings = settings
 
     @fastapi_app.middleware('http')
     async def mdlwr(request: Request, call_next):
@@ -156,14 +399,37 @@ def normal_app() -> FastAPI:
         :param request: Запрос входящий (или мб исходящий)
         :param call_next: Следующий ендпоинт, куда в оригинале шел запрос
         """
-        logger: loguru.Logger = loguru.logger.bind(object_id='Middleware')
-        req_start_time = datetime.now()
-        # вывести адрес ручки без адреса и порта сервиса
-        logger.info(f"Incoming request: /{''.join(str(request.url).split('/')[3:])}")
+        request_log = request.app.state.sof.request_log
+        # подробные логи только у части запросов (log_sample_rate), по остальным - только периодическая сводка
+        request.state.log_sampled = sampled = request_log.sampled()
+        # клиент для справедливой очереди к слотам stackoverflow, эндпоинт наследует контекст
+        CLIENT.set(client_key(request, settings.client_header))
+        req_start_time = time.perf_counter()
+        if sampled:
+            middleware_logger.info('Incoming request: {} {}', request.method, request.url.path)
         response = await call_next(request)
-        process_time = (datetime.now() - req_start_time)
-        response.headers["X-Process-Time"] = str(process_time)
-        logger.debug(f'Request time took {process_time} seconds')
+        # заголовок уходит до тела ответа - в нем время до начала ответа
+        response.headers["X-Process-Time"] = str(timedelta(seconds=time.perf_counter() - req_start_time))
+
+        async def timed_body(body: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+            """
+            Время запроса в метриках и логах - до отправки всего тела: потоковый ответ (NDJSON / SSE) идет еще долго
+            после заголовков
+            """
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:  # и если клиент отключился посреди ответа
+                process_time = time.perf_counter() - req_start_time
+                request_log.record(response.status_code, process_time)
+                endpoint = SEARCH_ENDPOINTS.get(request.url.path)
+                if endpoint:
+                    metrics.SEARCH_LATENCY.observe(process_time, endpoint)
+                    metrics.SEARCH_REQUESTS.inc(1, endpoint, str(response.status_code))
+                if sampled:
+                    middleware_logger.debug('Request time took {:.6f} seconds', process_time)
+
+        response.body_iterator = timed_body(response.body_iterator)
         return response
 
     @fastapi_app.get("/config")
@@ -177,83 +443,110 @@ def normal_app() -> FastAPI:
             raise HTTPException(status_code=401, detail=msg)  # 401 Unauthorized
 
     @fastapi_app.post('/search')
-    async def search(tag: List[str] = Query()) -> ORJSONPrettyResponse:
+    async def search(request: Request, tag: List[str] = Query(), pages: int = Query(default=1, ge=1),
+                     stream: bool = Query(default=False), top: int = Query(default=None, ge=1),
+                     min_total: int = Query(default=0, ge=0), sort_by: SortBy = Query(default=None),
+                     timeout: float = Query(default=None, gt=0), partial: bool = Query(default=False),
+                     state: AppState = Depends(get_state)) -> Response:
         """
         Standard stackoverflow for received tags
         :param tag:
+        :param pages: сколько страниц по pagesize вопросов учитывать по каждому тегу (не больше max_pages)
+        :param stream: отдавать статистику каждого тега по мере получения (NDJSON, либо SSE при Accept:
+        text/event-stream). Так же включается заголовком Accept: application/x-ndjson или text/event-stream
+        :param top: вернуть только top тегов с наибольшим sort_by
+        :param min_total: вернуть только теги, встретившиеся не меньше min_total раз
+        :param sort_by: total, answered или ratio (answered / total) - порядок тегов в ответе
+        :param timeout: бюджет времени запроса в секундах (или заголовок X-Request-Timeout), не больше timeout
+        из настроек. По его исчерпании запросы оставшихся тегов отменяются
+        :param partial: по исчерпании бюджета / ошибке тега вернуть статистику по полученным тегам:
+        {"stats": ..., "tags": {tag: {"status": ...}}, "partial": bool} вместо ошибки 504 / ошибки тега
         :return:
         """
-        logger: loguru.Logger = loguru.logger.bind(object_id='Search endpoint')
-
-        # region Checks
+        logger = search_logger
+        plan = check_search(state, [tag], pages, logger)
+        tag = plan.groups[0]  # канонические теги без повторов
+        view = {'top': top, 'min_total': min_total, 'sort_by': sort_by}
+        deadline = Deadline.from_request(request, timeout, settings.timeout)
+
+        accept = request.headers.get('accept', '')
+        sse = 'text/event-stream' in accept
+        if stream or sse or 'application/x-ndjson' in accept:
+            return StreamingResponse(stream_tags(state, plan.tags, pages, sse=sse, deadline=deadline, **view),
+                                     media_type='text/event-stream' if sse else 'application/x-ndjson')
+
+        try:  # uniform func, semaphore is acquired per tag inside
+            stats, status = await fetch_tags(state, plan.tags, pages, deadline=deadline, request=request,
+                                             partial=partial)
+        except RequestError as e:  # base error for requester.py
+            raise HTTPException(status_code=e.error_code, detail=str(e), headers=e.headers)
+        tag_answers = [stats[_tag] for _tag in tag if stats.get(_tag)]  # пустые и плохие ответы пропускаются
 
-        if not is_running:
-            s = f'Error: service is shutting down!'
+        if not tag_answers and not partial:
+            s = f'Error: something went wrong with request / response!'
             logger.error(s)
-            raise HTTPException(status_code=503, detail=s)  # service unavailable
+            raise HTTPException(status_code=500, detail=s)
 
-        if not tag or len(tag) == 0:
-            s = f'Error: empty tag list!'
-            logger.error(s)
-            raise HTTPException(status_code=422, detail=s)  # Unprocessable entity
+        try:
+            with metrics.EXTRACT_LATENCY.time():
+                tag_stats = await extract_info(tag_answers, tag, engine=state.aggregation_engine,
+                                               offloader=state.offloader, **view) if tag_answers else None
+        except ExtractionError as e:  # TODO!: TEST
+            raise HTTPException(status_code=500, detail=str(e))
 
-        for _tag in tag:
-            if not _tag.isalnum():
-                s = f'Error: tag "{_tag}" is not alphanumeric!'
-                logger.error(s)
-                raise HTTPException(status_code=422, detail=s)  # Unprocessable entity
-        # endregion
-
-        # if len(tag) < 2:  # для единичного тега
-        #     tag_answers = await search_sof_questions(query_tag=tag[0], aclient=aclient, _settings=settings)
-        # else:
-        #     tag_answers = await concat_tags(tags=tag)
-        logger.trace(f'Tags {tag} are waiting for Semaphore '
-                     f'(around {semaphore._value} of {settings.max_requests} free)...')
-        await semaphore.acquire()  # manually awaiting - this restricts simultaneous requests count
-        logger.trace(f'Tags {tag} acquired Semaphore!')
-
-        if not is_running:  # check again if service is stopping
-            s = f'Error: service is shutting down!'
-            logger.error(s)
-            raise HTTPException(status_code=503, detail=s)  # service unavailable
+        if request.state.log_sampled:
+            logger.success('Request with tags {} done!', tag)
 
-        if len(tag) < 2:  # для единичного тега:
-            tag = [tag]  # create list
+        if partial:  # статус каждого тега: получен, пустой, ошибка или не успел
+            tag_stats = {'stats': tag_stats, 'tags': status,
+                         'partial': any(item['status'] in ('error', 'timeout') for item in status.values())}
+        # orjson вместо json.dumps FastAPI, формат и сжатие - по заголовкам запроса
+        return stats_response(request, tag_stats, settings.compress_min_size)
 
-        try:
-            tag_answers = await concat_tags(tags=tag)  # uniform func
-        except RequestError as e:  # base error for requester.py
-            raise HTTPException(status_code=e.error_code, detail=str(e))
-        finally:
-            try:
-                semaphore.release()
-                logger.trace(f'Tags {tag} released Semaphore!')
-            except ValueError:
-                # semaphore was already released
-                logger.trace(f'Semaphore was already released!')
+    @fastapi_app.post('/search/batch')
+    async def search_batch(request: Request, batch: BatchSearch,
+                           state: AppState = Depends(get_state)) -> Response:
+        """
+        Статистика по нескольким группам тегов за один запрос. Каждый уникальный тег запрашивается один раз,
+        статистика групп складывается из общих частичных статистик
+        :param batch: группы тегов и pages
+        :return: {"results": [...]} - статистика по каждой группе в том же порядке, null если по группе ничего нет.
+        С partial - еще "tags": статус каждого тега, как у /search
+        """
+        logger = search_logger
 
-        if not tag_answers:
-            s = f'Error: something went wrong with request / response!'
+        if len(batch.groups) > settings.max_batch_groups:
+            s = f'Error: {len(batch.groups)} groups is more than {settings.max_batch_groups}!'
             logger.error(s)
-            raise HTTPException(status_code=500, detail=s)
+            raise HTTPException(status_code=422, detail=s)  # Unprocessable entity
+        plan = check_search(state, batch.groups, batch.pages, logger)
 
-        # logger.trace(f'tag_answers: {tag_answers}')  # словарь с полем items
+        deadline = Deadline.from_request(request, batch.timeout, settings.timeout)
         try:
-            tag_stats = await extract_info(tag_answers, tag)
-        except ExtractionError as e:  # TODO!: TEST
-            raise HTTPException(status_code=500, detail=e)
+            stats, status = await fetch_tags(state, plan.tags, batch.pages, deadline=deadline, request=request,
+                                             partial=batch.partial)
+        except RequestError as e:  # base error for requester.py
+            raise HTTPException(status_code=e.error_code, detail=str(e), headers=e.headers)
 
-        logger.success(f'Request with tags {tag} done!')
+        results = []
+        with metrics.EXTRACT_LATENCY.time():
+            for group in plan.groups:
+                partials = [stats[tag] for tag in group if stats.get(tag)]
+                results.append(await extract_info(partials, group, top=batch.top, min_total=batch.min_total,
+                                                  sort_by=batch.sort_by, engine=state.aggregation_engine,
+                                                  offloader=state.offloader)
+                               if partials else None)
 
-        # using custom Response to avoid calling json.dumps in FastAPI JSONResponse
-        return ORJSONPrettyResponse(tag_stats,
-                                    media_type='application/json')
+        if request.state.log_sampled:
+            logger.success('Batch of {} groups ({} unique tags) done!', len(batch.groups), len(stats))
+
+        content = {'results': results, 'tags': status} if batch.partial else {'results': results}
+        return stats_response(request, content, settings.compress_min_size)
 
     @fastapi_app.get("/diag")
-    async def diag() -> dict:  #
+    async def diag(state: AppState = Depends(get_state)) -> dict:  #
         """Standard /diag route"""
-        delta = datetime.now() - start_time
+        delta = datetime.now() - state.start_time
         if delta.days < 0:  # for midnight
             delta = timedelta(
                 days=0,
@@ -272,10 +565,34 @@ def normal_app() -> FastAPI:
             "app"       : f'{settings.service_name}',
             "version"   : f'{settings.version}',
             "uptime"    : delta,
-            "is_running": is_running
+            "is_running": state.is_running,
+            "worker"    : os.getpid(),
+            "upstream"  : state.governor.status(),
+            "admission" : state.admission.status(),
+            "clients"   : state.admission.clients(),
+            "resilience": state.upstream_policy.status()
         }
         return response
 
+    @fastapi_app.get("/metrics")
+    async def prometheus_metrics(state: AppState = Depends(get_state)) -> PlainTextResponse:
+        """ Metrics of this worker in Prometheus text format """
+        metrics.CACHE_REQUESTS.set(state.tag_cache.hits, 'hit')
+        metrics.CACHE_REQUESTS.set(state.tag_cache.misses, 'miss')
+        metrics.CACHE_SIZE.set(len(state.tag_cache))
+        free = state.admission.free
+        metrics.UPSTREAM_SLOTS.set(state.max_requests - free, 'busy')
+        metrics.UPSTREAM_SLOTS.set(free, 'free')
+        # внутренности httpx - если они поменяются, метрика просто пропадет
+        connections = getattr(getattr(state.aclient._transport, '_pool', None), 'connections', None)
+        if connections is not None:
+            idle = sum(1 for connection in connections if connection.is_idle())
+            metrics.POOL_CONNECTIONS.set(len(connections) - idle, 'active')
+            metrics.POOL_CONNECTIONS.set(idle, 'idle')
+        if state.governor.quota_remaining is not None:
+            metrics.QUOTA_REMAINING.set(state.governor.quota_remaining)
+        return PlainTextResponse(metrics.render_metrics(), media_type='text/plain; version=0.0.4')
+
     @fastapi_app.exception_handler(404)
     async def custom_404_handler(request: Request, _):
         """Собственный обработчик 404 ошибки"""
@@ -293,56 +610,44 @@ def normal_app() -> FastAPI:
 
 # endregion
 
-def main():
-    """ Initialize globals, such as settings and FastAPI app, do some preparations like logger bind and run uvicorn"""
-
-    global settings  # use a global type of link
+def create_app() -> FastAPI:
+    """
+    App factory: parse settings, set up logger and create FastAPI app. Is called by uvicorn in every worker process
+    (uvicorn run_sof_stats:create_app --factory), so nothing here is shared between workers
+    """
     war_config = constants.WAR_CONFIG_PATH
     # win_config = constants.WAR_CONFIG_PATH
     config = war_config
 
     settings = get_settings(_config_path=config)  # if SOF_STATS_CONFIG is in env variables, it will be used
 
-    logger_set_up(settings)
+    # файл логов на каждый worker, иначе процессы мешают друг другу при ротации
+    logs_path = f'logs/sof_stats.{os.getpid()}.log' if settings.workers > 1 else 'logs/sof_stats.log'
+    logger_set_up(settings, logs_path)
     # logger.bind(object_id=os.path.basename(__file__))
-    _logger: loguru.Logger = loguru.logger.bind(object_id='Run main')
+    _logger: loguru.Logger = loguru.logger.bind(object_id='Create app')
     _logger.info("SETTINGS PARSED", f"data: {settings}")
     # logger.log("HL", "Test highlighting!")
 
-    global app  # use global variable
-    app = normal_app()
-
-    global is_running  # shows if service is alive
-    is_running = True  # ATM actually IDK if its needed
-
-    global start_time
-    start_time = datetime.now()
+    return normal_app(settings)
 
-    global limits
-    limits = httpx.Limits(max_connections=settings.max_requests,
-                          max_keepalive_connections=settings.max_alive_requests,
-                          keepalive_expiry=settings.keep_alive)
-    global aclient
-    proxy = os.getenv('HTTP_PROXY')  # get proxy from env, if it here
-    if proxy:
-        logger.info(f'Got HTTP_PROXY env variable. Using proxy {proxy}')
-        aclient = httpx.AsyncClient(limits=limits, proxy=proxy, verify=False)
-    else:
-        logger.info(f'Running without proxy')
-        aclient = httpx.AsyncClient(limits=limits)
 
-    global semaphore
-    semaphore = BoundedSemaphore(value=settings.max_requests)
+def main():
+    """ Parse settings and run uvicorn with settings.workers worker processes, each creates its own app """
+    settings = get_settings(_config_path=constants.WAR_CONFIG_PATH)
+    logger_set_up(settings)
+    _logger: loguru.Logger = loguru.logger.bind(object_id='Run main')
 
     try:
         # disabled duplicate logs (uvicorn logs)
         # uvicorn_log_config = uvicorn.config.LOGGING_CONFIG
         # del uvicorn_log_config["loggers"]
-        _logger.trace(f'Main passed, launching uvicorn...')
+        _logger.trace(f'Main passed, launching uvicorn with {settings.workers} workers...')
 
-        uvicorn.run(app=f'__main__:app',
+        uvicorn.run(app='run_sof_stats:create_app', factory=True,
                     host=settings.self_api_host,
                     port=settings.self_api_port,
+                    workers=settings.workers,
                     log_level="debug", access_log=False)
 
     except KeyboardInterrupt:
@@ -352,18 +657,4 @@ def main():
 
 
 if __name__ == '__main__':
-    # global variables declaration (just to list them and also keep track of them)
-    start_time: datetime = None  # just time when service started
-    settings: Settings = None  # app settings
-    app: FastAPI = None
-
-    # could be redundant, since it looks like FastAPI stops handling incoming requests immediately
-    is_running: bool = None
-
-    loop: asyncio.AbstractEventLoop = None
-    limits: httpx.Limits = None  # limits for httpx, uses config stop_delay setting
-    aclient: httpx.AsyncClient = None  # one async client for all requests for optimizations
-    semaphore: asyncio.BoundedSemaphore = None  # semaphore for manual limiting number of concurrent requests
-    # while True:
-    #     time.sleep(15)
     main()
@@ -0,0 +1,245 @@
+"""
+Контроль допуска к слотам соединений StackOverflow: очередь ожидающих ограничена по длине и по времени ожидания.
+Без него при всплеске запросы копятся в очереди семафора без ограничений - растут память и задержка, пока клиенты
+сами не отвалятся по тайм-ауту. Лучше сразу ответить 503 с Retry-After, чем делать работу для ушедших клиентов.
+
+Освободившийся слот достается не первому в очереди, а по справедливой очереди с весами (start-time fair queuing):
+у каждого клиента (IP или заголовок client_header) свой виртуальный счетчик, и клиент, который шлет большие запросы
+в цикле, не забирает все слоты - остальные ждут не дольше своей доли. Плюс необязательный лимит слотов на клиента
+"""
+import asyncio
+import contextvars
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+import loguru
+from starlette.requests import Request
+
+from src import metrics
+from src.requester import RequestError
+from src.settings_model import Settings
+
+# клиент текущего запроса: выставляется middleware, задачи запросов тегов наследуют его при создании.
+# Пусто - фоновая работа сервиса (обновление популярных тегов)
+CLIENT = contextvars.ContextVar('sof_client', default='')
+BACKGROUND = 'background'
+
+
+def client_key(request: Request, header: str = '') -> str:
+    """
+    Ключ клиента для справедливой очереди: значение заголовка header (API ключ / id клиента, выставляется
+    доверенным шлюзом), иначе IP
+    :param request: входящий запрос
+    :param header: имя заголовка, пусто - только IP
+    """
+    if header:
+        value = request.headers.get(header)
+        if value:
+            return value
+    return request.client.host if request.client else 'unknown'
+
+
+class Overloaded(RequestError):
+    """ Очередь к StackOverflow переполнена или ожидание в ней слишком долгое - 503 Service Unavailable """
+
+    def __init__(self, message, retry_after: int = 1):
+        super().__init__(message, error_code=503)
+        self.headers = {'Retry-After': str(retry_after)}
+
+
+class _Client:
+    """ Состояние одного клиента в очереди. Удаляется, когда у клиента нет ни слотов, ни ожидающих запросов """
+    __slots__ = ('key', 'weight', 'active', 'queue', 'finish')
+
+    def __init__(self, key: str, weight: float):
+        self.key = key
+        self.weight = weight
+        self.active = 0  # занятых слотов
+        self.queue: deque[tuple[float, int, asyncio.Future]] = deque()  # (start, seq, future) ожидающих
+        self.finish = 0.0  # виртуальное время окончания последнего запроса клиента
+
+
+class AdmissionControl:
+    """ Слоты соединений к StackOverflow с ограниченной очередью ожидания и справедливой выдачей по клиентам """
+
+    def __init__(self, slots: int, max_queue: int = 1000, queue_timeout: float = 5, retry_after: int = 1,
+                 client_max_slots: int = 0, weights: dict[str, float] = None):
+        """
+        :param slots: количество одновременных запросов к StackOverflow
+        :param max_queue: сколько запросов может ждать свободного слота, остальные сразу получают 503
+        :param queue_timeout: сколько секунд запрос может ждать слота, 0 - без ограничения
+        :param retry_after: значение заголовка Retry-After в ответе 503, секунды
+        :param client_max_slots: сколько слотов может занять один клиент одновременно, 0 - без ограничения
+        :param weights: ключ клиента -> вес (доля слотов при конкуренции), по умолчанию 1
+        """
+        self.slots = slots
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.client_max_slots = client_max_slots
+        self.weights = {key: weight for key, weight in (weights or dict()).items() if weight > 0}
+        self._free = slots
+        self._clients: dict[str, _Client] = dict()
+        self._vtime = 0.0  # виртуальное время: start последнего выданного слота
+        self._seq = itertools.count()  # при равном start - в порядке прихода
+        self.waiting = 0  # сколько запросов сейчас в очереди
+        self.rejected = 0  # сколько запросов отклонено с запуска
+        self.logger = loguru.logger.bind(object_id='Admission')
+
+    @classmethod
+    def from_settings(cls, _settings: Settings, slots: int, workers: int = 1) -> 'AdmissionControl':
+        """
+        :param _settings: Pydantic модель с настройками приложения
+        :param slots: слотов в этом worker'е (max_requests уже поделен между worker'ами)
+        :param workers: количество worker процессов - очередь из конфига тоже делится между ними
+        """
+        return cls(slots, max_queue=max(_settings.max_queue // max(workers, 1), 0),
+                   queue_timeout=_settings.queue_timeout, retry_after=_settings.retry_after,
+                   client_max_slots=_settings.client_max_slots, weights=_settings.client_weights)
+
+    @property
+    def free(self) -> int:
+        """ Свободных слотов """
+        return self._free
+
+    def status(self) -> dict:
+        """ Состояние для /diag """
+        return {'slots': self.slots, 'busy': self.slots - self.free, 'waiting': self.waiting,
+                'max_queue': self.max_queue, 'rejected': self.rejected}
+
+    def clients(self, top: int = 10) -> dict:
+        """ top клиентов с наибольшим количеством занятых и ожидающих слотов - для /diag """
+        busiest = sorted(self._clients.values(), key=lambda client: client.active + len(client.queue), reverse=True)
+        return {client.key: {'active': client.active, 'waiting': len(client.queue), 'weight': client.weight}
+                for client in busiest[:top]}
+
+    def _reject(self, reason: str, message: str):
+        self.rejected += 1
+        metrics.ADMISSION_REJECTED.inc(1, reason)
+        self.logger.warning(message)
+        raise Overloaded(message, retry_after=self.retry_after)
+
+    def _client(self, key: str) -> _Client:
+        client = self._clients.get(key)
+        if client is None:
+            client = self._clients[key] = _Client(key, self.weights.get(key, 1.0))
+            metrics.ADMISSION_CLIENTS.set(len(self._clients))
+        return client
+
+    def _forget(self, client: _Client):
+        """ Удалить клиента без слотов и ожидающих запросов """
+        if not client.active and not client.queue:
+            self._clients.pop(client.key, None)
+            metrics.ADMISSION_CLIENTS.set(len(self._clients))
+
+    def _capped(self, client: _Client) -> bool:
+        return 0 < self.client_max_slots <= client.active
+
+    def _start(self, client: _Client) -> float:
+        """ Виртуальное время начала нового запроса клиента: запрос клиента с большим весом "короче" """
+        start = max(self._vtime, client.finish)
+        client.finish = start + 1 / client.weight
+        return start
+
+    def _dispatch(self):
+        """ Раздать свободные слоты ожидающим: клиенту с наименьшим start первого в очереди запроса, не выше лимита """
+        while self._free > 0:
+            best = None
+            for client in self._clients.values():
+                if client.queue and not self._capped(client) and (best is None or client.queue[0] < best.queue[0]):
+                    best = client
+            if best is None:
+                return
+            start, _, future = best.queue.popleft()
+            if future.done():  # ожидание уже отменено, но еще не убрано из очереди
+                continue
+            self._vtime = start
+            best.active += 1
+            self._free -= 1
+            future.set_result(None)
+
+    def _release(self, client: _Client):
+        client.active -= 1
+        self._free += 1
+        self._dispatch()
+        self._forget(client)
+
+    @asynccontextmanager
+    async def slot(self, key: str = None):
+        """
+        Занять слот на время блока with
+        :param key: клиент, по умолчанию клиент текущего запроса (CLIENT)
+        :raises Overloaded: 503, если очередь полна или слот не освободился за queue_timeout
+        """
+        wait_start = time.perf_counter()
+        client = self._client(key or CLIENT.get() or BACKGROUND)
+        # после каждой раздачи слотов либо свободных нет, либо все ожидающие уперлись в свой лимит -
+        # поэтому свободный слот можно брать сразу, не обгоняя никого в очереди
+        if self._free > 0 and not self._capped(client):
+            self._vtime = self._start(client)
+            client.active += 1
+            self._free -= 1
+        else:  # встаем в очередь, если в ней есть место
+            if self.waiting >= self.max_queue:
+                self._forget(client)
+                self._reject('queue_full', f'Upstream queue is full: {self.waiting} waiting for '
+                                           f'{self.slots} slots')
+            if self._capped(client):
+                metrics.ADMISSION_CAPPED.inc()
+            future = asyncio.get_running_loop().create_future()
+            waiter = (self._start(client), next(self._seq), future)
+            client.queue.append(waiter)
+            self.waiting += 1
+            metrics.ADMISSION_QUEUE.set(self.waiting)
+            try:
+                await asyncio.wait_for(future, self.queue_timeout or None)
+            except asyncio.TimeoutError:
+                self._drop(client, waiter)
+                self._reject('timeout', f'No free upstream slot in {self.queue_timeout} seconds '
+                                        f'({self.waiting} waiting)')
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():  # слот выдан одновременно с отменой - возвращаем
+                    self._release(client)
+                else:
+                    self._drop(client, waiter)
+                raise
+            finally:
+                self.waiting -= 1
+                metrics.ADMISSION_QUEUE.set(self.waiting)
+        metrics.SEMAPHORE_WAIT.observe(time.perf_counter() - wait_start)
+
+        try:
+            yield
+        finally:
+            self._release(client)
+
+    def try_acquire(self, key: str = None) -> str | None:
+        """
+        Занять слот без ожидания - для необязательной работы (hedged запрос): если свободного слота нет или клиент
+        уперся в свой лимит, работа просто не делается и никого в очереди не обгоняет
+        :param key: клиент, по умолчанию клиент текущего запроса (CLIENT)
+        :return: ключ клиента для release или None, если слот не занят
+        """
+        key = key or CLIENT.get() or BACKGROUND
+        client = self._client(key)
+        if self._free <= 0 or self._capped(client):
+            self._forget(client)
+            return None
+        self._vtime = self._start(client)
+        client.active += 1
+        self._free -= 1
+        return key
+
+    def release(self, key: str):
+        """ Освободить слот, занятый try_acquire """
+        self._release(self._clients[key])
+
+    def _drop(self, client: _Client, waiter: tuple):
+        """ Убрать отмененное ожидание из очереди клиента """
+        try:
+            client.queue.remove(waiter)
+        except ValueError:  # уже убрано раздачей слотов
+            pass
+        self._forget(client)
@@ -0,0 +1,21 @@
+"""
+Pydantic модели тел запросов к API сервиса
+"""
+from typing import List, Literal, Optional
+
+from pydantic import BaseModel, Field
+
+
+SortBy = Literal['total', 'answered', 'ratio']  # ключи сортировки статистики, см. data_extractor.SORT_KEYS
+
+
+class BatchSearch(BaseModel):
+    """ Тело запроса /search/batch: несколько групп тегов, статистика считается по каждой группе отдельно """
+
+    groups: List[List[str]]  # группы тегов, как параметры tag у /search
+    pages: int = Field(default=1, ge=1)  # сколько страниц вопросов учитывать по каждому тегу (не больше max_pages)
+    top: Optional[int] = Field(default=None, ge=1)  # только top тегов с наибольшим sort_by в статистике каждой группы
+    min_total: int = Field(default=0, ge=0)  # только теги, встретившиеся не меньше min_total раз
+    sort_by: Optional[SortBy] = None  # total, answered или ratio (answered / total)
+    timeout: Optional[float] = Field(default=None, gt=0)  # бюджет времени в секундах (не больше Settings.timeout)
+    partial: bool = False  # по исчерпании бюджета / ошибке тега вернуть то, что получено, и статус каждого тега
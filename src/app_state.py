@@ -0,0 +1,73 @@
+"""
+Состояние приложения (httpx клиент, семафор, кэш, регулятор и т.д.). Создается в lifespan FastAPI отдельно в каждом
+worker процессе, поэтому общие лимиты из конфига делятся на количество worker'ов
+"""
+import os
+from datetime import datetime
+
+import httpx
+import loguru
+
+from src.admission import AdmissionControl
+from src.cache import TagCache
+from src.governor import QuotaGovernor
+from src.offload import LoopLagMonitor, Offloader
+from src.refresher import HotTagRefresher
+from src.requester import create_client
+from src.resilience import UpstreamPolicy
+from src.request_log import RequestLog
+from src.settings_model import Settings
+from src.snapshot import SnapshotWriter, TagSnapshot
+from src.store import create_store
+from src.vector_engine import resolve_engine
+
+
+class AppState:
+    """ Все, что раньше было глобальными переменными run_sof_stats.py """
+
+    def __init__(self, _settings: Settings):
+        """
+        :param _settings: Pydantic модель с настройками приложения
+        """
+        logger: loguru.Logger = loguru.logger.bind(object_id='App state')
+        self.settings = _settings
+        self.start_time = datetime.now()  # just time when service (worker) started
+        # could be redundant, since it looks like FastAPI stops handling incoming requests immediately
+        self.is_running = True
+
+        # лимит соединений к StackOverflow общий на весь сервис - делим между worker процессами
+        workers = max(_settings.workers, 1)
+        self.max_requests = max(_settings.max_requests // workers, 1)
+        self.limits = httpx.Limits(max_connections=self.max_requests,
+                                   max_keepalive_connections=max(_settings.max_alive_requests // workers, 1),
+                                   keepalive_expiry=_settings.keep_alive)
+
+        proxy = os.getenv('HTTP_PROXY')  # get proxy from env, if it here
+        if proxy:
+            logger.info(f'Got HTTP_PROXY env variable. Using proxy {proxy}')
+        else:
+            logger.info(f'Running without proxy')
+        # one async client for all requests for optimizations
+        self.aclient = create_client(_settings, self.limits, proxy=proxy)
+
+        # semaphore for manual limiting number of concurrent requests to StackOverflow (acquired per tag)
+        # с ограниченной очередью: при перегрузке - сразу 503, а не бесконечное ожидание
+        self.admission = AdmissionControl.from_settings(_settings, self.max_requests, workers)
+        # хранилище, общее для worker'ов: кэш статистики и квота / бан StackOverflow, None - без него (memory)
+        self.store = create_store(_settings)
+        # снимок кэша на диске: после перезапуска статистика не запрашивается у StackOverflow заново
+        self.snapshot = TagSnapshot.from_settings(_settings)
+        self.tag_cache = TagCache(ttl=_settings.cache_ttl, max_size=_settings.cache_max_size, store=self.store,
+                                  snapshot=self.snapshot)
+        self.snapshot_writer = SnapshotWriter(self.snapshot, self.tag_cache, _settings.snapshot_interval) \
+            if self.snapshot is not None else None
+        self.governor = QuotaGovernor.from_settings(_settings, workers, store=self.store)
+        # повторы, hedging (в своем слоте admission), circuit breaker
+        self.upstream_policy = UpstreamPolicy.from_settings(_settings, self.admission)
+
+        self.aggregation_engine = resolve_engine(_settings.aggregation_engine)  # без numpy - всегда python
+        self.request_log = RequestLog.from_settings(_settings)  # выборочные логи запросов и сводка по ним
+        self.offloader = Offloader.from_settings(_settings)  # пул для разбора больших ответов и сложения статистик
+        self.loop_lag = LoopLagMonitor(_settings.loop_lag_interval)
+        self.refresher: HotTagRefresher | None = None  # создается в lifespan, ему нужна функция запроса тегов
+        logger.debug(f'Worker {os.getpid()}: {self.max_requests} connections of {_settings.max_requests}')
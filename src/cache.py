@@ -0,0 +1,221 @@
+"""
+Кэш частичных статистик по тегам в памяти процесса (вместо сырых ответов StackOverflow).
+TTL + LRU вытеснение, одновременные промахи по одному ключу объединяются в один запрос к StackOverflow
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Hashable, Iterator
+
+import loguru
+
+from src.settings_model import Settings
+from src.store import StatsStore
+
+if TYPE_CHECKING:  # snapshot.py сам импортирует store.py и data_extractor.py
+    from src.snapshot import TagSnapshot
+
+
+def cache_key(tag: str, _settings: Settings, page: int = 1) -> tuple:
+    """
+    Ключ кэша для страницы вопросов тега - все параметры запроса к StackOverflow, от которых зависит ответ
+    :param tag: тег для поиска
+    :param _settings: Pydantic модель с настройками приложения
+    :param page: номер страницы, с 1
+    :return: кортеж (tag, site, sort, order, pagesize, page)
+    """
+    return tag, _settings.site, _settings.sort, _settings.order, _settings.pagesize, page
+
+
+class TagCache:
+    """ TTL + LRU кэш с объединением (coalescing) одновременных промахов по одному ключу """
+
+    def __init__(self, ttl: float, max_size: int, store: StatsStore = None, snapshot: 'TagSnapshot' = None):
+        """
+        :param ttl: время жизни записи в секундах. Если <= 0, то записи не сохраняются (остается только coalescing)
+        :param max_size: максимальное количество записей, при превышении вытесняется самая давно использованная
+        :param store: хранилище, общее для worker процессов. Проверяется при локальном промахе, новые записи
+        пишутся и в него
+        :param snapshot: снимок кэша с диска (с прошлого запуска). Проверяется при промахе после store
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.store = store
+        self.snapshot = snapshot
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()  # key: (expires_at, value)
+        self._in_flight: dict[Hashable, asyncio.Future] = dict()  # запросы к StackOverflow, которые уже идут
+        self._waiters: dict[Hashable, int] = dict()  # сколько запросов ждут каждый из идущих запросов
+        self.hits = 0
+        self.misses = 0
+        self.logger: loguru.Logger = loguru.logger.bind(object_id='Tag cache')
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, allow_stale: bool = False) -> Any | None:
+        """
+        Вернуть значение из кэша, если оно есть и не устарело.
+        Устаревшие записи не удаляются сразу (только LRU вытеснением), чтобы их можно было отдать,
+        когда StackOverflow недоступен (например исчерпана квота)
+        :param key: ключ кэша
+        :param allow_stale: вернуть значение, даже если оно устарело
+        :return: значение или None
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if not allow_stale and expires_at <= time.monotonic():  # устарело
+            return None
+
+        self._data.move_to_end(key)  # LRU - помечаем как недавно использованное
+        return value
+
+    def put(self, key: Hashable, value: Any, ttl: float = None, share: bool = True):
+        """
+        Положить значение в кэш, вытеснив самые давно использованные записи при переполнении
+        :param key: ключ кэша
+        :param value: значение
+        :param ttl: время жизни записи, по умолчанию self.ttl
+        :param share: записать и в общее хранилище (False - значение из него же и получено)
+        """
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+
+        ttl = self.ttl if ttl is None else ttl
+        if share and self.store is not None:
+            self.store.put_stats(key, value, time.time() + ttl)
+
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            old_key, _ = self._data.popitem(last=False)
+            self.logger.trace(f'Evicted {old_key} from cache')
+
+    def expires_in(self, key: Hashable) -> float | None:
+        """
+        Через сколько секунд запись устареет (отрицательное - уже устарела)
+        :param key: ключ кэша
+        :return: секунды или None, если записи нет
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        return entry[0] - time.monotonic()
+
+    def get_shared(self, key: Hashable) -> Any | None:
+        """
+        Вернуть значение из общего хранилища, если оно там есть и не устарело, и положить его в локальный кэш
+        :param key: ключ кэша
+        :return: значение или None
+        """
+        if self.store is None or self.ttl <= 0:
+            return None
+
+        entry = self.store.get_stats(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        ttl = expires_at - time.time()
+        if ttl <= 0:
+            return None
+        self.put(key, value, ttl=ttl, share=False)
+        return value
+
+    def get_snapshot(self, key: Hashable) -> Any | None:
+        """
+        Вернуть значение из снимка с прошлого запуска, если оно там есть и не устарело, и положить его в кэш
+        :param key: ключ кэша
+        :return: значение или None
+        """
+        if self.snapshot is None or self.ttl <= 0:
+            return None
+
+        entry = self.snapshot.get(key)
+        if entry is None:
+            return None
+
+        value, expires_at = entry
+        self.put(key, value, ttl=expires_at - time.time())  # и в store - другие worker'ы не читают снимок повторно
+        return value
+
+    def entries(self) -> Iterator[tuple[Hashable, float, float, Any]]:
+        """
+        Неустаревшие записи для снимка на диске: (ключ, unix time получения, unix time устаревания, значение).
+        Время получения считается по текущему ttl (записи из store / снимка хранят исходное время устаревания)
+        """
+        offset = time.time() - time.monotonic()
+        now = time.monotonic()
+        for key, (expires_at, value) in self._data.items():
+            if expires_at > now:
+                yield key, expires_at + offset - self.ttl, expires_at + offset, value
+
+    def discard(self, key: Hashable):
+        """
+        Удалить запись из кэша, общего хранилища и снимка - она больше не соответствует ответу StackOverflow
+        :param key: ключ кэша
+        """
+        self._data.pop(key, None)
+        if self.store is not None:
+            self.store.delete_stats(key)
+        if self.snapshot is not None:
+            self.snapshot.discard(key)
+
+    def clear(self):
+        """ Очистить кэш (запросы в процессе не затрагиваются) """
+        self._data.clear()
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Вернуть значение из кэша или получить его через fetch. Если по этому ключу уже идет запрос,
+        то новый не создается - ожидается результат уже идущего. Если все ожидающие отменены, отменяется и запрос
+        :param key: ключ кэша
+        :param fetch: корутина-функция без аргументов, получающая значение (например из StackOverflow)
+        :return: значение
+        """
+        value = self.get(key)
+        if value is None:
+            value = self.get_shared(key)  # возможно, другой worker уже запросил
+        if value is None:
+            value = self.get_snapshot(key)  # возможно, запрашивали до перезапуска
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._on_fetched(key, t))
+        else:
+            self.logger.trace(f'Key {key} is already being fetched, waiting for it...')
+
+        # shield - отмена одного из ожидающих не должна отменять общий запрос для остальных
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # ушел последний ожидающий (клиент отключился, бюджет исчерпан) - результат никому не нужен,
+            # отменяем запрос, чтобы он не занимал слот и соединение к StackOverflow
+            if self._waiters[key] == 1 and not task.done():
+                self.logger.trace(f'Nobody is waiting for {key} anymore, cancelling its fetch')
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def _on_fetched(self, key: Hashable, task: asyncio.Future):
+        """ Callback завершения запроса: убрать из списка идущих и сохранить удачный результат """
+        self._in_flight.pop(key, None)
+        if task.cancelled():
+            return
+        if task.exception() is not None:  # ошибки не кэшируем, exception() также помечает ошибку как полученную
+            return
+        result = task.result()
+        if result:
+            self.put(key, result)
@@ -112,7 +112,10 @@ def logger_set_up(_settings, logs_path: str = "logs/sof_stats.log"):
     """Loguru set up"""
     logger.remove()  # this removes duplicates in the console if we use the custom log format
     logger.configure(extra={"object_id": "None"})  # Default values if not bind extra variable
-    logger.level("HL", no=38, color=Back.MAGENTA, icon="🔺")
+    try:
+        logger.level("HL")  # already registered - logger_set_up is called again by uvicorn app factory
+    except ValueError:
+        logger.level("HL", no=38, color=Back.MAGENTA, icon="🔺")
     logger.level(f"TRACE", color="<fg #1b7c80>")  # выставить цвет
     logger.level(f"SUCCESS", color="<bold><fg #2dd644>")  # выставить цвет
 
@@ -124,7 +127,7 @@ def logger_set_up(_settings, logs_path: str = "logs/sof_stats.log"):
         logger.add(sink=stderr,
                    format=_settings.log_format,
                    colorize=True,
-                   enqueue=True,  # for better work of async
+                   enqueue=_settings.log_enqueue,  # for better work of async
                    level=_settings.console_lvl)  # mb backtrace=True?
 
     logger.add(sink=logs_path,
@@ -132,5 +135,5 @@ def logger_set_up(_settings, logs_path: str = "logs/sof_stats.log"):
                compression='gz',
                retention=_settings.retention_time,
                format=_settings.log_format,
-               enqueue=True,  # for better work of async
+               enqueue=_settings.log_enqueue,  # for better work of async
                level=_settings.log_level)
@@ -1,7 +1,14 @@
 """ Extract data from list of questions """
-from typing import List
+import heapq
+from typing import TYPE_CHECKING, Iterable, List
 
 import loguru
+import orjson
+
+from src import vector_engine
+
+if TYPE_CHECKING:
+    from src.offload import Offloader
 
 
 class ExtractionError(Exception):
@@ -9,15 +16,113 @@ class ExtractionError(Exception):
     pass
 
 
-async def extract_info(tag_questions: dict, tags: List[str] = None) -> dict:
+logger = loguru.logger.bind(object_id='Data extractor')  # привязан один раз, не на каждый вызов
+
+# ключи сортировки статистики (параметр sort_by): [total, answered] -> ключ, при равенстве выше тег с большим total
+SORT_KEYS = {
+    'total'   : lambda counter: (counter[0], counter[1]),
+    'answered': lambda counter: (counter[1], counter[0]),
+    'ratio'   : lambda counter: (counter[1] / counter[0] if counter[0] else 0, counter[0]),
+}
+
+
+class TagStats:
     """
-    Извлекает инфу из входного словаря вопросов по тегам и возвращает статистику в формате dict.
-    :param tag_questions: dict of questions with q in list under 'items' field
-    :param tags: Optional tags for more precise logging
-    :return: calculated statistics based on tag_questions
+    Компактная частичная статистика по одному запросу (тегу): tag -> [total, answered].
+    Хранится в кэше вместо сырого списка вопросов и складывается с другими частями без повторного прохода по вопросам
     """
-    logger: loguru.Logger = loguru.logger.bind(object_id='Data extractor')
+    __slots__ = ('counts', 'questions', 'has_more', 'arrays')
+
+    def __init__(self, counts: dict[str, list[int]] = None, questions: int = 0, has_more: bool = False):
+        self.counts: dict[str, list[int]] = counts if counts is not None else dict()
+        self.questions = questions  # сколько вопросов учтено
+        self.has_more = has_more  # у StackOverflow есть следующая страница вопросов
+        self.arrays = None  # те же счетчики в виде массивов NumPy (vector_engine.as_arrays), None - не построены
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __repr__(self):
+        return f'TagStats(tags={len(self.counts)}, questions={self.questions})'
+
+    def copy(self) -> 'TagStats':
+        """ Независимая копия (счетчики не разделяются с оригиналом) """
+        return TagStats({tag: counter.copy() for tag, counter in self.counts.items()},
+                        self.questions, self.has_more)
+
+    def __getstate__(self):
+        """ Для pickle (пул процессов): массивы NumPy не передаются, id тегов в них - из словаря этого процесса """
+        return self.counts, self.questions, self.has_more
+
+    def __setstate__(self, state):
+        self.counts, self.questions, self.has_more = state
+        self.arrays = None
+
+    def dumps(self) -> bytes:
+        """ Сериализовать для хранения вне процесса (общее хранилище, снимки на диск) """
+        return orjson.dumps([self.counts, self.questions, self.has_more])
+
+    @classmethod
+    def loads(cls, data: bytes) -> 'TagStats':
+        """ Восстановить из результата dumps """
+        counts, questions, has_more = orjson.loads(data)[:3]  # в старых записях 4-е поле - дата самого нового вопроса
+        return cls(counts, questions, has_more)
+
+    def add_question(self, tags: Iterable[str], answered: bool):
+        """ Учесть один вопрос """
+        counts = self.counts
+        self.arrays = None
+        answered = 1 if answered else 0
+        for tag in tags:
+            counter = counts.get(tag)
+            if counter is None:  # create new counter if this is new tag in our stats
+                counts[tag] = [1, answered]
+            else:
+                counter[0] += 1
+                counter[1] += answered
+        self.questions += 1
+
+    def update(self, other: 'TagStats'):
+        """ Прибавить к себе другую частичную статистику """
+        counts = self.counts
+        self.arrays = None
+        for tag, (total, answered) in other.counts.items():
+            counter = counts.get(tag)
+            if counter is None:
+                counts[tag] = [total, answered]
+            else:
+                counter[0] += total
+                counter[1] += answered
+        self.questions += other.questions
+
+    def to_dict(self, top: int = None, min_total: int = 0, sort_by: str = None) -> dict:
+        """
+        Статистика в формате ответа сервиса: {tag: {'total': int, 'answered': int}}
+        :param top: только top тегов с наибольшим sort_by (выбор через кучу, без сортировки всех тегов)
+        :param min_total: только теги, встретившиеся не меньше min_total раз
+        :param sort_by: total, answered или ratio (answered / total). По умолчанию total, если задан top,
+        иначе теги не сортируются
+        :return: словарь ответа, при top / sort_by - по убыванию sort_by
+        """
+        items = self.counts.items()
+        if min_total > 0:
+            items = [(tag, counter) for tag, counter in items if counter[0] >= min_total]
+        if top is not None or sort_by is not None:
+            key = SORT_KEYS[sort_by or 'total']
+            if top is not None:
+                items = heapq.nlargest(top, items, key=lambda item: key(item[1]))
+            else:
+                items = sorted(items, key=lambda item: key(item[1]), reverse=True)
+        return {tag: {'total': total, 'answered': answered} for tag, (total, answered) in items}
+
 
+def count_questions(tag_questions: dict, tag: str = None) -> TagStats:
+    """
+    Посчитать частичную статистику по ответу StackOverflow для одного тега
+    :param tag_questions: dict of questions with q in list under 'items' field
+    :param tag: Optional tag for more precise logging
+    :return: TagStats по вопросам из tag_questions
+    """
     try:
         questions = tag_questions['items']
     except TypeError as te:
@@ -29,33 +134,61 @@ async def extract_info(tag_questions: dict, tags: List[str] = None) -> dict:
         logger.error(msg)
         raise ExtractionError(msg)
 
-    stats: dict[dict[str:int]] = dict()
+    stats = TagStats(has_more=bool(tag_questions.get('has_more')))
     for question in questions:
-        # logger.trace(f"{question}")
         try:
-            # logger.trace(f"q_id {question['question_id']} in consideration")
-
             # just to not catch error here. Hopefully this would not go so wrong that is_answered is missing
-            answered = question.get('is_answered', False)
-            for tag in question['tags']:
-                if tag in stats:
-                    stats[tag]['total'] += 1
-                else:  # create new dict if this is new tag in our stats
-                    stats[tag] = {'total': 1, 'answered': 0}
-
-                if answered:  # rise up counter if question was given
-                    stats[tag]['answered'] += 1
+            stats.add_question(question['tags'], question.get('is_answered', False))
         except KeyError as ke:
-            logger.debug(f'Skipping question: {question}, Error: {ke}')
+            logger.debug('Skipping question: {}, Error: {}', question, ke)
+
+    logger.trace('Tag {}: counted {} tags in {} questions!', tag, len(stats), stats.questions)
+    return stats
+
 
-    if tags:
-        logger.debug(f'Tags {tags}: extracted info from {len(questions)} questions!')
+def merge_stats(partials: List[TagStats], tags: List[str] = None,
+                top: int = None, min_total: int = 0, sort_by: str = None, engine: str = 'python') -> dict:
+    """
+    Синхронная часть extract_info: сложение и выбор тегов. Отдельная функция, чтобы ее можно было выполнить
+    в пуле потоков / процессов (src/offload.py). Параметры - см. extract_info
+    """
+    merged = TagStats()
+    if engine != 'python' and vector_engine.use_numpy(engine, sum(len(partial) for partial in partials)):
+        merged.counts = vector_engine.merge_counts(partials)
+        merged.questions = sum(partial.questions for partial in partials)
     else:
-        logger.debug(f'Extracted info from {len(questions)} questions!')
+        for partial in partials:
+            merged.update(partial)
+
+    logger.trace('Tags {}: extracted info from {} questions!', tags, merged.questions)
 
-    if not stats:
+    if not merged:
         msg = f'Gathered statistics is empty!'
         logger.error(msg)
         raise ExtractionError(msg)
 
-    return stats
+    return merged.to_dict(top=top, min_total=min_total, sort_by=sort_by)
+
+
+async def extract_info(partials: List[TagStats], tags: List[str] = None,
+                       top: int = None, min_total: int = 0, sort_by: str = None, engine: str = 'python',
+                       offloader: 'Offloader' = None) -> dict:
+    """
+    Складывает частичные статистики по тегам и возвращает общую статистику в формате dict.
+    :param partials: частичные статистики по каждому из тегов (из кэша или только что посчитанные)
+    :param tags: Optional tags for more precise logging
+    :param top: вернуть только top тегов с наибольшим sort_by
+    :param min_total: вернуть только теги, встретившиеся не меньше min_total раз
+    :param sort_by: total, answered или ratio - см. TagStats.to_dict
+    :param engine: python, numpy или auto - см. vector_engine
+    :param offloader: пул, в котором складываются большие статистики. Если None, все считается в event loop
+    :return: calculated statistics based on partials
+    """
+    if partials is None:
+        msg = f'Got None input partials. Returning...'
+        logger.error(msg)
+        raise ExtractionError(msg)
+
+    if offloader and offloader.should_aggregate(sum(len(partial) for partial in partials)):
+        return await offloader.run(merge_stats, partials, tags, top, min_total, sort_by, engine)
+    return merge_stats(partials, tags, top, min_total, sort_by, engine)
@@ -0,0 +1,76 @@
+"""
+Бюджет времени запроса клиента и отслеживание его отключения. Когда бюджет исчерпан или клиент ушел, оставшиеся
+запросы к StackOverflow отменяются - они освобождают слоты и соединения для других клиентов, вместо того чтобы
+работать на ответ, который уже никто не получит
+"""
+import math
+import time
+
+from starlette.requests import Request
+
+from src.requester import RequestError
+
+TIMEOUT_HEADER = 'x-request-timeout'  # бюджет в секундах, как и параметр timeout
+
+
+class DeadlineExceeded(RequestError):
+    """ Бюджет времени запроса исчерпан, а частичный ответ не разрешен - 504 Gateway Timeout """
+
+    def __init__(self, message):
+        super().__init__(message, error_code=504)
+
+
+class ClientDisconnected(RequestError):
+    """ Клиент отключился, не дождавшись ответа - 499 Client Closed Request (как у nginx), ответ никто не получит """
+
+    def __init__(self, message):
+        super().__init__(message, error_code=499)
+
+
+class Deadline:
+    """ Момент, к которому запрос должен быть выполнен (time.monotonic) """
+
+    def __init__(self, budget: float):
+        """
+        :param budget: бюджет времени в секундах от текущего момента
+        """
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+
+    def __repr__(self):
+        return f'Deadline(budget={self.budget}, remaining={self.remaining():.3f})'
+
+    def remaining(self) -> float:
+        """ Сколько секунд осталось (0 - бюджет исчерпан) """
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+    @classmethod
+    def from_request(cls, request: Request, timeout: float | None, max_budget: float) -> 'Deadline':
+        """
+        Бюджет из параметра timeout или заголовка X-Request-Timeout, не больше max_budget. Нет значения, оно
+        не положительное или не конечное - max_budget
+        :param request: входящий запрос
+        :param timeout: значение параметра запроса timeout (приоритетнее заголовка)
+        :param max_budget: максимальный и бюджет по умолчанию (Settings.timeout)
+        :return: Deadline
+        """
+        if timeout is None:
+            try:
+                timeout = float(request.headers.get(TIMEOUT_HEADER, ''))
+            except ValueError:  # нет заголовка или в нем не число
+                timeout = None
+        # nan и inf (их принимают и float, и параметр запроса) обошли бы ограничение: min(nan, x) - nan
+        if timeout is None or not math.isfinite(timeout) or timeout <= 0:
+            return cls(max_budget)
+        return cls(min(timeout, max_budget))
+
+
+async def wait_disconnected(request: Request):
+    """
+    Завершается, когда клиент отключился. Тело запроса к этому моменту уже прочитано (FastAPI читает его до вызова
+    эндпоинта, у /search тела нет), поэтому следующее сообщение от сервера - только http.disconnect.
+    Request.is_disconnected() не подходит: за BaseHTTPMiddleware его неблокирующая проверка никогда не видит отключения
+    :param request: входящий запрос
+    """
+    while (await request.receive())['type'] != 'http.disconnect':
+        pass
@@ -0,0 +1,186 @@
+"""
+Регулятор исходящих запросов к StackOverflow: дневная квота (quota_remaining), поле backoff и бан по IP
+(throttle_violation), а также сглаживание запросов token bucket'ом. Лучше быстро ответить 429 самим,
+чем получить от StackOverflow бан на ~24ч
+"""
+import asyncio
+import re
+import time
+from datetime import datetime, timezone
+
+import loguru
+
+from src.requester import UnsuccessfulRequest
+from src.settings_model import Settings
+from src.store import StatsStore
+
+# "too many requests from this IP, more requests available in 82235 seconds"
+BAN_SECONDS_RE = re.compile(r'available in (\d+) seconds')
+
+
+class QuotaGovernor:
+    """ Следит за квотой и backoff StackOverflow и ограничивает частоту исходящих запросов """
+
+    def __init__(self, rate: float, burst: int, quota_reserve: int, max_backoff_wait: float,
+                 store: StatsStore = None):
+        """
+        :param rate: средняя частота запросов в секунду (token bucket), <= 0 - без ограничения
+        :param burst: максимальное количество запросов подряд без ожидания
+        :param quota_reserve: сколько запросов квоты оставлять неиспользованными
+        :param max_backoff_wait: сколько максимум секунд ждать по backoff, дольше - сразу 429
+        :param store: хранилище, общее для worker процессов - через него все узнают о квоте, backoff и бане
+        """
+        self.rate = rate
+        self.burst = burst
+        self.quota_reserve = quota_reserve
+        self.max_backoff_wait = max_backoff_wait
+
+        self._tokens: float = burst
+        self._last_refill = time.monotonic()
+
+        self.quota_remaining: int | None = None  # неизвестно до первого ответа
+        self.quota_max: int | None = None
+        self._quota_day = datetime.now(timezone.utc).date()  # квота StackOverflow дневная
+        # unix time, а не monotonic - сроки передаются между процессами через store
+        self._backoff_until: dict[str, float] = dict()  # endpoint: unix time
+        self.banned_until: float = 0  # unix time
+        self.store = store
+        self._quota_updated: float = 0  # unix time последнего известного значения квоты
+
+        self.logger: loguru.Logger = loguru.logger.bind(object_id='Governor')
+
+    @classmethod
+    def from_settings(cls, _settings: Settings, workers: int = 1, store: StatsStore = None) -> 'QuotaGovernor':
+        """
+        Создать регулятор по настройкам приложения
+        :param _settings: Pydantic модель с настройками приложения
+        :param workers: количество worker процессов - частота запросов ограничивается по IP, то есть на весь сервис
+        :param store: хранилище, общее для worker процессов
+        """
+        return cls(rate=_settings.rate_limit / workers,
+                   burst=max(_settings.rate_burst // workers, 1),
+                   quota_reserve=_settings.quota_reserve,
+                   max_backoff_wait=_settings.max_backoff_wait,
+                   store=store)
+
+    def _check_new_day(self):
+        """ Сбросить известную квоту, если наступили новые сутки (UTC) """
+        today = datetime.now(timezone.utc).date()
+        if today != self._quota_day:
+            self._quota_day = today
+            self.quota_remaining = None
+
+    def _sync(self, endpoint: str):
+        """ Подтянуть из общего хранилища квоту, бан и backoff, которые получили другие worker'ы """
+        quota = self.store.get_quota()
+        if quota is not None and quota[2] > self._quota_updated:
+            if datetime.fromtimestamp(quota[2], timezone.utc).date() == self._quota_day:
+                self.quota_remaining, self.quota_max, self._quota_updated = quota
+        self.banned_until = max(self.banned_until, self.store.get_until('ban'))
+        backoff_until = self.store.get_until(f'backoff:{endpoint}')
+        if backoff_until > self._backoff_until.get(endpoint, 0):
+            self._backoff_until[endpoint] = backoff_until
+
+    def check(self, endpoint: str) -> float:
+        """
+        Проверить, можно ли сейчас делать запрос к endpoint, не ожидая
+        :param endpoint: путь метода StackOverflow API (backoff выдается на конкретный метод)
+        :return: сколько секунд нужно подождать по backoff (0 - можно сразу)
+        :raises UnsuccessfulRequest: 429, если IP забанен, квота исчерпана или backoff слишком длинный
+        """
+        if self.store is not None:
+            self._sync(endpoint)
+
+        now = time.time()
+        if self.banned_until > now:
+            raise UnsuccessfulRequest(f'StackOverflow ban, more requests available in '
+                                      f'{int(self.banned_until - now)} seconds', error_code=429)
+
+        self._check_new_day()
+        if self.quota_remaining is not None and self.quota_remaining <= self.quota_reserve:
+            raise UnsuccessfulRequest(f'StackOverflow quota is exhausted: {self.quota_remaining} of '
+                                      f'{self.quota_max} remaining', error_code=429)
+
+        wait = self._backoff_until.get(endpoint, 0) - now
+        if wait > self.max_backoff_wait:
+            raise UnsuccessfulRequest(f'StackOverflow backoff for {endpoint}, more requests available in '
+                                      f'{int(wait)} seconds', error_code=429)
+        return max(wait, 0)
+
+    async def acquire(self, endpoint: str):
+        """
+        Дождаться разрешения на запрос к endpoint: backoff и token bucket
+        :param endpoint: путь метода StackOverflow API
+        :raises UnsuccessfulRequest: 429, если запрос делать нельзя (см. check)
+        """
+        wait = self.check(endpoint)
+        if wait:
+            self.logger.debug(f'Waiting {wait:.2f} seconds of backoff for {endpoint}...')
+            await asyncio.sleep(wait)
+
+        if self.rate <= 0:
+            return
+
+        # резервируем токен сразу (баланс может уйти в минус) - так одновременные запросы выстраиваются в очередь
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+        self._tokens -= 1
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self.rate)
+
+    def has_spare_quota(self, amount: int) -> bool:
+        """
+        Остается ли сверх quota_reserve не меньше amount запросов квоты (для необязательных запросов: повторов, hedging)
+        :param amount: сколько запросов квоты должно остаться
+        :return: True, если квота еще неизвестна или ее достаточно, False при бане
+        """
+        if self.banned_until > time.time():
+            return False
+        return self.quota_remaining is None or self.quota_remaining - self.quota_reserve >= amount
+
+    def observe(self, endpoint: str, result: dict):
+        """
+        Учесть поля quota_remaining, quota_max и backoff из ответа StackOverflow
+        :param endpoint: путь метода StackOverflow API
+        :param result: декодированный ответ
+        """
+        quota_remaining = result.get('quota_remaining')
+        if quota_remaining is not None:
+            self._check_new_day()
+            self.quota_remaining = quota_remaining
+            self.quota_max = result.get('quota_max', self.quota_max)
+            self._quota_updated = time.time()
+            if self.store is not None:
+                self.store.put_quota(self.quota_remaining, self.quota_max)
+            if quota_remaining <= self.quota_reserve:
+                self.logger.warning(f'StackOverflow quota is almost exhausted: {quota_remaining} of {self.quota_max}')
+
+        backoff = result.get('backoff')
+        if backoff:
+            self.logger.warning(f'Got backoff {backoff} seconds for {endpoint}')
+            self._backoff_until[endpoint] = time.time() + backoff
+            if self.store is not None:
+                self.store.put_until(f'backoff:{endpoint}', self._backoff_until[endpoint])
+
+    def ban(self, error_message: str):
+        """
+        Учесть бан по IP (throttle_violation) из сообщения об ошибке StackOverflow
+        :param error_message: error_message из ответа
+        """
+        match = BAN_SECONDS_RE.search(error_message or '')
+        seconds = int(match.group(1)) if match else 60  # если не распарсили - хотя бы не долбим минуту
+        self.banned_until = time.time() + seconds
+        if self.store is not None:
+            self.store.put_until('ban', self.banned_until)
+        self.logger.error(f'StackOverflow banned us for {seconds} seconds')
+
+    def status(self) -> dict:
+        """ Текущее состояние регулятора для диагностики """
+        now = time.time()
+        return {
+            'quota_remaining': self.quota_remaining,
+            'quota_max'      : self.quota_max,
+            'banned_for'     : max(int(self.banned_until - now), 0),
+            'backoff'        : {k: round(v - now, 1) for k, v in self._backoff_until.items() if v > now},
+        }
@@ -0,0 +1,142 @@
+"""
+Метрики сервиса в текстовом формате Prometheus (эндпоинт /metrics).
+Минимальная реализация без prometheus_client: счетчики, gauge и гистограммы на уровне модуля, у каждого worker
+процесса свои
+"""
+import bisect
+import time
+from contextlib import contextmanager
+
+# границы бакетов гистограмм задержек в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+REGISTRY: list['Metric'] = list()
+
+
+def format_labels(labelnames: tuple, values: tuple) -> str:
+    """ {a="1",b="2"} - метки метрики в формате Prometheus """
+    parts = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Metric:
+    """ Базовый класс метрики, регистрируется в REGISTRY при создании """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        REGISTRY.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}'] + self.samples()
+
+
+class Counter(Metric):
+    """ Монотонно растущий счетчик """
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        super().__init__(name, documentation, labelnames)
+        self.values: dict[tuple, float] = dict()
+
+    def inc(self, amount: float = 1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, value: float, *labels):
+        """ Выставить значение (для счетчиков, которые уже ведутся в другом месте, например в TagCache) """
+        self.values[labels] = value
+
+    def samples(self) -> list[str]:
+        return [f'{self.name}{format_labels(self.labelnames, labels)} {value}' for labels, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """ Значение, которое может как расти, так и уменьшаться """
+    kind = 'gauge'
+
+
+class Histogram(Metric):
+    """ Гистограмма, по каждому набору меток своя (бакеты накопительные, как требует Prometheus, считаются при выводе) """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # метки -> [количество по бакетам (последний - больше всех границ, +Inf), сумма]
+        self.values: dict[tuple, list] = dict()
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def sum(self, *labels) -> float:
+        """ Сумма наблюдений с этими метками """
+        series = self.values.get(labels)
+        return series[1] if series else 0.0
+
+    @contextmanager
+    def time(self, *labels):
+        """ Замерить длительность блока with """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, (counts, value_sum) in self.values.items():
+            names, total = self.labelnames + ('le',), 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                lines.append(f'{self.name}_bucket{format_labels(names, labels + (bound,))} {total}')
+            total += counts[-1]
+            lines.append(f'{self.name}_bucket{format_labels(names, labels + ("+Inf",))} {total}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {value_sum}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {total}')
+        return lines
+
+
+def render_metrics() -> str:
+    """ Все зарегистрированные метрики в текстовом формате Prometheus """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# region Metrics
+SEARCH_LATENCY = Histogram('sof_search_duration_seconds', 'End-to-end latency of /search and /search/batch '
+                                                          '(endpoint: search, batch)', ('endpoint',))
+SEARCH_REQUESTS = Counter('sof_search_requests_total', '/search and /search/batch responses by status code',
+                          ('endpoint', 'status'))
+UPSTREAM_LATENCY = Histogram('sof_upstream_duration_seconds', 'Latency of one StackOverflow request (one tag page)')
+UPSTREAM_RESPONSES = Counter('sof_upstream_responses_total', 'StackOverflow responses by status code '
+                                                             '(error - no response)', ('status',))
+UPSTREAM_EXTRA = Counter('sof_upstream_extra_attempts_total', 'Retries and hedged requests to StackOverflow '
+                                                              '(hedge_won - hedged request answered first, '
+                                                              'hedge_skipped - no free slot for it)', ('kind',))
+BREAKER_STATE = Gauge('sof_upstream_breaker_state', 'Circuit breaker state: 0 closed, 1 half open, 2 open')
+SEMAPHORE_WAIT = Histogram('sof_semaphore_wait_seconds', 'Wait for a free upstream connection slot')
+ADMISSION_QUEUE = Gauge('sof_admission_queue', 'Requests waiting for a free upstream connection slot')
+ADMISSION_REJECTED = Counter('sof_admission_rejected_total', 'Requests shed with 503 by reason', ('reason',))
+ADMISSION_CLIENTS = Gauge('sof_admission_clients', 'Clients holding or waiting for upstream connection slots')
+ADMISSION_CAPPED = Counter('sof_admission_capped_total', 'Requests queued because their client hit client_max_slots')
+EXTRACT_LATENCY = Histogram('sof_extract_info_duration_seconds', 'extract_info (merge of tag statistics) duration')
+CACHE_REQUESTS = Counter('sof_cache_requests_total', 'Tag cache lookups by result', ('result',))
+CACHE_SIZE = Gauge('sof_cache_entries', 'Entries in the local tag cache')
+UPSTREAM_SLOTS = Gauge('sof_upstream_slots', 'Upstream connection slots (semaphore) by state', ('state',))
+POOL_CONNECTIONS = Gauge('sof_httpx_pool_connections', 'httpx pool connections by state', ('state',))
+EVENT_LOOP_LAG = Histogram('sof_event_loop_lag_seconds', 'How late the event loop wakes up from a sleep (blocked loop)')
+OFFLOAD_LATENCY = Histogram('sof_offload_duration_seconds', 'Work offloaded to the executor, including queueing')
+STORE_ERRORS = Counter('sof_store_errors_total', 'Shared store calls skipped: SQLite busy or failing', ('op',))
+QUOTA_REMAINING = Gauge('sof_quota_remaining', 'Last seen StackOverflow quota_remaining')
+# endregion
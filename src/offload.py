@@ -0,0 +1,113 @@
+"""
+Вынос тяжелой CPU работы (разбор больших ответов StackOverflow, сложение большого количества статистик) из event loop
+в пул потоков или процессов, и замер задержки event loop - насколько он занят синхронной работой.
+Пул потоков помогает для кода на Python (GIL переключается между потоками), но не для одного долгого вызова C
+(orjson.loads) - для него нужен пул процессов, который платит за передачу данных между процессами
+"""
+import asyncio
+import functools
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable
+
+import loguru
+
+from src import metrics
+from src.settings_model import Settings
+
+EXECUTORS = ('none', 'thread', 'process')
+
+
+class OffloadError(Exception):
+    """ Wrong executor configuration """
+    pass
+
+
+def _init_process():
+    """ Процессы пула не пишут логи: логгер в них не настроен, исключения и так возвращаются в worker """
+    loguru.logger.remove()
+
+
+class Offloader:
+    """ Пул для тяжелой синхронной работы и пороги, с которых работа в него выносится """
+
+    def __init__(self, kind: str = 'none', workers: int = 2, min_bytes: int = 262144, min_tags: int = 20000):
+        """
+        :param kind: none - все в event loop, thread - пул потоков, process - пул процессов
+        :param workers: размер пула
+        :param min_bytes: разбирать в пуле ответы StackOverflow от такого размера в байтах
+        :param min_tags: складывать в пуле статистики от стольких тегов во всех частичных статистиках вместе
+        """
+        if kind not in EXECUTORS:
+            raise OffloadError(f'Unknown executor "{kind}", expected one of {EXECUTORS}')
+        self.kind = kind
+        self.min_bytes = min_bytes
+        self.min_tags = min_tags
+        self.executor: Executor | None = None
+        if kind == 'thread':
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sof-offload')
+        elif kind == 'process':
+            # spawn, а не fork: fork процесса с event loop и потоками логгера может зависнуть
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=_init_process)
+
+    @classmethod
+    def from_settings(cls, _settings: Settings) -> 'Offloader':
+        return cls(kind=_settings.executor, workers=_settings.executor_workers,
+                   min_bytes=_settings.offload_min_bytes, min_tags=_settings.offload_min_tags)
+
+    def should_decode(self, size: int) -> bool:
+        """ Разбирать ли в пуле ответ размером size байт """
+        return self.executor is not None and size >= self.min_bytes
+
+    def should_aggregate(self, tags: int) -> bool:
+        """ Складывать ли в пуле статистики с tags тегами в сумме """
+        return self.executor is not None and tags >= self.min_tags
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        """ Выполнить func в пуле (для пула процессов func и аргументы должны сериализоваться pickle) """
+        with metrics.OFFLOAD_LATENCY.time():
+            return await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                    functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        """ Остановить пул, не дожидаясь задач (при остановке сервиса их результат уже не нужен) """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class LoopLagMonitor:
+    """
+    Замер задержки event loop: раз в interval секунд засыпает на interval и смотрит, насколько позже проснулся.
+    Задержка = сколько времени loop был занят синхронной работой и не мог обслуживать другие запросы
+    """
+
+    def __init__(self, interval: float = 0.5):
+        """
+        :param interval: период замера в секундах, 0 - не замерять
+        """
+        self.interval = interval
+        self.max_lag = 0.0  # максимальная задержка с запуска
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(loop.time() - start - self.interval, 0.0)
+            self.max_lag = max(self.max_lag, lag)
+            metrics.EVENT_LOOP_LAG.observe(lag)
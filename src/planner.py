@@ -0,0 +1,99 @@
+"""
+Планирование запроса до обращения к StackOverflow: теги приводятся к канонической форме (Unicode NFKC и casefold -
+"Python", "python" и "ｐｙｔｈｏｎ" это один тег, русские теги тоже), повторы убираются, запросы сверх лимитов
+отклоняются сразу. Кэш, объединение запросов и регулятор дальше работают с минимальным набором разных тегов,
+а один и тот же тег не считается в статистике несколько раз
+"""
+import unicodedata
+from typing import Iterable
+
+from src.cache import TagCache, cache_key
+from src.requester import RequestError
+from src.settings_model import Settings
+
+MAX_TAG_LENGTH = 35  # длиннее тегов у StackOverflow не бывает
+
+
+class InvalidQuery(RequestError):
+    """ Неверные теги или запрос сверх лимитов - 422 Unprocessable Entity """
+
+    def __init__(self, message):
+        super().__init__(message, error_code=422)
+
+
+def canonical_tag(tag: str) -> str:
+    """ Каноническая форма тега: NFKC (полноширинные символы, лигатуры) и casefold, без пробелов по краям """
+    return unicodedata.normalize('NFKC', tag).strip().casefold()
+
+
+def canonical_tags(tags: Iterable[str]) -> list[str]:
+    """
+    Канонические теги без повторов, в порядке первого упоминания
+    :param tags: теги из запроса
+    :raises InvalidQuery: тег не из букв и цифр или слишком длинный
+    """
+    result = dict()
+    for tag in tags:
+        canonical = canonical_tag(tag)
+        if not canonical.isalnum():
+            raise InvalidQuery(f'Error: tag "{tag}" is not alphanumeric!')
+        if len(canonical) > MAX_TAG_LENGTH:
+            raise InvalidQuery(f'Error: tag "{tag}" is longer than {MAX_TAG_LENGTH} characters!')
+        result[canonical] = None
+    return list(result)
+
+
+class QueryPlan:
+    """ Что и в каком порядке запрашивать: уникальные канонические теги и группы тегов из них """
+
+    def __init__(self, groups: list[list[str]], tags: list[str], pages: int, cached: int = 0):
+        """
+        :param groups: канонические теги каждой группы (у /search - одна группа)
+        :param tags: уникальные теги всех групп в порядке запросов
+        :param pages: количество страниц вопросов по каждому тегу
+        :param cached: сколько страниц уже есть в локальном кэше
+        """
+        self.groups = groups
+        self.tags = tags
+        self.pages = pages
+        self.cached = cached
+
+    def __repr__(self):
+        return f'QueryPlan(tags={self.tags}, pages={self.pages}, cached={self.cached} of {self.fetches})'
+
+    @property
+    def fetches(self) -> int:
+        """ Сколько страниц нужно получить (из кэша или у StackOverflow), не больше """
+        return len(self.tags) * self.pages
+
+
+def plan_query(groups: list[list[str]], pages: int, cache: TagCache, _settings: Settings) -> QueryPlan:
+    """
+    План запроса: канонические теги, проверка лимитов и порядок запросов - сначала теги, все страницы которых уже
+    в кэше (отдаются сразу, без слота и квоты), затем по возрастанию количества страниц, которых в кэше нет.
+    Дешевые теги не ждут за дорогими в очереди клиента к слотам и успевают до исчерпания бюджета времени
+    :param groups: группы тегов из запроса
+    :param pages: количество страниц вопросов по каждому тегу
+    :param cache: кэш статистик - проверяется без учета в hits / misses и без изменения порядка LRU
+    :param _settings: Pydantic модель с настройками приложения
+    :return: QueryPlan
+    :raises InvalidQuery: неверный тег или превышен лимит (max_pages, max_tags, max_fetches)
+    """
+    if pages > _settings.max_pages:
+        raise InvalidQuery(f'Error: pages {pages} is more than {_settings.max_pages}!')
+
+    groups = [canonical_tags(group) for group in groups]
+    unique = list(dict.fromkeys(tag for group in groups for tag in group))
+    if len(unique) > _settings.max_tags:
+        raise InvalidQuery(f'Error: {len(unique)} distinct tags is more than {_settings.max_tags}!')
+    if len(unique) * pages > _settings.max_fetches:
+        raise InvalidQuery(f'Error: {len(unique)} tags x {pages} pages is more than {_settings.max_fetches} '
+                           f'page requests!')
+
+    def missing(tag: str) -> int:  # страниц тега, которых нет в кэше (или они устарели)
+        return sum(1 for page in range(1, pages + 1)
+                   if (cache.expires_in(cache_key(tag, _settings, page)) or 0) <= 0)
+
+    costs = {tag: missing(tag) for tag in unique}
+    order = sorted(unique, key=costs.__getitem__)  # sorted устойчив - при равной цене порядок запроса
+    return QueryPlan(groups, order, pages, cached=len(unique) * pages - sum(costs.values()))
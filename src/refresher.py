@@ -0,0 +1,103 @@
+"""
+Фоновое обновление статистики популярных тегов (stale-while-revalidate).
+Популярные теги обновляются до того, как их запись в кэше устареет, поэтому /search отвечает по ним из памяти.
+Первая страница запрашивается заново целиком: с новыми вопросами сдвигаются и остальные страницы, поэтому их записи
+удаляются из кэша - иначе pages > 1 учли бы одни и те же вопросы дважды
+"""
+import asyncio
+from collections import Counter
+from typing import Awaitable, Callable
+
+import loguru
+
+from src.cache import TagCache, cache_key
+from src.data_extractor import TagStats
+from src.settings_model import Settings
+
+# fetch(tag) - запросить первую страницу вопросов тега
+FetchFunc = Callable[[str], Awaitable[TagStats | None]]
+
+
+class HotTagRefresher:
+    """ Следит за популярностью тегов и заранее обновляет их статистику в кэше """
+
+    def __init__(self, cache: TagCache, fetch: FetchFunc, _settings: Settings):
+        """
+        :param cache: кэш частичных статистик по тегам
+        :param fetch: функция запроса первой страницы вопросов тега к StackOverflow
+        :param _settings: Pydantic модель с настройками приложения
+        """
+        self.cache = cache
+        self.fetch = fetch
+        self.settings = _settings
+        self.popularity: Counter[str] = Counter()  # тег: количество запросов с затуханием
+        self.refreshed = 0
+        self._task: asyncio.Task | None = None
+        self.logger: loguru.Logger = loguru.logger.bind(object_id='Hot tags')
+
+    def touch(self, tag: str):
+        """ Учесть запрос тега """
+        self.popularity[tag] += 1
+
+    def hot_tags(self) -> list[str]:
+        """ Самые популярные теги, не больше hot_tags из настроек """
+        return [tag for tag, _ in self.popularity.most_common(self.settings.hot_tags)]
+
+    def start(self):
+        """ Запустить фоновое обновление (если hot_tags в настройках > 0) """
+        if self.settings.hot_tags > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """ Остановить фоновое обновление """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        """ Цикл обновления раз в refresh_interval секунд """
+        while True:
+            await asyncio.sleep(self.settings.refresh_interval)
+            try:
+                await self.refresh_due()
+            except Exception as e:  # фоновая задача не должна умирать от одной ошибки
+                self.logger.error(f'Refresh cycle failed: {e.__repr__()}')
+
+    async def refresh_due(self):
+        """ Обновить популярные теги, запись которых в кэше устареет раньше чем через refresh_ahead секунд """
+        due = []
+        for tag in self.hot_tags():
+            expires_in = self.cache.expires_in(cache_key(tag, self.settings))
+            if expires_in is not None and expires_in < self.settings.refresh_ahead:
+                due.append(tag)
+
+        # затухание популярности - теги, которые перестали запрашивать, со временем выпадают из горячих
+        for tag in list(self.popularity):
+            self.popularity[tag] //= 2
+            if not self.popularity[tag]:
+                del self.popularity[tag]
+
+        if not due:
+            return
+        self.logger.debug(f'Refreshing hot tags: {due}')
+        results = await asyncio.gather(*[self.refresh(tag) for tag in due], return_exceptions=True)
+        for tag, res in zip(due, results):
+            if isinstance(res, Exception):
+                self.logger.warning(f'Tag {tag}: refresh failed, {res}')
+
+    async def refresh(self, tag: str):
+        """
+        Обновить статистику тега в кэше: первая страница запрашивается заново (один запрос к StackOverflow, как и
+        запрос только новых вопросов), записи следующих страниц удаляются - их вопросы сдвинулись
+        :param tag: тег
+        """
+        fresh = await self.fetch(tag)
+        if fresh:
+            self.cache.put(cache_key(tag, self.settings), fresh)
+            for page in range(2, self.settings.max_pages + 1):
+                self.cache.discard(cache_key(tag, self.settings, page))
+            self.refreshed += 1
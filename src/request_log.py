@@ -0,0 +1,77 @@
+"""
+Выборочные логи запросов и периодическая сводка вместо них - при высокой нагрузке логи каждого запроса
+стоят заметного CPU и их все равно невозможно читать
+"""
+import asyncio
+import random
+
+import loguru
+
+from src.settings_model import Settings
+
+
+class RequestLog:
+    """ Решает, логировать ли запрос подробно, и раз в summary_interval секунд пишет сводку по всем запросам """
+
+    def __init__(self, sample_rate: float, summary_interval: int):
+        """
+        :param sample_rate: доля запросов с подробными логами (1 - все, 0 - ни одного)
+        :param summary_interval: период сводки в секундах, 0 - без сводки
+        """
+        self.sample_rate = sample_rate
+        self.summary_interval = summary_interval
+        self._reset()
+        self._task: asyncio.Task | None = None
+        self.logger: loguru.Logger = loguru.logger.bind(object_id='Requests summary')
+
+    @classmethod
+    def from_settings(cls, _settings: Settings) -> 'RequestLog':
+        return cls(sample_rate=_settings.log_sample_rate, summary_interval=_settings.log_summary_interval)
+
+    def _reset(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def sampled(self) -> bool:
+        """ Логировать ли этот запрос подробно """
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def record(self, status_code: int, seconds: float):
+        """ Учесть запрос в сводке """
+        self.requests += 1
+        if status_code >= 400:
+            self.errors += 1
+        self.total_time += seconds
+        if seconds > self.max_time:
+            self.max_time = seconds
+
+    def summary(self):
+        """ Записать сводку за прошедший период и начать новый """
+        if self.requests:
+            self.logger.info('Last {} s: {} requests, {} errors, avg {:.3f} s, max {:.3f} s',
+                             self.summary_interval, self.requests, self.errors,
+                             self.total_time / self.requests, self.max_time)
+        self._reset()
+
+    def start(self):
+        """ Запустить периодическую сводку """
+        if self.summary_interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """ Остановить периодическую сводку, записав последнюю """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            self.summary()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.summary_interval)
+            self.summary()
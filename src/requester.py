@@ -2,17 +2,33 @@
 Вынес в отдельный модуль, тк это часть взаимодействующая с сетью
 """
 
+import asyncio
+import importlib.util
+import time
 from ast import literal_eval
-from typing import Any
+from typing import TYPE_CHECKING, Any
 
 import httpx
 import loguru
+import orjson
 
+from src import metrics
 from src.settings_model import Settings
 
+if TYPE_CHECKING:  # governor.py сам импортирует исключения из этого модуля
+    from src.governor import QuotaGovernor
+    from src.offload import Offloader
+    from src.resilience import UpstreamPolicy
+
+
+# поля ответа StackOverflow, которые нужны сервису. Всё остальное (owner, title, link, score...) не передается по сети
+FILTER_INCLUDE = ('.backoff', '.error_id', '.error_message', '.error_name', '.has_more', '.items',
+                  '.quota_max', '.quota_remaining', 'question.tags', 'question.is_answered')
+
 
 class RequestError(Exception):
     """ Base class for all exceptions that occur at the level of the requester.py """
+    headers: dict | None = None  # дополнительные заголовки ответа сервиса (например Retry-After)
 
     def __init__(self, message, error_code=500):  # default 500 - Internal Server Error
         self.message = message
@@ -41,25 +57,40 @@ class UnsuccessfulRequest(RequestError):
         super().__init__(message, error_code)
 
 
+# необязательные пакеты: h2 - HTTP/2 в httpx, brotli / brotlicffi - сжатие br (httpx сам его декодирует)
+HTTP2_AVAILABLE = importlib.util.find_spec('h2') is not None
+BROTLI_AVAILABLE = any(importlib.util.find_spec(name) is not None for name in ('brotli', 'brotlicffi'))
+
+
+# логгер привязан один раз: bind() создает новый объект логгера, на горячем пути это лишняя работа
+logger = loguru.logger.bind(object_id='Requester')
+
+
 async def search_sof_questions(aclient: httpx.AsyncClient,
                                query_tag: str,
-                               _settings: Settings) -> Any:
+                               _settings: Settings,
+                               governor: 'QuotaGovernor' = None,
+                               page: int = 1,
+                               offloader: 'Offloader' = None,
+                               policy: 'UpstreamPolicy' = None) -> Any:
     """
     Search stackoverflow questions
     :param _settings: Pydantic модель с настройками приложения
     :param aclient: httpx.AsyncClient object для переиспользования keep-alive соединений и прочих оптимизаций
     :param query_tag: тег, по которому нужно совершить поиск
+    :param governor: регулятор квоты и частоты запросов. Если None, запрос отправляется без ограничений
+    :param page: номер страницы, с 1. Пустой ответ считается ошибкой только для первой страницы
+    :param offloader: пул для разбора больших ответов вне event loop. Если None, ответ разбирается в event loop
+    :param policy: повторы, hedging и circuit breaker. Если None, одна попытка
     :return: None если ошибка, JSON с ответом в случае успеха
     """
-    # bind logger extra obj for more intuitive logging
-    logger: loguru.Logger = loguru.logger.bind(object_id='Requester')
-
     if not _settings:
         msg = 'Settings not found!'
         logger.error(msg)
         raise FileNotFoundError(msg)
 
-    logger.debug(f'Working with tag "{query_tag}"...')
+    # строки по каждому тегу и странице - TRACE: в PROD (DEBUG и выше) они отбрасываются, не попадая в очередь логов
+    logger.trace('Working with tag "{}" (page {})...', query_tag, page)
 
     if not query_tag:
         msg = 'query_tag cannot be empty or null'
@@ -71,15 +102,34 @@ async def search_sof_questions(aclient: httpx.AsyncClient,
     else:
         log_out = logger.error  # simple
 
+    endpoint = httpx.URL(_settings.url).path
+    if policy:  # до try - 503 от circuit breaker не должен превратиться в 500 ниже
+        policy.check()
+    if governor:  # до try - 429 от регулятора не должен превратиться в 500 ниже
+        await governor.acquire(endpoint)
+
     try:
-        response = await aclient.get(_settings.url,
-                                     params={
-                                         "pagesize": _settings.pagesize,
-                                         "order"   : _settings.order,
-                                         "sort"    : _settings.sort,
-                                         "intitle" : query_tag,
-                                         "site"    : _settings.site
-                                     })
+        params = {
+            "pagesize": _settings.pagesize,
+            "order"   : _settings.order,
+            "sort"    : _settings.sort,
+            "intitle" : query_tag,
+            "site"    : _settings.site
+        }
+        if page > 1:
+            params['page'] = page
+        if _settings.api_filter:  # в ответе будут только tags и is_answered вопросов
+            params['filter'] = _settings.api_filter
+        if policy:  # метрики ответа считаются по каждой попытке внутри
+            response = await policy.get(aclient, _settings.url, params, governor=governor, endpoint=endpoint)
+        else:
+            try:
+                with metrics.UPSTREAM_LATENCY.time():
+                    response = await aclient.get(_settings.url, params=params)
+            except httpx.HTTPError:
+                metrics.UPSTREAM_RESPONSES.inc(1, 'error')
+                raise
+            metrics.UPSTREAM_RESPONSES.inc(1, str(response.status_code))
         response.raise_for_status()
 
     except httpx.HTTPStatusError as e:
@@ -95,10 +145,14 @@ async def search_sof_questions(aclient: httpx.AsyncClient,
                 logger.warning(f'Tag "{query_tag}": response status_code is not 400!')
             dict_str = response.content.decode("UTF-8")
             mydata: dict = literal_eval(dict_str)
+            if governor:
+                governor.observe(endpoint, mydata)
             sof_code = mydata.get('error_id')
             if sof_code == 502:
                 # 429 Too Many Requests - SOF забанил IP сервера на 24ч скорее всего
                 er_msg = response.json()['error_message']
+                if governor:
+                    governor.ban(er_msg)
                 logger.warning(f'Raising 429 error...')
                 raise UnsuccessfulRequest(f'StackOverflow error: {er_msg}', error_code=429) from e
             else:
@@ -135,12 +189,18 @@ async def search_sof_questions(aclient: httpx.AsyncClient,
         raise UnsuccessfulRequest(e, error_code=500) from e  # 500 Internal Server Error
 
     else:  # no errors
-        logger.debug(f'Tag {query_tag}: request to SOF went good!')
+        logger.trace('Tag {}: request to SOF went good!', query_tag)
         # logger.trace(f'Good request response: {response.json()}')
-        result = response.json()
+        content, filtered = response.content, bool(_settings.api_filter)
+        if offloader and offloader.should_decode(len(content)):  # большой ответ (глубокая страница без фильтра)
+            result = await offloader.run(decode_response, content, filtered=filtered)
+        else:
+            result = decode_response(content, filtered=filtered)
+        if governor:
+            governor.observe(endpoint, result)
 
         items = result['items']  # just additional check
-        if not items:
+        if not items and page == 1:
             msg = f'Tag: {query_tag} - empty response!'
             logger.warning(msg)
             raise UnsuccessfulRequest(msg)
@@ -148,3 +208,97 @@ async def search_sof_questions(aclient: httpx.AsyncClient,
         return result
     # logger.warning(f'Bad request response for tag "{query_tag}"')
     # return None
+
+
+def decode_response(content: bytes, filtered: bool = False) -> dict:
+    """
+    Декодировать ответ StackOverflow, оставив у вопросов только поля, нужные для статистики.
+    orjson разбирает байты напрямую, без промежуточной строки как у response.json()
+    :param content: тело ответа
+    :param filtered: запрос был сделан с api_filter, то есть в ответе уже только нужные поля
+    :return: словарь ответа, где в items у каждого вопроса только tags и is_answered
+    """
+    result: dict = orjson.loads(content)
+    items = result.get('items')
+    if items and not filtered:  # пришли все поля вопросов, лишние не храним
+        result['items'] = [{'tags': q['tags'], 'is_answered': q.get('is_answered', False)}
+                           for q in items if 'tags' in q]
+    return result
+
+
+async def create_filter(aclient: httpx.AsyncClient, _settings: Settings) -> str:
+    """
+    Создать в StackExchange API фильтр, оставляющий в ответе только нужные сервису поля (FILTER_INCLUDE).
+    Фильтры в StackExchange неизменяемые, поэтому его достаточно создать один раз при запуске
+    :param aclient: httpx.AsyncClient object
+    :param _settings: Pydantic модель с настройками приложения
+    :return: строка фильтра или пустая строка, если создать не удалось (тогда используется фильтр по умолчанию)
+    """
+    try:
+        response = await aclient.get(_settings.filter_url,
+                                     params={
+                                         "include": ';'.join(FILTER_INCLUDE),
+                                         "base"   : "none",
+                                         "unsafe" : "false"
+                                     })
+        response.raise_for_status()
+        api_filter = orjson.loads(response.content)['items'][0]['filter']
+    except Exception as e:  # без фильтра сервис работает, просто получает больше данных
+        logger.warning(f'Failed to create StackOverflow filter, using default one: {e.__repr__()}')
+        return ''
+
+    logger.info(f'Created StackOverflow filter "{api_filter}"')
+    return api_filter
+
+
+def create_client(_settings: Settings, limits: httpx.Limits, proxy: str = None) -> httpx.AsyncClient:
+    """
+    Создать httpx.AsyncClient для запросов к StackOverflow: тайм-ауты из настроек, HTTP/2 (если включен и установлен
+    пакет h2 - все запросы идут потоками в нескольких соединениях вместо сотен TCP+TLS соединений), явное сжатие ответа
+    :param _settings: Pydantic модель с настройками приложения
+    :param limits: лимиты пула соединений (уже поделенные между worker'ами)
+    :param proxy: адрес прокси или None
+    :return: клиент, один на все запросы worker'а
+    """
+    http2 = _settings.http2 and HTTP2_AVAILABLE
+    if _settings.http2 and not HTTP2_AVAILABLE:
+        logger.warning('http2 is enabled, but package h2 is not installed (pip install httpx[http2]), using HTTP/1.1')
+
+    timeout = httpx.Timeout(_settings.timeout, connect=_settings.connect_timeout, pool=_settings.pool_timeout)
+    # br заметно компактнее gzip на JSON, но httpx декодирует его только при установленном brotli
+    headers = {'Accept-Encoding': 'br, gzip' if BROTLI_AVAILABLE else 'gzip'}
+    logger.info('Upstream client: {}, Accept-Encoding: {}, timeouts: {}',
+                'HTTP/2' if http2 else 'HTTP/1.1', headers['Accept-Encoding'], timeout)
+
+    if proxy:
+        return httpx.AsyncClient(limits=limits, timeout=timeout, headers=headers, http2=http2, proxy=proxy,
+                                 verify=False)
+    return httpx.AsyncClient(limits=limits, timeout=timeout, headers=headers, http2=http2)
+
+
+async def warm_up(aclient: httpx.AsyncClient, _settings: Settings):
+    """
+    Открыть соединения к StackOverflow при запуске, чтобы первые запросы /search не ждали TCP+TLS рукопожатий.
+    Запрашивается корень хоста, а не API - это не тратит квоту. Ошибки только логируются
+    :param aclient: httpx.AsyncClient object
+    :param _settings: Pydantic модель с настройками приложения
+    """
+    count = _settings.warmup_connections
+    if count <= 0:
+        return
+    if _settings.http2 and HTTP2_AVAILABLE:
+        count = 1  # HTTP/2 - одного соединения достаточно, запросы в нем мультиплексируются
+    root = httpx.URL(_settings.url).copy_with(path='/', query=None)
+
+    async def touch():
+        try:
+            await aclient.head(root)
+        except httpx.HTTPError as e:
+            return e
+
+    start = time.perf_counter()
+    errors = [e for e in await asyncio.gather(*[touch() for _ in range(count)]) if e is not None]
+    if errors:
+        logger.warning('Warm-up of {} connections to {}: {} failed, {!r}', count, root, len(errors), errors[0])
+    else:
+        logger.info('Warmed up {} connections to {} in {:.3f} s', count, root, time.perf_counter() - start)
@@ -0,0 +1,265 @@
+"""
+Устойчивость запросов к StackOverflow: повторы при сетевых ошибках, hedged запросы (второй такой же запрос,
+если первый отвечает дольше обычного) и circuit breaker (пока StackOverflow сбоит, сразу 503 без запроса).
+Каждая лишняя попытка тратит квоту, поэтому проходит через регулятор (token bucket, бан, backoff)
+и делается, только если до резерва квоты еще далеко. Hedged запрос занимает свой слот соединения: если свободного
+нет, hedging пропускается и соединений к StackOverflow не больше max_requests
+"""
+import asyncio
+import random
+import time
+from collections import deque
+
+import httpx
+import loguru
+
+from src import metrics
+from src.admission import AdmissionControl
+from src.governor import QuotaGovernor
+from src.requester import UnsuccessfulRequest
+from src.settings_model import Settings
+
+# повторяются только сбои соединения: запрос GET идемпотентен, а ответ (любой статус) уже получен от StackOverflow.
+# PoolTimeout - перегрузка своего пула, повтор ее только усилит
+RETRY_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.ReadError, httpx.ReadTimeout, httpx.WriteError,
+                httpx.RemoteProtocolError)
+BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}  # значения метрики sof_upstream_breaker_state
+
+
+class LatencyTracker:
+    """ Задержки последних ответов StackOverflow и их перцентиль (пересчитывается не на каждый ответ) """
+
+    def __init__(self, size: int = 200, percentile: float = 0.95, min_samples: int = 20):
+        """
+        :param size: сколько последних задержек хранить
+        :param percentile: перцентиль, от 0 до 1
+        :param min_samples: до стольких замеров перцентиль неизвестен
+        """
+        self.samples: deque[float] = deque(maxlen=size)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self._value: float | None = None
+        self._stale = 0  # замеров с последнего пересчета
+
+    def observe(self, seconds: float):
+        self.samples.append(seconds)
+        self._stale += 1
+
+    def value(self) -> float | None:
+        """ Перцентиль задержки в секундах или None, если замеров мало """
+        if len(self.samples) < self.min_samples:
+            return None
+        if self._value is None or self._stale >= self.min_samples:
+            ordered = sorted(self.samples)
+            self._value = ordered[int(self.percentile * (len(ordered) - 1))]
+            self._stale = 0
+        return self._value
+
+
+class CircuitBreaker:
+    """
+    closed - запросы идут; open - после failures сбоев подряд запросы сразу получают 503;
+    half_open - через reset_timeout пропускается один пробный запрос: успех закрывает breaker, сбой - снова open.
+    Если пробный запрос отменен, следующий пропускается еще через reset_timeout
+    """
+
+    def __init__(self, failures: int = 5, reset_timeout: float = 30):
+        """
+        :param failures: сбоев подряд для открытия, 0 - breaker выключен
+        :param reset_timeout: через сколько секунд пропустить пробный запрос
+        """
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.consecutive = 0  # сбоев подряд
+        self.retry_at = 0.0  # monotonic - когда пропустить следующий пробный запрос
+        self.logger = loguru.logger.bind(object_id='Circuit breaker')
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            self.logger.warning('Circuit breaker {} -> {} ({} failures in a row)', self.state, state, self.consecutive)
+            self.state = state
+            metrics.BREAKER_STATE.set(BREAKER_STATES[state])
+
+    def check(self):
+        """
+        :raises UnsuccessfulRequest: 503, если breaker открыт (или пробный запрос уже идет)
+        """
+        if self.state == 'closed':
+            return
+        now = time.monotonic()
+        if now < self.retry_at:
+            retry_after = max(int(self.retry_at - now), 1)
+            error = UnsuccessfulRequest(f'StackOverflow is failing, circuit breaker is {self.state}, '
+                                        f'next try in {retry_after} seconds', error_code=503)
+            error.headers = {'Retry-After': str(retry_after)}
+            raise error
+        self.retry_at = now + self.reset_timeout  # этот запрос - пробный, следующий не раньше чем через reset_timeout
+        self._set_state('half_open')
+
+    def success(self):
+        self.consecutive = 0
+        self._set_state('closed')
+
+    def failure(self):
+        self.consecutive += 1
+        if self.failures > 0 and (self.state == 'half_open' or self.consecutive >= self.failures):
+            self.retry_at = time.monotonic() + self.reset_timeout
+            self._set_state('open')
+
+    def status(self) -> dict:
+        return {'state': self.state, 'failures': self.consecutive,
+                'retry_in': round(max(self.retry_at - time.monotonic(), 0), 1) if self.state != 'closed' else 0}
+
+
+class UpstreamPolicy:
+    """ Отправка запроса к StackOverflow с повторами, hedging и circuit breaker """
+
+    def __init__(self, retries: int = 2, backoff: float = 0.2, backoff_max: float = 2, hedge: bool = False,
+                 hedge_min_delay: float = 0.2, min_quota: int = 1000, breaker: CircuitBreaker = None,
+                 latency: LatencyTracker = None, admission: AdmissionControl = None):
+        """
+        :param retries: сколько раз повторить запрос при сбое соединения
+        :param backoff: базовая пауза перед повтором в секундах, удваивается с каждым повтором, со случайным jitter
+        :param backoff_max: максимальная пауза перед повтором
+        :param hedge: отправлять второй запрос, если первый не ответил за p95 задержки
+        :param hedge_min_delay: hedged запрос - не раньше чем через столько секунд
+        :param min_quota: повторы и hedged запросы - только если квоты сверх quota_reserve осталось не меньше
+        :param breaker: circuit breaker, None - без него
+        :param latency: задержки ответов для hedging
+        :param admission: слоты соединений - hedged запрос занимает свой слот, None - без учета слотов
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.min_quota = min_quota
+        self.breaker = breaker or CircuitBreaker(failures=0)
+        self.latency = latency or LatencyTracker()
+        self.admission = admission
+        self.logger = loguru.logger.bind(object_id='Upstream policy')
+
+    @classmethod
+    def from_settings(cls, _settings: Settings, admission: AdmissionControl = None) -> 'UpstreamPolicy':
+        return cls(retries=_settings.retries, backoff=_settings.retry_backoff, backoff_max=_settings.retry_backoff_max,
+                   hedge=_settings.hedge, hedge_min_delay=_settings.hedge_min_delay,
+                   min_quota=_settings.extra_attempts_min_quota,
+                   breaker=CircuitBreaker(_settings.breaker_failures, _settings.breaker_reset),
+                   latency=LatencyTracker(percentile=_settings.hedge_percentile), admission=admission)
+
+    def status(self) -> dict:
+        """ Состояние для /diag """
+        delay = self.hedge_delay()
+        return {'breaker': self.breaker.status(), 'hedge_delay': round(delay, 3) if delay is not None else None}
+
+    def check(self):
+        """ :raises UnsuccessfulRequest: 503, если circuit breaker открыт """
+        self.breaker.check()
+
+    def can_spend(self, governor: QuotaGovernor | None) -> bool:
+        """ Можно ли потратить квоту на лишнюю попытку """
+        return governor is None or governor.has_spare_quota(self.min_quota)
+
+    def hedge_delay(self) -> float | None:
+        """ Через сколько секунд без ответа отправлять hedged запрос, None - hedging выключен или замеров мало """
+        latency = self.latency.value() if self.hedge else None
+        return None if latency is None else max(latency, self.hedge_min_delay)
+
+    async def _attempt(self, aclient: httpx.AsyncClient, url: str, params: dict,
+                       governor: QuotaGovernor = None, endpoint: str = None) -> httpx.Response:
+        """ Одна попытка. Если передан governor, сначала ждет его разрешения (для лишних попыток) """
+        if governor is not None:
+            await governor.acquire(endpoint)
+        start = time.perf_counter()
+        try:
+            response = await aclient.get(url, params=params)
+        except httpx.HTTPError:
+            metrics.UPSTREAM_RESPONSES.inc(1, 'error')
+            raise
+        elapsed = time.perf_counter() - start
+        metrics.UPSTREAM_LATENCY.observe(elapsed)
+        metrics.UPSTREAM_RESPONSES.inc(1, str(response.status_code))
+        if response.status_code < 500:
+            self.latency.observe(elapsed)
+        return response
+
+    async def _hedged(self, aclient: httpx.AsyncClient, url: str, params: dict,
+                      governor: QuotaGovernor | None, endpoint: str) -> httpx.Response:
+        """ Попытка с hedged запросом: если первый не ответил за hedge_delay, отправить второй и взять первый ответ """
+        delay = self.hedge_delay()
+        if delay is None or not self.can_spend(governor):
+            return await self._attempt(aclient, url, params)
+
+        first = asyncio.ensure_future(self._attempt(aclient, url, params))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                # свой слот без ожидания: нет свободного - не отправляем, запрос в чужом слоте превысил бы max_requests
+                slot = self.admission.try_acquire() if self.admission is not None else None
+                if self.admission is None or slot is not None:
+                    metrics.UPSTREAM_EXTRA.inc(1, 'hedge')
+                    hedge = asyncio.ensure_future(self._attempt(aclient, url, params, governor, endpoint))
+                    if slot is not None:  # и при отмене до запуска задачи, когда finally в ней не выполняется
+                        hedge.add_done_callback(lambda _: self.admission.release(slot))
+                    tasks.append(hedge)
+                else:
+                    metrics.UPSTREAM_EXTRA.inc(1, 'hedge_skipped')
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            metrics.UPSTREAM_EXTRA.inc(1, 'hedge_won')
+                        return task.result()
+            raise first.exception()  # обе попытки неудачны - ошибка основной (hedged могла упасть на регуляторе)
+        finally:
+            for task in tasks:  # проигравший запрос отменяется - httpx закрывает его соединение / поток HTTP/2
+                if not task.done():
+                    task.cancel()
+
+    async def get(self, aclient: httpx.AsyncClient, url: str, params: dict,
+                  governor: QuotaGovernor = None, endpoint: str = None) -> httpx.Response:
+        """
+        GET запрос к StackOverflow. Разрешение регулятора на первую попытку и breaker (check) проверяются до вызова
+        :param aclient: httpx клиент
+        :param url: адрес
+        :param params: параметры запроса
+        :param governor: регулятор квоты и частоты - через него проходят повторы и hedged запросы
+        :param endpoint: путь метода StackOverflow API для регулятора
+        :return: ответ с любым статусом
+        :raises httpx.HTTPError: сбой соединения после всех повторов (для circuit breaker - один сбой)
+        """
+        attempt = 0
+        while True:
+            try:
+                response = await self._hedged(aclient, url, params, governor, endpoint)
+            except RETRY_ERRORS as e:
+                # breaker считает вызовы, а не попытки: сбой - один, когда повторов больше не будет
+                if attempt >= self.retries or self.breaker.state == 'open' or not self.can_spend(governor):
+                    self.breaker.failure()
+                    raise
+                attempt += 1
+                # full jitter: одновременно упавшие запросы не повторяются одной волной
+                delay = random.uniform(0, min(self.backoff * 2 ** (attempt - 1), self.backoff_max))
+                self.logger.debug('Retry {} of {} in {:.3f} s after {!r}', attempt, self.retries, delay, e)
+                metrics.UPSTREAM_EXTRA.inc(1, 'retry')
+                await asyncio.sleep(delay)
+                try:
+                    if governor is not None:
+                        await governor.acquire(endpoint)
+                except UnsuccessfulRequest:  # квота / бан / backoff - повтор не делаем, отдаем исходную ошибку
+                    self.breaker.failure()
+                    raise e
+                continue
+            except httpx.HTTPError:
+                self.breaker.failure()
+                raise
+
+            if response.status_code >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            return response
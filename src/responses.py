@@ -0,0 +1,90 @@
+"""
+Ответы API со статистикой: формат выбирается по заголовку Accept, сжатие - по Accept-Encoding.
+Человекочитаемый JSON - только для браузера и Swagger, остальным компактный JSON или MessagePack.
+msgpack и zstandard есть в requirements.txt, но импортируются необязательно: без них эти форматы не предлагаются
+"""
+import gzip
+from typing import Any
+
+import orjson
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MSGPACK_TYPES = ('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack')
+
+
+# noinspection PyPep8
+class ORJSONPrettyResponse(JSONResponse):
+    """
+    Класс для возврата FastAPI Response JSON с человекочитаемым форматированием
+    """
+
+    def render(self, content: Any) -> bytes:
+        """
+        Вернуть ответ от orjson.dumps с человекочитаемым форматированием
+        """
+        return orjson.dumps(
+            content,
+            option=orjson.OPT_NON_STR_KEYS
+                   | orjson.OPT_SERIALIZE_NUMPY
+                   | orjson.OPT_INDENT_2,
+        )
+
+
+def accepted_encodings(header: str) -> set[str]:
+    """ 'gzip, br;q=0.5, zstd;q=0' -> {'gzip', 'br'} - кодировки из Accept-Encoding, кроме запрещенных q=0 """
+    encodings = set()
+    for part in header.lower().split(','):
+        name, _, params = part.partition(';')
+        name, params = name.strip(), params.replace(' ', '')
+        if name and params not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            encodings.add(name)
+    return encodings
+
+
+def wants_pretty(request: Request) -> bool:
+    """ Человекочитаемый JSON: браузер (Accept с text/html), Swagger (/docs в Referer) или параметр pretty=true """
+    if request.query_params.get('pretty', '').lower() in ('1', 'true'):
+        return True
+    if 'text/html' in request.headers.get('accept', ''):
+        return True
+    return request.headers.get('referer', '').split('?')[0].rstrip('/').endswith('/docs')
+
+
+def stats_response(request: Request, content: Any, compress_min_size: int = 1024) -> Response:
+    """
+    Ответ со статистикой в формате, который просит клиент
+    :param request: входящий запрос (заголовки Accept, Accept-Encoding, Referer)
+    :param content: данные ответа
+    :param compress_min_size: сжимать ответ от такого размера в байтах, 0 - не сжимать
+    :return: MessagePack, компактный или человекочитаемый JSON, сжатый zstd / gzip, если клиент их принимает
+    """
+    accept = request.headers.get('accept', '')
+    if msgpack is not None and any(media_type in accept for media_type in MSGPACK_TYPES):
+        body, media_type = msgpack.packb(content), 'application/msgpack'
+    elif wants_pretty(request):
+        body, media_type = ORJSONPrettyResponse(content).body, 'application/json'
+    else:
+        body, media_type = orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS), 'application/json'
+
+    headers = {'Vary': 'Accept, Accept-Encoding'}  # для кэширующих прокси: ответ зависит от этих заголовков
+    if 0 < compress_min_size <= len(body):
+        encodings = accepted_encodings(request.headers.get('accept-encoding', ''))
+        if zstandard is not None and 'zstd' in encodings:
+            body = zstandard.ZstdCompressor(level=3).compress(body)
+            headers['Content-Encoding'] = 'zstd'
+        elif 'gzip' in encodings:
+            body = gzip.compress(body, compresslevel=5)  # выше 5 почти не сжимает лучше, но заметно дольше
+            headers['Content-Encoding'] = 'gzip'
+
+    return Response(body, media_type=media_type, headers=headers)
@@ -23,6 +23,10 @@ class Settings(BaseModel):
     self_api_host: str = '0.0.0.0'  # адрес для FastAPI сервера
     env_mode: str = 'TEST'  # среда в которой запускается проект
     stop_delay: int = 5  # задержка перед закрытием
+    workers: int = 1  # количество worker процессов uvicorn, лимиты network делятся между ними
+    # подсчет статистики: python, numpy (векторизованный, нужен пакет numpy) или auto - numpy на больших объемах
+    aggregation_engine: str = 'auto'
+    compress_min_size: int = 1024  # сжимать ответы (zstd / gzip по Accept-Encoding) от такого размера в байтах, 0 - нет
 
     # logger - настройки логгера
     # уровень логирования. По умолчанию: TRACE если env_mode TEST, иначе DEBUG
@@ -31,16 +35,77 @@ class Settings(BaseModel):
     console_lvl: str = 'DEBUG'  # уровень логирования в консоль, по умолчанию DEBUG
     rotation_size: str = "500 MB"  # размер в МБ для начала ротации - то есть замены записываемого файла
     retention_time: int = 5  # время в днях до начала ротации
+    # писать логи через очередь в отдельном потоке: запись не блокирует event loop, но каждая запись сериализуется
+    log_enqueue: bool = True
+    log_sample_rate: float = 1.0  # доля запросов с подробными логами (входящий запрос, время, успех), 1 - все
+    log_summary_interval: int = 60  # период сводки по всем запросам в логах в секундах, 0 - без сводки
 
     # network
     max_requests: int = 1000  # максимальное количество запросов к stackoverflow
     max_alive_requests: int = 1000  # максимальное количество активных (keep-alive) запросов к stackoverflow
     keep_alive: int = 15  # время в секундах для keep-alive
-    timeout: int = 10  # тайм-аут в секундах для запросов к stackoverflow
+    timeout: int = 10  # тайм-аут в секундах для запросов к stackoverflow (чтение ответа и отправка запроса)
+    connect_timeout: float = 5  # тайм-аут в секундах на установку соединения к stackoverflow
+    pool_timeout: float = 10  # сколько секунд ждать свободного соединения в пуле httpx
+    http2: bool = True  # HTTP/2 к stackoverflow (запросы мультиплексируются), нужен пакет h2, без него HTTP/1.1
+    warmup_connections: int = 4  # сколько соединений к stackoverflow открыть при запуске, 0 - не прогревать
+    max_queue: int = 2000  # сколько запросов к stackoverflow может ждать свободного слота, остальным сразу 503
+    queue_timeout: float = 5  # сколько секунд запрос может ждать свободного слота, дольше - 503, 0 - без ограничения
+    retry_after: int = 1  # заголовок Retry-After в ответе 503 при перегрузке, секунды
+    # справедливая очередь к слотам: клиент - IP. Имя заголовка (например X-Client-Id) - только за доверенным шлюзом,
+    # который его выставляет сам, иначе клиент может назваться кем угодно
+    client_header: str = ''
+    client_max_slots: int = 0  # сколько слотов может занять один клиент одновременно, 0 - без ограничения
+    client_weights: dict[str, float] = dict()  # клиент -> вес (доля слотов при конкуренции), остальные - 1
+    rate_limit: float = 25  # средняя частота запросов к stackoverflow в секунду (API допускает 30), 0 - без ограничения
+    rate_burst: int = 30  # сколько запросов к stackoverflow можно отправить подряд без ожидания
+    quota_reserve: int = 10  # сколько запросов дневной квоты stackoverflow не тратить (дальше сразу 429)
+    max_backoff_wait: int = 10  # максимальное ожидание в секундах по полю backoff, дольше - сразу 429
+    retries: int = 2  # сколько раз повторить запрос к stackoverflow при сбое соединения (не при ошибке в ответе)
+    retry_backoff: float = 0.2  # базовая пауза перед повтором в секундах, удваивается, со случайным jitter
+    retry_backoff_max: float = 2  # максимальная пауза перед повтором в секундах
+    hedge: bool = False  # второй такой же запрос, если первый не ответил за hedge_percentile задержки (тратит квоту)
+    hedge_percentile: float = 0.95  # перцентиль задержки ответов stackoverflow, после которого отправлять второй
+    hedge_min_delay: float = 0.2  # второй запрос - не раньше чем через столько секунд
+    extra_attempts_min_quota: int = 1000  # повторы и hedging - только пока квоты сверх quota_reserve не меньше
+    breaker_failures: int = 5  # сбоев stackoverflow подряд, после которых сразу 503 без запроса, 0 - без breaker
+    breaker_reset: float = 30  # через сколько секунд после открытия breaker пропустить пробный запрос
+
+    # cache - кэш частичных статистик по тегам
+    cache_ttl: int = 300  # время жизни записи кэша в секундах, 0 - не кэшировать (одновременные запросы объединяются)
+    cache_max_size: int = 10000  # максимальное количество тегов в кэше (LRU вытеснение)
+    # хранилище, общее для worker процессов (кэш и квота stackoverflow): memory - только свой процесс, sqlite - файл
+    store_backend: str = 'memory'
+    store_path: str = 'data/sof_stats.db'  # путь к файлу SQLite для store_backend = sqlite
+    # сколько секунд ждать блокировку записи SQLite другого worker'а - ожидание блокирует event loop. Дальше - промах
+    # кэша или пропущенная запись
+    store_busy_timeout: float = 0.05
+    # снимок кэша на диске для быстрого старта после перезапуска, пусто - без снимков (в docker - volume на data/)
+    snapshot_path: str = 'data/tag_stats.snap'
+    snapshot_interval: int = 60  # период записи снимка в секундах, 0 - только при остановке
+
+    # refresh - фоновое обновление популярных тегов
+    hot_tags: int = 50  # сколько самых запрашиваемых тегов обновлять заранее, 0 - не обновлять
+    refresh_interval: int = 30  # период проверки популярных тегов в секундах
+    refresh_ahead: int = 60  # обновлять тег, если его запись в кэше устареет раньше, чем через столько секунд
+
+    # offload - тяжелая CPU работа вне event loop
+    executor: str = 'thread'  # пул для разбора больших ответов и сложения статистик: none, thread или process
+    executor_workers: int = 2  # размер пула
+    offload_min_bytes: int = 262144  # разбирать в пуле ответы StackOverflow от такого размера в байтах
+    offload_min_tags: int = 20000  # складывать в пуле статистики от стольких тегов во всех частях вместе
+    loop_lag_interval: float = 0.5  # период замера задержки event loop в секундах, 0 - не замерять
 
     # stackoverflow - вынесены в настройки с предположением что они будут изменяться в будущем
     url: str = "https://api.stackexchange.com/2.3/search"  # url-адрес для запросов к stackoverflow
-    pagesize: int = 100  # кол-во вопросов по тегу
+    pagesize: int = 100  # кол-во вопросов по тегу на одной странице
+    max_pages: int = 10  # максимальное кол-во страниц по тегу в параметре pages /search
+    max_batch_groups: int = 100  # максимальное кол-во групп тегов в одном запросе /search/batch
+    max_tags: int = 100  # максимальное кол-во разных тегов в одном запросе (у /search/batch - во всех группах)
+    max_fetches: int = 500  # максимальное кол-во страниц в одном запросе: разные теги x pages
     order: str = "desc"  # порядок
     sort: str = "creation"  # сортировка
     site: str = "stackoverflow"  # название внутреннего домена для поиска
+    # фильтр ответа StackOverflow (только нужные поля). Пусто - создать при запуске через filter_url
+    api_filter: str = ''
+    filter_url: str = "https://api.stackexchange.com/2.3/filters/create"  # url-адрес для создания фильтра
@@ -0,0 +1,207 @@
+"""
+Снимок кэша статистики по тегам на диске - чтобы после перезапуска (деплоя) не запрашивать у StackOverflow
+все теги заново и не тратить квоту. Раз в snapshot_interval секунд и при остановке записи кэша пишутся в файл,
+при запуске файл открывается через mmap и разбирается лениво: сразу читается только индекс (ключи и времена),
+статистика тега декодируется при первом промахе кэша по нему.
+
+Формат: MAGIC, затем записи подряд - заголовок RECORD (fetched_at, expires_at - unix time, длины ключа и данных),
+ключ (store_key) в UTF-8 и TagStats.dumps(). Файл заменяется атомарно (временный файл + os.replace), записи других
+worker'ов из старого файла, которых нет в своем кэше, переносятся в новый без декодирования
+"""
+import asyncio
+import mmap
+import os
+import struct
+import time
+from typing import Hashable, Iterable
+
+import loguru
+
+from src.data_extractor import TagStats
+from src.settings_model import Settings
+from src.store import store_key
+
+MAGIC = b'SOFSNAP1'
+RECORD = struct.Struct('<ddII')  # fetched_at, expires_at, длина ключа, длина данных
+
+
+class SnapshotError(Exception):
+    """ Snapshot file is damaged or has unknown format """
+    pass
+
+
+class TagSnapshot:
+    """ Файл снимка: ленивое чтение записей и атомарная перезапись """
+
+    def __init__(self, path: str, ttl: float):
+        """
+        :param path: путь к файлу снимка, папка создается при необходимости
+        :param ttl: текущее время жизни записей кэша - запись из снимка действительна не дольше fetched_at + ttl,
+        даже если при записи снимка TTL был больше
+        """
+        self.path = path
+        self.ttl = ttl
+        self._map: mmap.mmap | None = None
+        self._index: dict[str, tuple[float, float, int, int]] = dict()  # key: (fetched_at, expires_at, offset, size)
+        self.loaded = 0  # сколько записей отдано в кэш
+        self._discarded: set[str] = set()  # ключи удаленных записей - не переносить их из старого файла при записи
+        self.logger = loguru.logger.bind(object_id='Snapshot')
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    @classmethod
+    def from_settings(cls, _settings: Settings) -> 'TagSnapshot | None':
+        """ Снимок по настройкам, None - снимки выключены (snapshot_path пустой или кэш выключен) """
+        if not _settings.snapshot_path or _settings.cache_ttl <= 0:
+            return None
+        return cls(_settings.snapshot_path, _settings.cache_ttl)
+
+    def open(self):
+        """ Открыть файл и прочитать индекс. Отсутствующий или поврежденный файл - пустой снимок, не ошибка """
+        self.close()
+        try:
+            with open(self.path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size <= len(MAGIC):
+                    return
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)  # после close файла mmap остается
+            self._index = self._read_index(self._map)
+        except FileNotFoundError:
+            self.logger.info('No snapshot at {}, starting with empty cache', self.path)
+        except (OSError, SnapshotError) as e:
+            self.logger.warning('Can not read snapshot {}: {}. Starting with empty cache', self.path, e)
+            self.close()
+        else:
+            self.logger.info('Opened snapshot {}: {} entries', self.path, len(self._index))
+
+    @staticmethod
+    def _read_index(data: mmap.mmap) -> dict[str, tuple[float, float, int, int]]:
+        """ Пройти по заголовкам записей, не декодируя статистику """
+        if data[:len(MAGIC)] != MAGIC:
+            raise SnapshotError('unknown format')
+        index, offset, end = dict(), len(MAGIC), len(data)
+        while offset < end:
+            if offset + RECORD.size > end:
+                raise SnapshotError(f'truncated record at {offset}')
+            fetched_at, expires_at, key_size, size = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            if offset + key_size + size > end:
+                raise SnapshotError(f'truncated record at {offset}')
+            key = data[offset:offset + key_size].decode()
+            offset += key_size
+            index[key] = (fetched_at, expires_at, offset, size)
+            offset += size
+        return index
+
+    def close(self):
+        self._index = dict()
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def get(self, key: Hashable) -> tuple[TagStats, float] | None:
+        """
+        Статистика из снимка, если она еще действительна
+        :param key: ключ кэша
+        :return: (статистика, unix time устаревания) или None
+        """
+        entry = self._index.get(store_key(key))
+        if entry is None:
+            return None
+        fetched_at, expires_at, offset, size = entry
+        expires_at = min(expires_at, fetched_at + self.ttl)
+        if expires_at <= time.time():
+            return None
+        try:
+            stats = TagStats.loads(self._map[offset:offset + size])
+        except ValueError as e:  # orjson.JSONDecodeError, неверная структура
+            self.logger.warning('Damaged snapshot entry {}: {}', key, e)
+            return None
+        finally:
+            self._index.pop(store_key(key), None)  # в кэш попадает один раз, дальше живет там
+        self.loaded += 1
+        return stats, expires_at
+
+    def discard(self, key: Hashable):
+        """ Удалить запись: она не отдается в кэш и не переносится в следующий снимок """
+        key = store_key(key)
+        self._index.pop(key, None)
+        self._discarded.add(key)
+
+    def write(self, entries: Iterable[tuple[Hashable, float, float, TagStats]]):
+        """
+        Атомарно записать снимок: свои записи и еще действительные записи старого файла, которых среди своих нет
+        (их мог записать другой worker). Синхронный - вызывается в отдельном потоке (save)
+        :param entries: (ключ кэша, fetched_at, expires_at, статистика)
+        """
+        folder = os.path.dirname(self.path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        now, written, discarded = time.time(), set(), set(self._discarded)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            for key, fetched_at, expires_at, stats in entries:
+                key = store_key(key)
+                data, key_bytes = stats.dumps(), key.encode()
+                f.write(RECORD.pack(fetched_at, expires_at, len(key_bytes), len(data)) + key_bytes + data)
+                written.add(key)
+            try:
+                with open(self.path, 'rb') as old_file, mmap.mmap(old_file.fileno(), 0, access=mmap.ACCESS_READ) as old:
+                    for key, (fetched_at, expires_at, offset, size) in self._read_index(old).items():
+                        if key not in written and key not in discarded and min(expires_at, fetched_at + self.ttl) > now:
+                            key_bytes = key.encode()
+                            f.write(RECORD.pack(fetched_at, expires_at, len(key_bytes), size) + key_bytes
+                                    + old[offset:offset + size])
+                            written.add(key)
+            except (OSError, ValueError, SnapshotError):  # нет старого файла, он пустой или поврежден
+                pass
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._discarded -= discarded  # в новом файле их уже нет
+        self.logger.debug('Snapshot {} written: {} entries', self.path, len(written))
+
+
+class SnapshotWriter:
+    """ Периодическая запись снимка кэша в фоне и последняя запись при остановке """
+
+    def __init__(self, snapshot: TagSnapshot, cache, interval: float = 60):
+        """
+        :param snapshot: файл снимка
+        :param cache: TagCache, записи которого сохраняются
+        :param interval: период записи в секундах, 0 - только при остановке
+        """
+        self.snapshot = snapshot
+        self.cache = cache
+        self.interval = interval
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """ Остановить периодическую запись и записать снимок последний раз """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.save()
+
+    async def save(self):
+        """ Записать снимок. Записи кэша собираются в event loop, сериализация и запись на диск - в потоке """
+        entries = list(self.cache.entries())
+        try:
+            await asyncio.to_thread(self.snapshot.write, entries)
+        except OSError as e:
+            self.snapshot.logger.error('Can not write snapshot {}: {}', self.snapshot.path, e)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.save()
@@ -0,0 +1,188 @@
+"""
+Хранилище, общее для worker процессов: статистика по тегам и состояние квоты / бана StackOverflow.
+Без него при N worker'ах каждый ходит в StackOverflow сам и каждый отдельно узнает о бане.
+memory - без общего хранилища (один worker: кэш TagCache и квота регулятора и так в памяти процесса),
+sqlite - локальный файл SQLite в режиме WAL (несколько worker'ов).
+Вызовы синхронные и идут из event loop, поэтому ожидание блокировки записи короткое (store_busy_timeout), а занятая
+или сбойная база - промах кэша или пропущенная запись, а не остановка всего worker'а
+"""
+import abc
+import os
+import sqlite3
+import time
+from typing import Hashable
+
+import loguru
+
+from src import metrics
+from src.data_extractor import TagStats
+from src.settings_model import Settings
+
+
+class StoreError(Exception):
+    """ Wrong store configuration """
+    pass
+
+
+def store_key(key: Hashable) -> str:
+    """ Строковый ключ для хранилища из ключа кэша (кортежа) """
+    if isinstance(key, tuple):
+        return '|'.join(str(part) for part in key)
+    return str(key)
+
+
+class StatsStore(abc.ABC):
+    """
+    Интерфейс хранилища. Времена (expires_at, until) - unix time, т.к. monotonic у каждого процесса свой.
+    Методы синхронные: реализация локальная и отвечает за микросекунды. Ошибки хранилища не выходят наружу -
+    чтение возвращает "нет данных", запись пропускается
+    """
+
+    @abc.abstractmethod
+    def get_stats(self, key: Hashable) -> tuple[TagStats, float] | None:
+        """
+        :param key: ключ кэша
+        :return: (статистика, unix time устаревания) или None
+        """
+
+    @abc.abstractmethod
+    def put_stats(self, key: Hashable, stats: TagStats, expires_at: float):
+        """
+        :param key: ключ кэша
+        :param stats: статистика
+        :param expires_at: unix time устаревания
+        """
+
+    @abc.abstractmethod
+    def delete_stats(self, key: Hashable):
+        """
+        :param key: ключ кэша, отсутствующий - не ошибка
+        """
+
+    @abc.abstractmethod
+    def get_quota(self) -> tuple[int, int, float] | None:
+        """ :return: (quota_remaining, quota_max, unix time обновления) или None """
+
+    @abc.abstractmethod
+    def put_quota(self, quota_remaining: int, quota_max: int | None):
+        """ Сохранить последнюю известную квоту """
+
+    @abc.abstractmethod
+    def get_until(self, name: str) -> float:
+        """
+        :param name: 'ban' или 'backoff:<endpoint>'
+        :return: unix time окончания бана / backoff, 0 - если нет
+        """
+
+    @abc.abstractmethod
+    def put_until(self, name: str, until: float):
+        """ Продлить бан / backoff до until (более ранний срок не перезаписывает более поздний) """
+
+    def close(self):
+        """ Освободить ресурсы """
+        pass
+
+
+class SQLiteStore(StatsStore):
+    """ Локальный файл SQLite в режиме WAL - общий для всех worker процессов на одной машине """
+
+    def __init__(self, path: str, busy_timeout: float = 0.05):
+        """
+        :param path: путь к файлу базы, папка создается при необходимости
+        :param busy_timeout: сколько секунд ждать блокировку записи другого worker'а, дальше - OperationalError
+        """
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+        # autocommit, WAL - читатели не блокируют писателя и наоборот. При создании базы (при старте, не в event loop
+        # обработки запросов) ждем дольше, потом - не больше busy_timeout
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False, timeout=5)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')  # для кэша потеря последних записей при сбое не страшна
+        self.conn.execute('CREATE TABLE IF NOT EXISTS stats '
+                          '(key TEXT PRIMARY KEY, expires_at REAL NOT NULL, data BLOB NOT NULL)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS upstream '
+                          '(name TEXT PRIMARY KEY, value REAL NOT NULL, extra REAL, updated_at REAL NOT NULL)')
+        self.conn.execute(f'PRAGMA busy_timeout = {int(busy_timeout * 1000)}')
+        self._puts = 0
+        self.errors = 0  # вызовов, пропущенных из-за занятой или сбойной базы
+        self.logger = loguru.logger.bind(object_id='Store')
+        self.logger.info(f'Using shared SQLite store {path}')
+
+    def _failed(self, op: str, sql: str, e: sqlite3.Error):
+        self.errors += 1
+        metrics.STORE_ERRORS.inc(1, op)
+        if self.errors % 100 == 1:  # при долгой конкуренции за базу - не строка на каждый вызов
+            self.logger.warning('SQLite store {} skipped ({} so far): {!r} in "{}"', op, self.errors, e, sql)
+
+    def _read(self, sql: str, params: tuple = ()) -> tuple | None:
+        """ Первая строка запроса или None, если ее нет или база занята / сбоит (для кэша - промах) """
+        try:
+            return self.conn.execute(sql, params).fetchone()
+        except sqlite3.OperationalError as e:
+            self._failed('read', sql, e)
+            return None
+
+    def _write(self, sql: str, params: tuple = ()):
+        """ Выполнить запись. Занятая / сбойная база - запись пропускается: это кэш и подсказки о квоте """
+        try:
+            self.conn.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            self._failed('write', sql, e)
+
+    def get_stats(self, key: Hashable) -> tuple[TagStats, float] | None:
+        row = self._read('SELECT data, expires_at FROM stats WHERE key = ?', (store_key(key),))
+        if row is None:
+            return None
+        return TagStats.loads(row[0]), row[1]
+
+    def put_stats(self, key: Hashable, stats: TagStats, expires_at: float):
+        self._write('INSERT OR REPLACE INTO stats (key, expires_at, data) VALUES (?, ?, ?)',
+                    (store_key(key), expires_at, stats.dumps()))
+        self._puts += 1
+        if self._puts % 1000 == 0:  # время от времени чистим давно устаревшее
+            self._write('DELETE FROM stats WHERE expires_at < ?', (time.time() - 86400,))
+
+    def delete_stats(self, key: Hashable):
+        self._write('DELETE FROM stats WHERE key = ?', (store_key(key),))
+
+    def get_quota(self) -> tuple[int, int, float] | None:
+        row = self._read("SELECT value, extra, updated_at FROM upstream WHERE name = 'quota'")
+        if row is None:
+            return None
+        return int(row[0]), int(row[1]) if row[1] is not None else None, row[2]
+
+    def put_quota(self, quota_remaining: int, quota_max: int | None):
+        self._write("INSERT OR REPLACE INTO upstream (name, value, extra, updated_at) VALUES ('quota', ?, ?, ?)",
+                    (quota_remaining, quota_max, time.time()))
+
+    def get_until(self, name: str) -> float:
+        row = self._read('SELECT value FROM upstream WHERE name = ?', (name,))
+        return row[0] if row else 0
+
+    def put_until(self, name: str, until: float):
+        self._write('INSERT INTO upstream (name, value, updated_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value), '
+                    'updated_at = excluded.updated_at',
+                    (name, until, time.time()))
+
+    def close(self):
+        self.conn.close()
+
+
+def create_store(_settings: Settings) -> StatsStore | None:
+    """
+    Создать хранилище по настройке store_backend
+    :param _settings: Pydantic модель с настройками приложения
+    :return: экземпляр хранилища или None для memory - второй копии кэша в памяти того же процесса не нужно,
+    кэш ограничен по размеру и TTL в TagCache
+    """
+    if _settings.store_backend == 'memory':
+        if _settings.workers > 1:
+            loguru.logger.bind(object_id='Store').warning(f'{_settings.workers} workers with memory store: '
+                                                          f'cache and quota are not shared between them!')
+        return None
+    if _settings.store_backend == 'sqlite':
+        return SQLiteStore(_settings.store_path, busy_timeout=_settings.store_busy_timeout)
+    raise StoreError(f'Unknown store_backend "{_settings.store_backend}", expected "memory" or "sqlite"')
@@ -0,0 +1,111 @@
+"""
+Векторизованное (NumPy) сложение статистик по тегам - для больших объемов: глубокая пагинация, много тегов.
+Теги переводятся в целочисленные id общего словаря процесса, у каждой частичной статистики один раз строятся массивы
+(id, total, answered), дальше они лежат в ней же - статистики из кэша переиспользуются между запросами.
+Сложение - np.concatenate + np.bincount без цикла Python, в словарь ответа переводятся только итоговые теги.
+На нескольких статистиках накладные расходы NumPy больше выигрыша, поэтому в режиме auto он используется
+только от AUTO_MIN_ITEMS тегов во всех статистиках вместе (замеры - bench/bench_aggregation.py).
+numpy есть в requirements.txt, но импортируется необязательно: без него всегда обычное сложение на Python
+"""
+import threading
+from operator import itemgetter
+from typing import TYPE_CHECKING, Iterable
+
+import loguru
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+if TYPE_CHECKING:  # data_extractor.py сам импортирует этот модуль
+    from src.data_extractor import TagStats
+
+ENGINES = ('python', 'numpy', 'auto')
+AUTO_MIN_ITEMS = 20000  # от стольких тегов во всех складываемых статистиках auto выбирает numpy
+
+
+class TagVocabulary:
+    """
+    Словарь тег -> id, общий для процесса. Только растет: тегов у StackOverflow порядка десятков тысяч,
+    а в словарь попадают только теги из ответов StackOverflow, не из запросов клиентов
+    """
+
+    def __init__(self):
+        self.ids: dict[str, int] = dict()
+        self.names: list[str] = list()
+        self._lock = threading.Lock()  # новые теги могут добавляться из пула потоков
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _add(self, tag: str) -> int:
+        with self._lock:
+            tag_id = self.ids.get(tag)
+            if tag_id is None:
+                tag_id = self.ids[tag] = len(self.names)
+                self.names.append(tag)
+            return tag_id
+
+    def intern(self, tags: Iterable[str]) -> 'np.ndarray':
+        """ id тегов, новые теги добавляются в словарь """
+        ids = self.ids
+        return np.array([ids[tag] if tag in ids else self._add(tag) for tag in tags], dtype=np.intp)
+
+
+VOCABULARY = TagVocabulary()
+
+
+def resolve_engine(engine: str) -> str:
+    """
+    Проверить настройку aggregation_engine
+    :param engine: python, numpy или auto
+    :return: движок, который реально будет использоваться (без numpy - всегда python)
+    """
+    if engine not in ENGINES:
+        raise ValueError(f'Unknown aggregation_engine "{engine}", expected one of {ENGINES}')
+    if engine != 'python' and np is None:
+        if engine == 'numpy':
+            loguru.logger.bind(object_id='Vector engine').warning('aggregation_engine is numpy, but numpy is not '
+                                                                  'installed, using python')
+        return 'python'
+    return engine
+
+
+def use_numpy(engine: str, items: int) -> bool:
+    """ Складывать ли NumPy статистики с items тегами в сумме при движке engine (уже проверенном resolve_engine) """
+    return engine == 'numpy' or (engine == 'auto' and items >= AUTO_MIN_ITEMS)
+
+
+def as_arrays(stats: 'TagStats') -> tuple:
+    """
+    Массивы (id тегов, total, answered) частичной статистики. Строятся один раз и хранятся в ней же,
+    TagStats сбрасывает их при изменении
+    """
+    if stats.arrays is None:
+        values = list(stats.counts.values())
+        stats.arrays = (VOCABULARY.intern(stats.counts),
+                        np.fromiter(map(itemgetter(0), values), dtype=np.float64, count=len(values)),
+                        np.fromiter(map(itemgetter(1), values), dtype=np.float64, count=len(values)))
+    return stats.arrays
+
+
+def merge_counts(partials: Iterable['TagStats']) -> dict[str, list[int]]:
+    """
+    Сложить счетчики частичных статистик
+    :param partials: частичные статистики
+    :return: tag -> [total, answered], теги в порядке их id (а не первого появления, как у сложения на Python)
+    """
+    arrays = [as_arrays(partial) for partial in partials if partial.counts]
+    if not arrays:
+        return dict()
+    ids = np.concatenate([item[0] for item in arrays])
+    size = len(VOCABULARY)
+    totals = np.bincount(ids, weights=np.concatenate([item[1] for item in arrays]), minlength=size)
+    answered = np.bincount(ids, weights=np.concatenate([item[2] for item in arrays]), minlength=size)
+
+    present = np.flatnonzero(totals)
+    names = VOCABULARY.names
+    totals = totals[present].astype(np.int64).tolist()
+    answered = answered[present].astype(np.int64).tolist()
+    return {names[tag_id]: [total, answer] for tag_id, total, answer in zip(present.tolist(), totals, answered)}
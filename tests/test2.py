@@ -59,4 +59,1001 @@ def event_loop():
 
     res._close()
 
+
+@pytest.fixture
+def fake_sof(monkeypatch):
+    """
+    Фабрика TestClient сервиса, у которого вместо StackOverflow - handler(tag, page) (может быть async).
+    handler возвращает тело ответа StackOverflow (dict) или httpx.Response, либо бросает httpx.HTTPError.
+    Остальные запросы (создание фильтра, прогрев соединений) получают 404
+    """
+    import httpx
+    from fastapi.testclient import TestClient
+
+    import src.app_state
+    from run_sof_stats import normal_app
+
+    def factory(handler, **overrides) -> TestClient:
+        async def transport(request: httpx.Request) -> httpx.Response:
+            if 'intitle' not in request.url.params:
+                return httpx.Response(404)
+            result = handler(request.url.params['intitle'], int(request.url.params.get('page', 1)))
+            if asyncio.iscoroutine(result):
+                result = await result
+            return result if isinstance(result, httpx.Response) else httpx.Response(200, json=result)
+
+        monkeypatch.setattr(src.app_state, 'create_client',
+                            lambda *args, **kwargs: httpx.AsyncClient(transport=httpx.MockTransport(transport)))
+        options = {'version': 'test', 'api_filter': 'test', 'warmup_connections': 0, 'stop_delay': 0,
+                   'snapshot_path': '', 'hot_tags': 0, 'log_sample_rate': 0, **overrides}
+        return TestClient(normal_app(Settings(**options)))
+
+    return factory
+
+
+def sof_page(tag: str, count: int, has_more: bool = True, *other: str) -> dict:
+    """ Тело ответа StackOverflow: count вопросов с тегами tag и other, половина с ответом """
+    items = [{'tags': [tag, *other], 'is_answered': i % 2 == 0} for i in range(count)]
+    return {'items': items, 'has_more': has_more, 'quota_max': 10000, 'quota_remaining': 9000}
+
+# endregion
+
+
+# region Cache
+
+def test_cache_coalesces_concurrent_misses():
+    """ Одновременные промахи по одному ключу - один запрос к источнику """
+    from src.cache import TagCache
+
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {'items': [1]}
+
+    async def run():
+        cache = TagCache(ttl=60, max_size=10)
+        results = await asyncio.gather(*[cache.get_or_fetch('python', fetch) for _ in range(5)])
+        assert all(r == {'items': [1]} for r in results)
+        assert await cache.get_or_fetch('python', fetch) == {'items': [1]}  # hit
+        assert cache.hits == 1
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_cache_lru_and_ttl():
+    """ Вытеснение самой давно использованной записи и отключение хранения при ttl 0 """
+    from src.cache import TagCache
+
+    cache = TagCache(ttl=60, max_size=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1  # 'b' теперь самая давно использованная
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+
+    no_store = TagCache(ttl=0, max_size=2)
+    no_store.put('a', 1)
+    assert no_store.get('a') is None
+
+# endregion
+
+
+# region Data extractor
+
+def test_extract_info_merges_partials():
+    """ Частичные статистики по тегам складываются без повторного прохода по вопросам """
+    from src.data_extractor import count_questions, extract_info
+
+    python = count_questions({'items': [{'tags': ['python', 'django'], 'is_answered': True},
+                                        {'tags': ['python'], 'is_answered': False},
+                                        {'title': 'no tags - skipped'}]})
+    django = count_questions({'items': [{'tags': ['django'], 'is_answered': True}]})
+    assert python.questions == 2
+
+    stats = asyncio.run(extract_info([python, django]))
+    assert stats == {'python': {'total': 2, 'answered': 1}, 'django': {'total': 2, 'answered': 2}}
+    assert python.counts['django'] == [1, 1]  # части из кэша не изменяются при сложении
+
+# endregion
+
+
+# region Requester
+
+def test_decode_response_keeps_only_needed_fields(fake_sof):
+    """ Ответ без api_filter (фильтр не создан) - у вопросов остаются только tags и is_answered """
+    import orjson
+    from src.requester import decode_response
+
+    full = {'items': [{'tags': ['python'], 'is_answered': True, 'title': 'x' * 100, 'owner': {'name': 'a'},
+                       'creation_date': 1},
+                      {'tags': ['go']},
+                      {'title': 'no tags - skipped'}],
+            'has_more': False, 'quota_remaining': 10}
+    content = orjson.dumps(full)
+    assert decode_response(content) == {'items': [{'tags': ['python'], 'is_answered': True},
+                                                  {'tags': ['go'], 'is_answered': False}],
+                                        'has_more': False, 'quota_remaining': 10}
+    assert decode_response(content, filtered=True) == full  # с фильтром ответ уже минимальный
+
+    with fake_sof(lambda tag, page: {**full, 'quota_max': 10000}, api_filter='') as client:
+        assert client.app.state.sof.settings.api_filter == ''  # фильтр не создан (404) - запросы без него
+        response = client.post('/search', params={'tag': 'python'})
+        assert response.json() == {'python': {'total': 1, 'answered': 1}, 'go': {'total': 1, 'answered': 0}}
+
+
+def test_create_filter_returns_empty_on_failure():
+    """ Фильтр создается с нужными полями, при любой ошибке - пустая строка (фильтр StackExchange по умолчанию) """
+    import httpx
+    from src.requester import FILTER_INCLUDE, create_filter
+
+    settings = Settings(version='test', filter_url='https://sof.test/2.3/filters/create')
+    requests = []
+
+    def client(response) -> httpx.AsyncClient:
+        def handler(request: httpx.Request) -> httpx.Response:
+            requests.append(request)
+            if isinstance(response, Exception):
+                raise response
+            return response
+        return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def scenario(response) -> str:
+        async with client(response) as aclient:
+            return await create_filter(aclient, settings)
+
+    assert asyncio.run(scenario(httpx.Response(200, json={'items': [{'filter': '!abc'}]}))) == '!abc'
+    assert requests[0].url.params['include'] == ';'.join(FILTER_INCLUDE)
+    assert requests[0].url.params['base'] == 'none'
+
+    assert asyncio.run(scenario(httpx.Response(400, json={'error_id': 400}))) == ''
+    assert asyncio.run(scenario(httpx.Response(200, json={'items': []}))) == ''
+    assert asyncio.run(scenario(httpx.Response(200, content=b'not json'))) == ''
+    assert asyncio.run(scenario(httpx.ConnectError('connection refused'))) == ''
+
+
+def test_create_client_settings(monkeypatch):
+    """ Тайм-ауты и лимиты из настроек, HTTP/2, Accept-Encoding br только при установленном brotli """
+    import httpx
+    import src.requester
+    from src.requester import create_client
+
+    settings = Settings(version='test', timeout=7, connect_timeout=2, pool_timeout=3, http2=True)
+    sent = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        sent.append(request)
+        return httpx.Response(200)
+
+    async def scenario(aclient: httpx.AsyncClient):
+        # настроенный транспорт - для проверки пула, запрос - в MockTransport: заголовки клиента в каждом запросе
+        transport, aclient._transport = aclient._transport, httpx.MockTransport(handler)
+        async with aclient:
+            await aclient.get('https://sof.test/2.3/search')
+        await transport.aclose()
+        return transport
+
+    aclient = create_client(settings, httpx.Limits(max_connections=5))
+    assert aclient.timeout == httpx.Timeout(7, connect=2, pool=3)
+    transport = asyncio.run(scenario(aclient))
+    assert transport._pool._http2 and transport._pool._max_connections == 5
+    assert sent[-1].headers['Accept-Encoding'] == 'br, gzip'
+
+    monkeypatch.setattr(src.requester, 'BROTLI_AVAILABLE', False)
+    monkeypatch.setattr(src.requester, 'HTTP2_AVAILABLE', False)  # h2 не установлен - HTTP/1.1
+    transport = asyncio.run(scenario(create_client(settings, httpx.Limits(max_connections=5))))
+    assert not transport._pool._http2 and sent[-1].headers['Accept-Encoding'] == 'gzip'
+
+
+def test_warm_up_connections_and_errors(monkeypatch):
+    """ Прогрев - HEAD корня хоста (без квоты): одно соединение под HTTP/2, ошибки только в лог """
+    import httpx
+    import src.requester
+    from src.requester import warm_up
+
+    heads = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        heads.append((request.method, str(request.url)))
+        if request.url.host == 'down.test':
+            raise httpx.ConnectError('connection refused')
+        return httpx.Response(200)
+
+    async def scenario(**options):
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as aclient:
+            await warm_up(aclient, Settings(version='test', warmup_connections=3, **options))
+
+    asyncio.run(scenario(http2=True))
+    assert heads == [('HEAD', 'https://api.stackexchange.com/')]
+    monkeypatch.setattr(src.requester, 'HTTP2_AVAILABLE', False)
+    heads.clear()
+    asyncio.run(scenario(http2=True))  # h2 не установлен - соединений столько, сколько warmup_connections
+    assert len(heads) == 3
+
+    messages = []
+    sink = logger.add(messages.append, level='WARNING', format='{message}')
+    try:
+        heads.clear()
+        asyncio.run(scenario(http2=False, url='https://down.test/2.3/search'))  # не бросает исключение
+    finally:
+        logger.remove(sink)
+    assert heads == [('HEAD', 'https://down.test/')] * 3
+    assert len(messages) == 1 and '3 failed' in messages[0] and 'ConnectError' in messages[0]
+
+# endregion
+
+
+# region Governor
+
+def test_governor_quota_backoff_and_ban():
+    """ Регулятор отвечает 429 сам, не дожидаясь бана от StackOverflow """
+    from src.governor import QuotaGovernor
+    from src.requester import UnsuccessfulRequest
+
+    governor = QuotaGovernor(rate=0, burst=1, quota_reserve=10, max_backoff_wait=5)
+    endpoint = '/2.3/search'
+    assert governor.check(endpoint) == 0
+
+    governor.observe(endpoint, {'quota_remaining': 200, 'quota_max': 300, 'backoff': 3})
+    assert 0 < governor.check(endpoint) <= 3  # короткий backoff - ждем
+    assert governor.check('/2.3/questions') == 0  # backoff только на свой метод
+
+    governor.observe(endpoint, {'quota_remaining': 5, 'quota_max': 300, 'backoff': 100})
+    with pytest.raises(UnsuccessfulRequest) as exc:
+        governor.check(endpoint)
+    assert exc.value.error_code == 429
+
+    governor.ban('too many requests from this IP, more requests available in 82235 seconds')
+    assert 82000 < governor.status()['banned_for'] <= 82235
+
+# endregion
+
+
+# region Hot tags refresher
+
+def test_refresher_refetches_first_page(settings):
+    """ Популярный тег обновляется заранее: первая страница запрашивается заново, следующие удаляются из кэша """
+    from src.cache import TagCache, cache_key
+    from src.data_extractor import count_questions
+    from src.refresher import HotTagRefresher
+
+    fetched = []
+
+    async def fetch(tag):
+        fetched.append(tag)
+        return count_questions({'items': [{'tags': [tag, 'new'], 'is_answered': True}]})
+
+    async def run():
+        cache = TagCache(ttl=settings.refresh_ahead / 2, max_size=10)  # запись устареет раньше refresh_ahead
+        first, second = cache_key('python', settings), cache_key('python', settings, 2)
+        cache.put(first, count_questions({'items': [{'tags': ['python'], 'is_answered': False}]}))
+        cache.put(second, count_questions({'items': [{'tags': ['python', 'old'], 'is_answered': False}]}))
+
+        refresher = HotTagRefresher(cache, fetch, settings)
+        refresher.touch('python')
+        await refresher.refresh_due()
+        return cache.get(first), cache.get(second, allow_stale=True)
+
+    first, second = asyncio.run(run())
+    assert fetched == ['python']
+    assert first.to_dict() == {'python': {'total': 1, 'answered': 1}, 'new': {'total': 1, 'answered': 1}}
+    assert second is None  # вопросы второй страницы сдвинулись - она запросится заново
+
+# endregion
+
+
+# region Shared store
+
+def test_sqlite_store_shared_between_workers(settings, tmp_path):
+    """ Два worker'а с общим SQLite хранилищем видят статистику и бан друг друга """
+    from src.cache import TagCache, cache_key
+    from src.data_extractor import count_questions
+    from src.governor import QuotaGovernor
+    from src.requester import UnsuccessfulRequest
+    from src.store import SQLiteStore
+
+    path = str(tmp_path / 'store.db')
+    first, second = SQLiteStore(path), SQLiteStore(path)
+    key = cache_key('python', settings)
+    stats = count_questions({'items': [{'tags': ['python'], 'is_answered': True}], 'has_more': True})
+
+    TagCache(ttl=60, max_size=10, store=first).put(key, stats)
+    shared = TagCache(ttl=60, max_size=10, store=second).get_shared(key)
+    assert shared.to_dict() == stats.to_dict() and shared.has_more
+
+    QuotaGovernor(0, 1, 10, 5, store=first).ban('more requests available in 600 seconds')
+    with pytest.raises(UnsuccessfulRequest) as exc:
+        QuotaGovernor(0, 1, 10, 5, store=second).check('/2.3/search')
+    assert exc.value.error_code == 429
+
+    first.close()
+    second.close()
+
+
+def test_sqlite_store_does_not_block_on_busy_database(tmp_path):
+    """ Блокировка записи другого worker'а ждется не дольше busy_timeout: запись пропускается, сбой чтения - промах """
+    import sqlite3
+    import time
+    from src.data_extractor import TagStats
+    from src.store import SQLiteStore, StatsStore
+
+    with pytest.raises(TypeError):  # интерфейс, не реализация
+        StatsStore()
+
+    path = str(tmp_path / 'store.db')
+    store = SQLiteStore(path, busy_timeout=0.05)
+    store.put_stats('python', TagStats({'python': [1, 1]}, 1), time.time() + 60)
+
+    other = sqlite3.connect(path, isolation_level=None)  # другой worker держит блокировку записи
+    other.execute('BEGIN IMMEDIATE')
+    other.execute("DELETE FROM stats WHERE key = 'go'")
+    start = time.perf_counter()
+    store.put_stats('go', TagStats(), time.time() + 60)
+    store.put_until('ban', time.time() + 60)
+    assert time.perf_counter() - start < 1 and store.errors == 2
+    assert store.get_stats('python')[0].to_dict() == {'python': {'total': 1, 'answered': 1}}  # WAL: чтение идет
+    other.execute('ROLLBACK')
+
+    other.execute('DROP TABLE upstream')  # любая OperationalError при чтении - "нет данных"
+    assert store.get_quota() is None and store.get_until('ban') == 0 and store.errors == 4
+    other.close()
+    store.close()
+
+
+def test_memory_backend_keeps_only_bounded_cache():
+    """ memory - без общего хранилища: в памяти только кэш, ограниченный cache_max_size """
+    from src.cache import TagCache
+    from src.store import create_store
+
+    store = create_store(Settings(version='test', store_backend='memory'))
+    assert store is None
+    cache = TagCache(ttl=60, max_size=10, store=store)
+    for i in range(100):
+        cache.put(('tag', i), i)
+    assert len(cache) == 10
+
+# endregion
+
+
+# region Metrics
+
+def test_histogram_render():
+    """ Бакеты гистограммы накопительные, как требует формат Prometheus """
+    from src.metrics import REGISTRY, Histogram
+
+    histogram = Histogram('test_duration_seconds', 'Test', buckets=(0.1, 1))
+    REGISTRY.remove(histogram)  # не выводить тестовую метрику в /metrics
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+
+    lines = histogram.render()
+    assert 'test_duration_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_duration_seconds_bucket{le="1"} 2' in lines
+    assert 'test_duration_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_duration_seconds_count 3' in lines
+
+    labeled = Histogram('test_labeled_seconds', 'Test', ('endpoint',), buckets=(1,))
+    REGISTRY.remove(labeled)
+    labeled.observe(0.5, 'search')
+    labeled.observe(2, 'batch')
+    lines = labeled.render()
+    assert 'test_labeled_seconds_bucket{endpoint="search",le="1"} 1' in lines
+    assert 'test_labeled_seconds_bucket{endpoint="batch",le="+Inf"} 1' in lines
+    assert 'test_labeled_seconds_sum{endpoint="batch"} 2.0' in lines and labeled.sum('search') == 0.5
+
+# endregion
+
+
+# region Request log
+
+def test_request_log_sampling_and_summary():
+    """ При log_sample_rate 0 подробных логов нет, а сводка считает все запросы и начинает период заново """
+    from src.request_log import RequestLog
+
+    request_log = RequestLog(sample_rate=0, summary_interval=60)
+    assert not any(request_log.sampled() for _ in range(100))
+    assert RequestLog(sample_rate=1, summary_interval=60).sampled()
+
+    messages = []
+    sink = logger.add(messages.append, level='INFO', format='{message}')
+    try:
+        request_log.record(200, 0.1)
+        request_log.record(500, 0.3)
+        request_log.summary()
+        request_log.summary()  # пустой период не логируется
+    finally:
+        logger.remove(sink)
+
+    assert len(messages) == 1
+    assert '2 requests, 1 errors, avg 0.200 s, max 0.300 s' in messages[0]
+    assert request_log.requests == 0
+
+
+def test_search_logs_nothing_below_trace_unless_sampled(fake_sof):
+    """ Запрос без выборки не пишет в логи DEBUG и выше ничего: строки по тегам - TRACE, подробные - по выборке """
+    for rate, per_request in (0, 0), (1, 3):  # входящий запрос, время запроса, успех
+        records = []
+        with fake_sof(lambda tag, page: sof_page(tag, 5, False), log_sample_rate=rate) as client:
+            sink = logger.add(records.append, level='DEBUG', format='{message}')
+            try:
+                for i in range(10):  # cache_ttl - каждый раз другие теги, чтобы были запросы к StackOverflow
+                    response = client.post('/search', params={'tag': [f'a{i}', f'b{i}', f'c{i}']})
+                    assert response.status_code == 200
+            finally:
+                logger.remove(sink)
+        assert len(records) == 10 * per_request, records
+
+# endregion
+
+
+# region Responses
+
+def test_stats_response_negotiation():
+    """ Компактный JSON по умолчанию, человекочитаемый для браузера, gzip только от compress_min_size """
+    import gzip
+
+    import orjson
+    from starlette.requests import Request
+
+    from src.responses import accepted_encodings, stats_response
+
+    def request(**headers) -> Request:
+        raw = [(name.replace('_', '-').encode(), value.encode()) for name, value in headers.items()]
+        return Request({'type': 'http', 'method': 'POST', 'path': '/search', 'query_string': b'', 'headers': raw})
+
+    content = {'python': {'total': 100, 'answered': 50}}
+    assert stats_response(request(accept='*/*'), content).body == orjson.dumps(content)
+    assert b'\n' in stats_response(request(accept='text/html,*/*'), content).body
+
+    compressed = stats_response(request(accept_encoding='gzip, br'), content, compress_min_size=10)
+    assert compressed.headers['content-encoding'] == 'gzip'
+    assert gzip.decompress(compressed.body) == orjson.dumps(content)
+    assert 'content-encoding' not in stats_response(request(accept_encoding='gzip'), content, 0).headers
+    assert accepted_encodings('gzip;q=0, zstd') == {'zstd'}
+
+
+def test_stats_response_msgpack_zstd_and_fallback(monkeypatch):
+    """ MessagePack и zstd, если пакеты установлены, без них - JSON и gzip """
+    msgpack = pytest.importorskip('msgpack')
+    zstandard = pytest.importorskip('zstandard')
+    from starlette.requests import Request
+
+    from src import responses
+
+    request = Request({'type': 'http', 'method': 'POST', 'path': '/search', 'query_string': b'',
+                       'headers': [(b'accept', b'application/msgpack'), (b'accept-encoding', b'zstd, gzip')]})
+    content = {'python': {'total': 100, 'answered': 50}}
+
+    packed = responses.stats_response(request, content, compress_min_size=10)
+    assert packed.media_type == 'application/msgpack' and packed.headers['content-encoding'] == 'zstd'
+    assert msgpack.unpackb(zstandard.ZstdDecompressor().decompress(packed.body)) == content
+
+    monkeypatch.setattr(responses, 'msgpack', None)
+    monkeypatch.setattr(responses, 'zstandard', None)
+    fallback = responses.stats_response(request, content, compress_min_size=10)
+    assert fallback.media_type == 'application/json' and fallback.headers['content-encoding'] == 'gzip'
+
+# endregion
+
+
+# region Top tags
+
+def test_to_dict_top_min_total_sort_by():
+    """ top выбирает теги с наибольшим sort_by, min_total отбрасывает редкие теги """
+    from src.data_extractor import TagStats
+
+    stats = TagStats({'a': [10, 1], 'b': [5, 5], 'c': [1, 1], 'd': [7, 0]}, questions=10)
+    assert list(stats.to_dict(top=2)) == ['a', 'd']
+    assert list(stats.to_dict(top=2, sort_by='answered')) == ['b', 'a']
+    assert list(stats.to_dict(sort_by='ratio', min_total=2)) == ['b', 'a', 'd']
+    assert list(stats.to_dict(min_total=6)) == ['a', 'd']  # без top / sort_by порядок не меняется
+    assert stats.to_dict(top=1) == {'a': {'total': 10, 'answered': 1}}
+
+# endregion
+
+
+# region Vector engine
+
+def test_numpy_engine_matches_python():
+    """ Сложение через NumPy дает ту же статистику, что и на Python, и переиспользует массивы статистик """
+    pytest.importorskip('numpy')
+    from src.data_extractor import TagStats, extract_info
+
+    first = TagStats({'python': [3, 1], 'django': [2, 2]}, questions=3)
+    second = TagStats({'django': [1, 0], 'flask': [4, 1]}, questions=4)
+    python = asyncio.run(extract_info([first, second]))
+    assert asyncio.run(extract_info([first, second], engine='numpy')) == python
+    assert first.arrays is not None
+
+    first.update(TagStats({'python': [1, 1]}, questions=1))  # изменение сбрасывает массивы
+    assert first.arrays is None
+    assert asyncio.run(extract_info([first, second], engine='numpy'))['python'] == {'total': 4, 'answered': 2}
+
+
+def test_engine_falls_back_to_python_without_numpy(monkeypatch):
+    """ Без numpy auto и numpy - сложение на Python с тем же результатом """
+    from src import vector_engine
+    from src.data_extractor import TagStats, extract_info
+
+    monkeypatch.setattr(vector_engine, 'np', None)
+    assert vector_engine.resolve_engine('numpy') == 'python' and vector_engine.resolve_engine('auto') == 'python'
+    partials = [TagStats({'python': [3, 1]}, questions=3), TagStats({'python': [1, 1], 'go': [2, 0]}, questions=2)]
+    engine = vector_engine.resolve_engine('auto')
+    assert asyncio.run(extract_info(partials, engine=engine)) == {'python': {'total': 4, 'answered': 2},
+                                                                  'go': {'total': 2, 'answered': 0}}
+
+# endregion
+
+
+# region Offload
+
+def test_offload_aggregation_and_loop_lag():
+    """ Сложение в пуле потоков / процессов дает тот же результат, задержка event loop замеряется """
+    import pickle
+    import time
+    from src.data_extractor import TagStats, extract_info
+    from src.offload import LoopLagMonitor, OffloadError, Offloader
+
+    partials = [TagStats({'python': [3, 1], 'django': [2, 2]}, questions=3), TagStats({'django': [1, 0]}, questions=1)]
+    expected = asyncio.run(extract_info(partials, top=1))
+    for kind in ('thread', 'process'):
+        offloader = Offloader(kind, workers=1, min_tags=1)
+        try:
+            assert asyncio.run(extract_info(partials, top=1, offloader=offloader)) == expected
+        finally:
+            offloader.shutdown()
+    assert not Offloader('none', min_tags=1).should_aggregate(10 ** 6)
+    with pytest.raises(OffloadError):
+        Offloader('fork')
+
+    partials[0].arrays = 'ids of this process'  # в другой процесс массивы не передаются
+    restored = pickle.loads(pickle.dumps(partials[0]))
+    assert restored.arrays is None and restored.counts == partials[0].counts
+
+    async def blocked_loop() -> float:
+        monitor = LoopLagMonitor(interval=0.05)
+        monitor.start()
+        await asyncio.sleep(0.01)
+        time.sleep(0.2)  # синхронная работа в event loop
+        await asyncio.sleep(0.1)
+        await monitor.stop()
+        return monitor.max_lag
+
+    assert asyncio.run(blocked_loop()) >= 0.1
+
+# endregion
+
+
+# region Snapshot
+
+def test_snapshot_warm_restart(tmp_path):
+    """ Записи кэша переживают перезапуск через снимок на диске, устаревшие не отдаются, чужие записи сохраняются """
+    import time
+    from src.cache import TagCache
+    from src.data_extractor import TagStats
+    from src.snapshot import SnapshotWriter, TagSnapshot
+
+    path = str(tmp_path / 'data' / 'tags.snap')
+    other = TagSnapshot(path, ttl=300)
+    other.write([(('java', 'so', 1), time.time(), time.time() + 300, TagStats({'java': [2, 1]}, questions=2))])
+
+    cache = TagCache(ttl=300, max_size=10)
+    cache.put(('python', 'so', 1), TagStats({'python': [5, 3]}, questions=5))
+    cache.put(('old', 'so', 1), TagStats({'old': [1, 1]}, questions=1), ttl=-1)  # уже устарела
+    asyncio.run(SnapshotWriter(TagSnapshot(path, ttl=300), cache).save())
+
+    snapshot = TagSnapshot(path, ttl=300)
+    snapshot.open()
+    assert len(snapshot) == 2  # свои записи и запись другого worker'а, без устаревшей
+    restarted = TagCache(ttl=300, max_size=10, snapshot=snapshot)
+
+    async def no_fetch():
+        raise AssertionError('must be served from snapshot')
+
+    assert asyncio.run(restarted.get_or_fetch(('python', 'so', 1), no_fetch)).counts == {'python': [5, 3]}
+    assert restarted.get(('java', 'so', 1)) is None  # читается лениво, при промахе
+    assert restarted.get_snapshot(('java', 'so', 1)).questions == 2
+    assert 0 < restarted.expires_in(('java', 'so', 1)) <= 300
+    snapshot.close()
+
+    shorter = TagSnapshot(path, ttl=0.001)  # TTL уменьшили в конфиге - записи уже устарели
+    shorter.open()
+    assert shorter.get(('python', 'so', 1)) is None
+
+    with open(path, 'wb') as f:
+        f.write(b'garbage!!')
+    damaged = TagSnapshot(path, ttl=300)
+    damaged.open()  # поврежденный файл - пустой снимок, не ошибка
+    assert len(damaged) == 0
+
+# endregion
+
+
+# region Admission control
+
+def test_admission_sheds_when_queue_is_full_or_slow():
+    """ Лишние ожидающие сразу получают 503 с Retry-After, ожидание слота ограничено по времени """
+    from src.admission import AdmissionControl, Overloaded
+
+    async def scenario():
+        admission = AdmissionControl(slots=1, max_queue=1, queue_timeout=0.1, retry_after=2)
+
+        async def hold(seconds: float):
+            async with admission.slot():
+                await asyncio.sleep(seconds)
+
+        holder = asyncio.ensure_future(hold(0.3))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(hold(0))  # встает в очередь
+        await asyncio.sleep(0)
+        assert admission.status()['waiting'] == 1
+
+        with pytest.raises(Overloaded) as full:  # очередь полна - сразу, без ожидания
+            await hold(0)
+        assert full.value.error_code == 503 and full.value.headers == {'Retry-After': '2'}
+        with pytest.raises(Overloaded):  # слот не освободился за queue_timeout
+            await waiter
+        await holder
+
+        await hold(0)  # слот освободился, очередь пуста
+        assert admission.status() == {'slots': 1, 'busy': 0, 'waiting': 0, 'max_queue': 1, 'rejected': 2}
+
+    asyncio.run(scenario())
+
+
+def test_admission_is_fair_between_clients():
+    """ Клиент с длинной очередью не задерживает других: слоты выдаются по очереди с учетом весов и лимита """
+    from src.admission import AdmissionControl
+
+    async def scenario():
+        admission = AdmissionControl(slots=1, max_queue=100, queue_timeout=0, client_max_slots=1,
+                                     weights={'partner': 2})
+        order = []
+
+        async def hold(client: str):
+            async with admission.slot(client):
+                order.append(client)
+                await asyncio.sleep(0.01)
+
+        tasks = [asyncio.ensure_future(hold('heavy')) for _ in range(6)]  # первый занимает слот, остальные ждут
+        await asyncio.sleep(0)
+        tasks += [asyncio.ensure_future(hold('light')) for _ in range(2)]
+        tasks += [asyncio.ensure_future(hold('partner')) for _ in range(4)]
+        await asyncio.sleep(0)
+        assert admission.clients()['heavy'] == {'active': 1, 'waiting': 5, 'weight': 1.0}
+        await asyncio.gather(*tasks)
+
+        assert order[:4].count('heavy') == 1 and order[:4].count('partner') == 2  # не 6 подряд от heavy
+        assert order.index('light') < 3 and order[-3:] == ['heavy'] * 3
+        assert admission.free == 1 and not admission.clients()
+
+    asyncio.run(scenario())
+
+# endregion
+
+
+# region Deadlines and cancellation
+
+def test_cache_cancels_fetch_without_waiters():
+    """ Общий запрос отменяется, только когда отменены все ожидающие его """
+    from src.cache import TagCache
+
+    async def scenario():
+        cache = TagCache(ttl=300, max_size=10)
+        started, cancelled = asyncio.Event(), asyncio.Event()
+
+        async def fetch():
+            started.set()
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        first = asyncio.ensure_future(cache.get_or_fetch('python', fetch))
+        second = asyncio.ensure_future(cache.get_or_fetch('python', fetch))
+        await started.wait()
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled.is_set()  # второй еще ждет
+        second.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        await asyncio.sleep(0.01)  # callback завершения запроса
+        assert not cache._waiters and not cache._in_flight
+
+    asyncio.run(scenario())
+
+
+def test_search_deadline_partial_and_disconnect(fake_sof):
+    """
+    Бюджет исчерпан - 504 или частичный ответ, клиент отключился - 499. В обоих случаях запрос к StackOverflow
+    отменяется
+    """
+    import time
+    from starlette.requests import Request
+    from run_sof_stats import fetch_tags
+    from src.deadline import ClientDisconnected
+
+    cancelled = []
+
+    async def handler(tag: str, page: int) -> dict:
+        if tag.startswith('slow'):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                cancelled.append(tag)
+                raise
+        return sof_page(tag, 2)
+
+    def wait_cancelled(tag: str):
+        for _ in range(100):  # отмена доходит до запроса через задачу кэша
+            if tag in cancelled:
+                return
+            time.sleep(0.01)
+        raise AssertionError(f'{tag} was not cancelled')
+
+    with fake_sof(handler) as client:
+        start = time.perf_counter()
+        timeout = client.post('/search', params={'tag': ['fast', 'slow1'], 'timeout': 0.3})
+        assert timeout.status_code == 504 and time.perf_counter() - start < 2
+        wait_cancelled('slow1')
+
+        partial = client.post('/search', params={'tag': ['fast', 'slow2'], 'timeout': 0.3, 'partial': True})
+        assert partial.status_code == 200
+        assert partial.json() == {'stats': {'fast': {'total': 2, 'answered': 1}},
+                                  'tags': {'fast': {'status': 'ok'}, 'slow2': {'status': 'timeout', 'code': 504}},
+                                  'partial': True}
+        wait_cancelled('slow2')
+
+        async def receive() -> dict:
+            await asyncio.sleep(0.2)
+            return {'type': 'http.disconnect'}
+
+        request = Request({'type': 'http', 'method': 'POST', 'path': '/search', 'query_string': b'', 'headers': []},
+                          receive)
+        with pytest.raises(ClientDisconnected) as error:
+            client.portal.call(fetch_tags, client.app.state.sof, ['slow3'], 1, None, request)
+        assert error.value.error_code == 499
+        wait_cancelled('slow3')
+
+
+def test_deadline_budget_is_capped():
+    """ Бюджет из параметра или заголовка не больше Settings.timeout, не конечные и неверные значения - по умолчанию """
+    from starlette.requests import Request
+    from src.deadline import Deadline
+
+    def budget(header: str = None, timeout: float = None) -> float:
+        headers = [(b'x-request-timeout', header.encode())] if header is not None else []
+        request = Request({'type': 'http', 'method': 'POST', 'path': '/search', 'query_string': b'',
+                           'headers': headers})
+        return Deadline.from_request(request, timeout, max_budget=10).budget
+
+    assert budget('2.5') == 2.5 and budget('30') == 10 and budget('2', timeout=1) == 1
+    assert budget() == budget('abc') == budget('-1') == budget('0') == 10
+    assert budget('nan') == budget('inf') == budget(timeout=float('nan')) == budget(timeout=float('-inf')) == 10
+
+# endregion
+
+
+# region Resilience
+
+def test_upstream_policy_retries_and_circuit_breaker():
+    """
+    Сбой соединения повторяется, после failures неудачных вызовов подряд breaker сразу отвечает 503.
+    Повторы внутри вызова - один сбой, иначе breaker открывался бы от одного вызова с retries >= failures - 1
+    """
+    import httpx
+    from src.requester import UnsuccessfulRequest
+    from src.resilience import CircuitBreaker, UpstreamPolicy
+
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.params['intitle'])
+        if request.url.params['intitle'] == 'down' or len(calls) == 1:
+            raise httpx.ConnectError('connection refused')
+        return httpx.Response(200, json={'items': []})
+
+    async def scenario():
+        policy = UpstreamPolicy(retries=2, backoff=0.01, breaker=CircuitBreaker(failures=2, reset_timeout=60))
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as aclient:
+            response = await policy.get(aclient, 'https://sof.test/search', {'intitle': 'python'})
+            assert response.status_code == 200 and calls == ['python', 'python']  # первая попытка повторена
+            assert policy.breaker.consecutive == 0  # повтор удался - сбоя нет
+
+            with pytest.raises(httpx.ConnectError):
+                await policy.get(aclient, 'https://sof.test/search', {'intitle': 'down'})
+            assert calls.count('down') == 3  # три попытки, но один сбой
+            assert policy.breaker.state == 'closed' and policy.breaker.consecutive == 1
+            with pytest.raises(httpx.ConnectError):
+                await policy.get(aclient, 'https://sof.test/search', {'intitle': 'down'})
+            assert policy.breaker.state == 'open' and calls.count('down') == 6
+            with pytest.raises(UnsuccessfulRequest) as error:
+                policy.check()
+            assert error.value.error_code == 503 and 'Retry-After' in error.value.headers
+
+    asyncio.run(scenario())
+
+
+def test_hedged_request_takes_own_slot():
+    """ Hedged запрос занимает свой слот admission и не отправляется, если свободного слота нет """
+    import httpx
+    from src.admission import AdmissionControl
+    from src.resilience import LatencyTracker, UpstreamPolicy
+
+    calls = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request.url.params['intitle'])
+        if len(calls) == 1:  # первый запрос отвечает дольше обычного
+            await asyncio.sleep(0.3)
+        return httpx.Response(200, json={'items': [len(calls)]})
+
+    async def scenario(slots: int) -> tuple[httpx.Response, AdmissionControl]:
+        admission = AdmissionControl(slots=slots)
+        latency = LatencyTracker(min_samples=1)
+        latency.observe(0.01)
+        policy = UpstreamPolicy(hedge=True, hedge_min_delay=0.02, latency=latency, admission=admission)
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as aclient:
+            async with admission.slot('user'):  # слот основного запроса
+                response = await policy.get(aclient, 'https://sof.test/search', {'intitle': 'python'})
+                assert admission.free == slots - 1  # слот hedged запроса уже освобожден
+        return response, admission
+
+    response, admission = asyncio.run(scenario(slots=2))
+    assert calls == ['python', 'python'] and response.json() == {'items': [2]}  # hedged ответил первым
+    assert admission.free == 2 and not admission.clients()
+
+    calls.clear()
+    response, _ = asyncio.run(scenario(slots=1))  # свободного слота нет - ждем основной запрос
+    assert calls == ['python'] and response.json() == {'items': [1]}
+
+# endregion
+
+
+# region Query planner
+
+def test_plan_query_dedupes_canonical_tags_and_orders_cached_first():
+    """ Теги приводятся к канонической форме без повторов, закэшированные запрашиваются первыми, лимиты - сразу 422 """
+    from src.cache import TagCache, cache_key
+    from src.data_extractor import TagStats
+    from src.planner import InvalidQuery, plan_query
+
+    _settings = Settings(version='test', max_tags=3, max_fetches=4)
+    cache = TagCache(ttl=300, max_size=10)
+    cache.put(cache_key('rust', _settings), TagStats())
+
+    plan = plan_query([['Python', 'python', 'ｐｙｔｈｏｎ', 'Rust'], ['RUST', 'Джава']], 1, cache, _settings)
+    assert plan.groups == [['python', 'rust'], ['rust', 'джава']]
+    assert plan.tags == ['rust', 'python', 'джава'] and plan.cached == 1
+    assert cache.hits == 0 and cache.misses == 0  # проверка кэша не считается обращением к нему
+
+    for groups, pages in ([['a', 'b', 'c', 'd']], 1), ([['a', 'b', 'c']], 2), ([['c-sharp']], 1), ([['a']], 11):
+        with pytest.raises(InvalidQuery) as error:
+            plan_query(groups, pages, cache, _settings)
+        assert error.value.error_code == 422
+
+# endregion
+
+
+# region Search
+
+def test_search_pages_stop_after_last_page(fake_sof):
+    """ Страница с has_more false - последняя: запросы следующих страниц отменяются и не учитываются """
+    answered = []
+
+    async def handler(tag: str, page: int) -> dict:
+        if page > 2:
+            await asyncio.sleep(2)  # отменяется раньше, чем ответит
+        answered.append(page)
+        return sof_page(tag, 10, page < 2, f'page{page}')
+
+    with fake_sof(handler, max_pages=4) as client:
+        response = client.post('/search', params={'tag': 'python', 'pages': 4})
+        assert response.status_code == 200
+        assert response.json() == {'python': {'total': 20, 'answered': 10}, 'page1': {'total': 10, 'answered': 5},
+                                   'page2': {'total': 10, 'answered': 5}}
+        assert sorted(answered) == [1, 2]
+
+        too_many = client.post('/search', params={'tag': 'python', 'pages': 5})
+        assert too_many.status_code == 422 and 'more than 4' in too_many.json()['detail']
+
+
+def test_search_latency_covers_streamed_body(fake_sof):
+    """ Время потокового /search в метриках - до конца тела ответа, а не до заголовков """
+    from src import metrics
+
+    async def handler(tag: str, page: int) -> dict:
+        await asyncio.sleep(0.3 if tag == 'slow' else 0)
+        return sof_page(tag, 2)
+
+    with fake_sof(handler) as client:
+        before = metrics.SEARCH_LATENCY.sum('search')
+        response = client.post('/search', params={'tag': ['fast', 'slow'], 'stream': True})
+        assert response.status_code == 200 and len(response.text.splitlines()) == 3
+        assert metrics.SEARCH_LATENCY.sum('search') - before >= 0.3
+
+
+def test_search_batch_shares_fetches_between_groups(fake_sof):
+    """ Тег из нескольких групп запрашивается один раз, лимиты групп и тегов - сразу 422 """
+    from src import metrics
+
+    calls = []
+
+    def handler(tag: str, page: int) -> dict:
+        calls.append(tag)
+        return sof_page(tag, 4, True, 'common')
+
+    with fake_sof(handler, max_batch_groups=2, max_tags=3) as client:
+        ok, rejected = (metrics.SEARCH_REQUESTS.values.get(('batch', status), 0) for status in ('200', '422'))
+        response = client.post('/search/batch', json={'groups': [['python', 'go'], ['Go', 'rust']], 'top': 2})
+        assert response.status_code == 200
+        assert response.json() == {'results': [{'common': {'total': 8, 'answered': 4},
+                                                'python': {'total': 4, 'answered': 2}},
+                                               {'common': {'total': 8, 'answered': 4},
+                                                'go': {'total': 4, 'answered': 2}}]}
+        assert sorted(calls) == ['go', 'python', 'rust']  # go - один запрос на обе группы
+
+        groups = client.post('/search/batch', json={'groups': [['a'], ['b'], ['c']]})
+        assert groups.status_code == 422 and '3 groups' in groups.json()['detail']
+        tags = client.post('/search/batch', json={'groups': [['a', 'b'], ['c', 'd']]})
+        assert tags.status_code == 422 and '4 distinct tags' in tags.json()['detail']
+        assert len(calls) == 3  # отклонены до запросов к StackOverflow
+
+        assert metrics.SEARCH_REQUESTS.values[('batch', '200')] == ok + 1  # /search/batch тоже виден в /metrics
+        assert metrics.SEARCH_REQUESTS.values[('batch', '422')] == rejected + 2
+        assert 'sof_search_duration_seconds_count{endpoint="batch"}' in client.get('/metrics').text
+
+
+def test_search_stream_ndjson_sse_and_tag_errors(fake_sof):
+    """
+    Потоковый /search: строка на каждый тег (ошибка тега - его строкой, не обрывом), последняя - общая статистика
+    """
+    import httpx
+    import orjson
+
+    def handler(tag: str, page: int) -> dict | httpx.Response:
+        if tag == 'broken':
+            return httpx.Response(400, json={'error_id': 400, 'error_message': 'bad tag', 'error_name': 'bad'})
+        return sof_page(tag, 2)
+
+    with fake_sof(handler) as client:
+        response = client.post('/search', params={'tag': ['python', 'broken', 'go'], 'stream': True})
+        assert response.headers['content-type'].startswith('application/x-ndjson')
+        lines = [orjson.loads(line) for line in response.text.splitlines()]
+        assert len(lines) == 4
+        tags = {line['tag']: line for line in lines[:3]}
+        assert tags['python']['stats'] == {'python': {'total': 2, 'answered': 1}}
+        assert tags['broken']['code'] == 502 and 'error' in tags['broken']
+        assert lines[3] == {'total': {'python': {'total': 2, 'answered': 1}, 'go': {'total': 2, 'answered': 1}}}
+
+        sse = client.post('/search', params={'tag': 'python'}, headers={'Accept': 'text/event-stream'})
+        assert sse.headers['content-type'].startswith('text/event-stream')
+        events = sse.text.split('\n\n')
+        assert events[0].startswith('event: tag\ndata: {"tag":"python"')
+        assert events[1].startswith('event: total\ndata: ') and events[2] == ''
+
+# endregion
+
+
+
+# region Bench
+
+def test_bench_dump_toml_round_trip():
+    """ Временный конфиг нагрузочного теста читается tomllib в те же данные, что и боевой, включая словари """
+    import os
+    import tomllib
+    from bench.run_bench import ROOT, dump_toml
+
+    with open(os.path.join(ROOT, constants.WAR_CONFIG_PATH), 'rb') as f:
+        data = tomllib.load(f)
+    assert tomllib.loads(dump_toml(data)) == data
+
+    data = {'network': {'client_weights': {'partner': 2, 'api key "1"': 0.5}, 'empty': {}, 'hedge': True},
+            'stackoverflow': {'url': 'https://sof.test/поиск?a="b"\\c', 'tags': ['python', 'go'], 'pages': 3}}
+    assert tomllib.loads(dump_toml(data)) == data
+
 # endregion